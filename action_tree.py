@@ -16,8 +16,16 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import array
+import fnmatch
+import heapq
+import json
 import optparse
+import os
+import Queue
 import sys
+import threading
+import time
 
 
 # Workaround for Python's variable binding semantics.
@@ -25,11 +33,42 @@ def thunkify(func, *args):
     return lambda: func(*args)
 
 
+# Names are interned so that the many nodes built from the same
+# module and step names share their strings.
+def intern_name(name):
+    if type(name) is str:
+        return intern(name)
+    return name
+
+
 class ActionTreeNode(object):
 
-    def __init__(self, children, name):
-        self.children = children
-        self.__name__ = name
+    # Generated trees can have a lot of nodes, so nodes have no
+    # per-instance dict.
+    __slots__ = ("children", "__name__", "dependencies")
+
+    # "dependencies" maps a child's name to the names of the sibling
+    # children that must finish before it can start.  If it is None,
+    # each child depends on the one before it, so the children run in
+    # list order.
+    def __init__(self, children, name, dependencies=None):
+        self.children = tuple(children)
+        self.__name__ = intern_name(name)
+        self.dependencies = dependencies
+
+    def get_child_dependencies(self):
+        # Returns, for each child, the set of indexes of the siblings
+        # it depends on.  A dependency on a sibling that is not
+        # present (e.g. because it was filtered out) is ignored.
+        if self.dependencies is None:
+            return [set([index - 1]) if index > 0 else set()
+                    for index in range(len(self.children))]
+        index_by_name = dict((name, index) for index, (name, node)
+                             in enumerate(self.children))
+        return [set(index_by_name[dep]
+                    for dep in self.dependencies.get(name, ())
+                    if dep in index_by_name)
+                for name, node in self.children]
 
     def two_stage_run(self, log):
         steps = []
@@ -55,12 +94,13 @@ class ActionTreeNode(object):
         return run
 
     def __call__(self, log):
-        self.two_stage_run(log)()
+        run_action(self, log)
 
 
-def make_node(actions, name):
+def make_node(actions, name, dependencies=None):
     return ActionTreeNode([coerce_to_name_action_pair(action)
-                           for action in actions], name)
+                           for action in actions], name,
+                          dependencies=dependencies)
 
 
 # Intended to be used as a decorator
@@ -70,45 +110,493 @@ def action_node(unbound_method):
     return property(wrapper)
 
 
+# Gives a leaf action a fingerprint of its inputs, for use with a
+# StepJournal.  "fingerprint" is a function returning a string; it is
+# called when the leaf is ready to run.
+def with_fingerprint(action, fingerprint):
+    action.fingerprint = fingerprint
+    return action
+
+
 def coerce_to_name_action_pair(val):
     if isinstance(val, tuple):
-        return val
+        name, action = val
     else:
-        return (val.__name__, val)
+        name, action = val.__name__, val
+    return (intern_name(name), action)
 
 
 class ActionInContext(object):
 
-    def __init__(self, action, name, path):
+    __slots__ = ("action", "name", "parent", "level", "index")
+
+    # "parent" is the ActionInContext of the enclosing node, or None
+    # at the top.  Paths are found by following parents rather than
+    # being stored, which would take quadratic space in deep trees.
+    def __init__(self, action, name, parent):
         self.action = action
         self.name = name
-        self.path = path
+        self.parent = parent
+        if parent is None:
+            self.level = 0
+        else:
+            self.level = parent.level + 1
         self.index = None # Filled out later
 
+    @property
+    def path(self):
+        path = []
+        act = self
+        while act is not None:
+            path.append(act.name)
+            act = act.parent
+        path.reverse()
+        return path
+
     def get_level(self):
-        return len(self.path) - 1
+        return self.level
 
     def run_leaf(self, log):
         if not isinstance(self.action, ActionTreeNode):
             self.action(log)
 
     def get_names(self):
-        for i in range(len(self.path)):
-            yield ".".join(self.path[i:])
+        path = self.path
+        for i in range(len(path)):
+            yield ".".join(path[i:])
+
+
+class _Task(object):
+
+    def __init__(self, func, log, groups, index, path, fingerprint=None):
+        self.func = func
+        self.fingerprint = fingerprint
+        # "log" is None for the placeholder task of an empty node.
+        self.log = log
+        # Enclosing interior nodes, outermost first.
+        self.groups = groups
+        self.index = index
+        # Dotted name of the node, starting from the top of the tree.
+        self.path = path
+        self.dependencies = set()
+        self.dependents = []
+        # Estimated time from starting this task to finishing
+        # everything that depends on it.
+        self.priority = 0
+
+    def __cmp__(self, other):
+        return cmp((-self.priority, self.index),
+                   (-other.priority, other.index))
+
+
+class _Group(object):
+
+    # Tracks the log of an interior node: it is started when the
+    # first leaf below it starts and finished when the last one
+    # finishes.
+
+    def __init__(self, log):
+        self.log = log
+        self.pending = 0
+        self.started = False
+        self.finished = False
+
+
+def _get_child_order(action, dependencies):
+    # Returns the indexes of the children of "action" in an order in
+    # which each comes after the siblings it depends on, keeping to
+    # tree order where possible.
+    remaining = [len(deps) for deps in dependencies]
+    dependents = [[] for deps in dependencies]
+    for index, deps in enumerate(dependencies):
+        for dep in deps:
+            dependents[dep].append(index)
+    ready = [index for index, count in enumerate(remaining) if count == 0]
+    heapq.heapify(ready)
+    order = []
+    while len(ready) > 0:
+        index = heapq.heappop(ready)
+        order.append(index)
+        for dependent in dependents[index]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    if len(order) != len(dependencies):
+        raise Exception("Dependency cycle in action tree among the children "
+                        "of %r: %s" % (action.__name__, ", ".join(
+                    action.children[index][0]
+                    for index, count in enumerate(remaining) if count > 0)))
+    return order
+
+
+def _add_tasks(action, log, path, groups, incoming, tasks, all_groups):
+    # Adds a task for each leaf below the interior node "action",
+    # creating sublogs in tree order as two_stage_run() does, except
+    # that a child that depends on a later sibling comes after it.
+    # Every task depends on the tasks in "incoming".  Returns the
+    # tasks that nothing else below "action" depends on.
+    dependencies = action.get_child_dependencies()
+    depended_on = set()
+    for deps in dependencies:
+        depended_on.update(deps)
+    child_exits = {}
+    for index in _get_child_order(action, dependencies):
+        name, node = action.children[index]
+        sublog = log.child_log(name, do_start=False)
+        if len(dependencies[index]) == 0:
+            child_incoming = list(incoming)
+        else:
+            # Tasks inherit "incoming" via their siblings.
+            child_incoming = []
+            for dep in sorted(dependencies[index]):
+                child_incoming.extend(child_exits[dep])
+        subpath = "%s.%s" % (path, name)
+        if isinstance(node, ActionTreeNode):
+            group = _Group(sublog)
+            all_groups.append(group)
+            subgroups = groups + [group]
+            if len(node.children) == 0:
+                sinks = [_new_task(lambda: None, None, subpath, subgroups,
+                                   child_incoming, tasks)]
+            else:
+                sinks = _add_tasks(node, sublog, subpath, subgroups,
+                                   child_incoming, tasks, all_groups)
+        else:
+            sinks = [_new_task(thunkify(node, sublog), sublog, subpath, groups,
+                               child_incoming, tasks,
+                               fingerprint=getattr(node, "fingerprint", None))]
+        child_exits[index] = sinks
+    exits = []
+    for index in range(len(action.children)):
+        if index not in depended_on:
+            exits.extend(child_exits[index])
+    return exits
+
+
+def _new_task(func, log, path, groups, incoming, tasks, fingerprint=None):
+    task = _Task(func, log, groups, len(tasks), path, fingerprint)
+    for dep in incoming:
+        if dep not in task.dependencies:
+            task.dependencies.add(dep)
+            dep.dependents.append(task)
+    for group in groups:
+        group.pending += 1
+    tasks.append(task)
+    return task
+
+
+def _set_priorities(tasks, durations):
+    # Gives each task the estimated length of the longest chain of
+    # tasks starting from it, so that the longest chain is started
+    # first.
+    remaining = dict((task, len(task.dependents)) for task in tasks)
+    to_visit = [task for task in tasks if remaining[task] == 0]
+    while len(to_visit) > 0:
+        task = to_visit.pop()
+        task.priority = (durations.get(task.path) +
+                         max([dependent.priority
+                              for dependent in task.dependents] + [0]))
+        for dep in task.dependencies:
+            remaining[dep] -= 1
+            if remaining[dep] == 0:
+                to_visit.append(dep)
+
+
+class _Executor(object):
+
+    # Runs tasks whose dependencies have finished, up to "jobs" at a
+    # time.  Tasks with the highest priority go first, and otherwise
+    # those that come first in the tree.  After the first failure, no
+    # new tasks are started; the executor waits for the running ones
+    # and then re-raises the failure.
+    #
+    # With a journal, tasks' fingerprints are recorded when they
+    # succeed.  With "resume" as well, a task is skipped if its
+    # fingerprint matches the journal and none of the tasks it
+    # depends on were run.
+
+    def __init__(self, tasks, groups, jobs, durations=None, token_pool=None,
+                 journal=None, resume=False):
+        self._tasks = tasks
+        self._groups = groups
+        self._jobs = jobs
+        self._durations = durations
+        self._token_pool = token_pool
+        self._journal = journal
+        self._resume = resume
+        self._start_times = {}
+        self._fingerprints = {}
+        self._ran = set()
+        self._results = Queue.Queue()
+
+    def run(self):
+        if self._durations is not None:
+            try:
+                self._run()
+            finally:
+                self._durations.save()
+        else:
+            self._run()
+
+    def _run(self):
+        waiting = dict((task, len(task.dependencies))
+                       for task in self._tasks)
+        ready = [task for task in self._tasks if waiting[task] == 0]
+        heapq.heapify(ready)
+        running = 0
+        done = 0
+        failure = None
+        while True:
+            while len(ready) > 0 and running < self._jobs and failure is None:
+                task = heapq.heappop(ready)
+                self._start(task)
+                running += 1
+                if self._can_skip(task):
+                    self._results.put((task, None))
+                elif self._jobs == 1:
+                    self._ran.add(task)
+                    self._run_inline(task)
+                else:
+                    self._ran.add(task)
+                    self._run_in_thread(task)
+            if running == 0:
+                break
+            task, exc_info = _get_interruptibly(self._results)
+            running -= 1
+            done += 1
+            if exc_info is None:
+                self._finish(task)
+                if task in self._ran:
+                    self._record(task)
+                if (self._durations is not None and task.log is not None and
+                    task in self._ran):
+                    self._durations.record(
+                        task.path, time.time() - self._start_times[task])
+                for dependent in task.dependents:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        heapq.heappush(ready, dependent)
+            else:
+                if self._journal is not None:
+                    self._journal.forget(task.path)
+                if task.log is not None:
+                    task.log.finish(1)
+                if failure is None:
+                    failure = exc_info
+        if failure is not None:
+            # Interior nodes that were started but cannot complete.
+            for group in reversed(self._groups):
+                if group.started and not group.finished:
+                    group.finished = True
+                    group.log.finish(1)
+            raise failure[0], failure[1], failure[2]
+        if done != len(self._tasks):
+            raise Exception("Dependency cycle in action tree")
+
+    def _get_fingerprint(self, task):
+        if task.fingerprint is None:
+            return None
+        try:
+            return task.fingerprint()
+        except Exception:
+            # Let the task itself report the problem.
+            return None
+
+    def _can_skip(self, task):
+        if self._journal is None:
+            return False
+        deps_ran = any(dep in self._ran for dep in task.dependencies)
+        if task.log is None:
+            # The placeholder for an empty node passes on whether
+            # anything before it ran.
+            return self._resume and not deps_ran
+        fingerprint = self._get_fingerprint(task)
+        self._fingerprints[task] = fingerprint
+        return (self._resume and not deps_ran and fingerprint is not None and
+                self._journal.get(task.path) == fingerprint)
+
+    def _record(self, task):
+        if self._journal is not None:
+            fingerprint = self._fingerprints.get(task)
+            if fingerprint is None:
+                self._journal.forget(task.path)
+            else:
+                self._journal.record(task.path, fingerprint)
+
+    def _start(self, task):
+        self._start_times[task] = time.time()
+        for group in task.groups:
+            if not group.started:
+                group.started = True
+                group.log.start()
+        if task.log is not None:
+            task.log.start()
+
+    def _finish(self, task):
+        if task.log is not None:
+            task.log.finish(0)
+        for group in reversed(task.groups):
+            group.pending -= 1
+            if group.pending == 0:
+                group.finished = True
+                group.log.finish(0)
+
+    def _run_inline(self, task):
+        try:
+            _call_with_token(self._token_pool, task.func)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            self._results.put((task, sys.exc_info()))
+        else:
+            self._results.put((task, None))
+
+    def _run_in_thread(self, task):
+        def run():
+            try:
+                _call_with_token(self._token_pool, task.func)
+            except:
+                self._results.put((task, sys.exc_info()))
+            else:
+                self._results.put((task, None))
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+
+def _call_with_token(token_pool, func):
+    if token_pool is None:
+        func()
+        return
+    token = token_pool.acquire()
+    try:
+        func()
+    finally:
+        token_pool.release(token)
+
+
+def _get_interruptibly(queue):
+    # In Python 2, a blocking get() without a timeout cannot be
+    # interrupted by Ctrl-C.
+    while True:
+        try:
+            return queue.get(True, 60)
+        except Queue.Empty:
+            pass
+
+
+# Runs the action, starting independent leaves concurrently when
+# "jobs" is more than 1.  This produces the same log calls as
+# two_stage_run(): sublogs are enrolled up front, in tree order.
+#
+# "durations" records how long each leaf takes, keyed on its dotted
+# path, which starts with "path".  When running leaves concurrently,
+# the durations from previous runs are used to start the longest
+# chain of leaves first.
+#
+# If "token_pool" is given, each leaf holds a token from it while it
+# runs (see jobserver.JobServer), so that the leaves and the
+# processes they start share one limit.
+#
+# "journal" (see StepJournal) records the fingerprints of leaves that
+# succeed.  With "resume", leaves whose fingerprints are unchanged
+# since they last succeeded are skipped, unless a leaf they depend on
+# runs.
+def run_action(action, log, jobs=1, durations=None, path=None,
+               token_pool=None, journal=None, resume=False):
+    if not isinstance(action, ActionTreeNode):
+        _call_with_token(token_pool, lambda: action(log))
+        return
+    if path is None:
+        path = action.__name__
+    tasks = []
+    groups = []
+    _add_tasks(action, log, path, [], [], tasks, groups)
+    if durations is not None and jobs > 1:
+        _set_priorities(tasks, durations)
+    _Executor(tasks, groups, jobs, durations=durations,
+              token_pool=token_pool, journal=journal, resume=resume).run()
+
+
+class StepJournal(object):
+
+    # Stores the fingerprint of each leaf that succeeded, keyed on its
+    # dotted path.  It is saved after every change, so that it is
+    # up to date if the build is interrupted.
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            fh = open(filename, "r")
+            try:
+                self._fingerprints = json.load(fh)
+            finally:
+                fh.close()
+        else:
+            self._fingerprints = {}
+
+    def get(self, path):
+        return self._fingerprints.get(path)
+
+    def record(self, path, fingerprint):
+        self._fingerprints[path] = fingerprint
+        self._save()
+
+    def forget(self, path):
+        if path in self._fingerprints:
+            del self._fingerprints[path]
+            self._save()
+
+    def _save(self):
+        self._lock.acquire()
+        try:
+            temp_file = "%s.tmp" % self._filename
+            fh = open(temp_file, "w")
+            try:
+                json.dump(self._fingerprints, fh, sort_keys=True, indent=0)
+            finally:
+                fh.close()
+            os.rename(temp_file, self._filename)
+        finally:
+            self._lock.release()
+
 
+def flatten_tree(action, name=None):
+    # Returns an iterator of ActionInContexts for each node, in tree
+    # order.  "action" may be a FlatTree.
+    if isinstance(action, FlatTree):
+        return action.iter_contexts()
+    return _flatten_nodes(action, name)
 
-def flatten_tree(action, name=None, path=[]):
+
+def _flatten_nodes(action, name=None):
+    # This walks the tree with an explicit stack of the enclosing
+    # nodes, so that deep trees do not go through a chain of
+    # generators.
     if name is None:
         name = action.__name__
-    path = path + [name]
-    yield ActionInContext(action, name, path)
+    top = ActionInContext(action, name, None)
+    yield top
+    stack = []
     if isinstance(action, ActionTreeNode):
-        for subname, subnode in action.children:
-            for result in flatten_tree(subnode, name=subname, path=path):
-                yield result
+        stack.append((top, iter(action.children)))
+    while len(stack) > 0:
+        parent, children = stack[-1]
+        for subname, subnode in children:
+            act = ActionInContext(subnode, subname, parent)
+            yield act
+            if isinstance(subnode, ActionTreeNode):
+                stack.append((act, iter(subnode.children)))
+            break
+        else:
+            stack.pop()
 
 
 def print_tree(action, stream):
+    if isinstance(action, FlatTree):
+        action.print_tree(stream)
+        return
     for index, act in enumerate(flatten_tree(action)):
         stream.write("%s%i: %s\n" % ("  " * act.get_level(), index, act.name))
 
@@ -119,27 +607,291 @@ def get_one(lst):
 
 
 def filter_tree(action, label):
-    if isinstance(action, ActionTreeNode):
-        got = []
-        for subname, subnode in action.children:
-            if subname == label:
-                got.append((subname, subnode))
-            else:
-                new_node = filter_tree(subnode, label)
-                if new_node is not None:
-                    got.append((subname, new_node))
-        if len(got) > 0:
-            return ActionTreeNode(got, action.__name__)
-    return None
+    # Keeps the subtrees named "label", and the nodes above them.
+    # Returns None if there are none.
+    if isinstance(action, FlatTree):
+        return action.filter(label)
+    return get_query([label]).apply(action)
 
 
 def negative_filter_tree(action, label):
+    # Removes the subtrees named "label".
+    if isinstance(action, FlatTree):
+        return make_flat_tree(negative_filter_tree(action.get_action(), label))
+    return get_query(["-" + label]).apply(action)
+
+
+def is_pattern(label):
+    return any(char in label for char in "*?[")
+
+
+class TreeQuery(object):
+
+    # Selects part of a tree in one pass.  "include_groups" is a list
+    # of lists of labels: a node is kept if, for every group, it or a
+    # node above it (other than the top node) has a name matching one
+    # of the group's labels, or if something below it is kept.  This
+    # is the same as filtering by each group in turn.  Nodes matching
+    # one of the "excludes" labels are removed, along with everything
+    # below them.  Labels may be glob patterns.
+    #
+    # Subtrees that are unchanged are shared with the original tree
+    # rather than copied, and results are memoized per node, so
+    # applying the query again to the same tree is cheap.  This relies
+    # on nodes not being changed once they are made.
+
+    def __init__(self, include_groups, excludes):
+        self._groups = [(set(label for label in group if not is_pattern(label)),
+                         [label for label in group if is_pattern(label)])
+                        for group in include_groups]
+        self._excludes = (set(label for label in excludes
+                              if not is_pattern(label)),
+                          [label for label in excludes if is_pattern(label)])
+        self._all_mask = (1 << len(include_groups)) - 1
+        # Maps a name to (bitmask of groups it matches, is excluded).
+        self._name_cache = {}
+        # Maps (node, mask) to the result for the node when the groups
+        # in "mask" are already matched above it.
+        self._memo = {}
+
+    def _matches(self, labels, patterns, name):
+        return name in labels or any(fnmatch.fnmatchcase(name, pattern)
+                                     for pattern in patterns)
+
+    def _check_name(self, name):
+        if name not in self._name_cache:
+            mask = 0
+            for index, (labels, patterns) in enumerate(self._groups):
+                if self._matches(labels, patterns, name):
+                    mask |= 1 << index
+            self._name_cache[name] = (mask, self._matches(
+                    self._excludes[0], self._excludes[1], name))
+        return self._name_cache[name]
+
+    def apply(self, action):
+        # Returns the selected part of the tree, or None if nothing is
+        # selected.  The top node is never removed or renamed, unless
+        # nothing below it is selected.
+        if not isinstance(action, ActionTreeNode):
+            if self._all_mask == 0:
+                return action
+            return None
+        if (action, 0) in self._memo:
+            return self._memo[(action, 0)]
+        # Each frame is [node, mask, name, index of next child, kept
+        # children].  This uses an explicit stack so that deep trees
+        # do not hit the recursion limit.
+        stack = [[action, 0, None, 0, []]]
+        while True:
+            frame = stack[-1]
+            node, mask, name, next_child, kept = frame
+            if next_child < len(node.children):
+                frame[3] += 1
+                subname, subnode = node.children[next_child]
+                name_mask, excluded = self._check_name(subname)
+                if excluded:
+                    continue
+                submask = mask | name_mask
+                if (subnode, submask) in self._memo:
+                    result = self._memo[(subnode, submask)]
+                elif isinstance(subnode, ActionTreeNode):
+                    stack.append([subnode, submask, subname, 0, []])
+                    continue
+                elif submask == self._all_mask:
+                    result = subnode
+                else:
+                    result = None
+                if result is not None:
+                    kept.append((subname, result))
+            else:
+                result = self._make_node(node, mask, kept)
+                self._memo[(node, mask)] = result
+                stack.pop()
+                if len(stack) == 0:
+                    return result
+                if result is not None:
+                    stack[-1][4].append((name, result))
+
+    def _make_node(self, node, mask, kept):
+        if len(kept) == 0 and mask != self._all_mask:
+            return None
+        if (len(kept) == len(node.children) and
+            all(new_node is old_node
+                for (name, new_node), (old_name, old_node)
+                in zip(kept, node.children))):
+            return node
+        return ActionTreeNode(kept, node.__name__,
+                              dependencies=node.dependencies)
+
+
+def parse_filters(filters):
+    # Each filter is a comma-separated list of labels to keep, or to
+    # remove if it starts with "-".
+    include_groups = []
+    excludes = []
+    for filter_name in filters:
+        if filter_name.startswith("-"):
+            excludes.extend(filter_name[1:].split(","))
+        else:
+            include_groups.append(filter_name.split(","))
+    return TreeQuery(include_groups, excludes)
+
+
+_queries = {}
+_queries_lock = threading.Lock()
+_max_queries = 64
+
+
+def get_query(filters):
+    # Returns a TreeQuery for the filters, reusing one made earlier so
+    # that its memoized results are reused too.
+    key = tuple(filters)
+    _queries_lock.acquire()
+    try:
+        if key not in _queries:
+            if len(_queries) >= _max_queries:
+                _queries.clear()
+            _queries[key] = parse_filters(filters)
+        return _queries[key]
+    finally:
+        _queries_lock.release()
+
+
+class FlatTree(object):
+
+    # A tree held as parallel arrays of its nodes in tree order, which
+    # takes less memory than nested objects and can be walked without
+    # recursion.  "levels" gives each node's depth and "ends" gives the
+    # index after the last node below it, so node i's first child is
+    # at i + 1 and each child is followed by its next sibling at
+    # ends[child].  "names" gives the name each node has in its parent
+    # and "actions" the node itself.  flatten_tree(), print_tree() and
+    # filter_tree() accept a FlatTree in place of a node.
+
+    __slots__ = ("names", "actions", "levels", "ends")
+
+    def __init__(self, names, actions, levels, ends):
+        self.names = names
+        self.actions = actions
+        self.levels = levels
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_action(self):
+        return self.actions[0]
+
+    def get_children(self, index):
+        child = index + 1
+        while child < self.ends[index]:
+            yield child
+            child = self.ends[child]
+
+    def iter_contexts(self):
+        # The enclosing nodes' contexts, indexed by level.
+        stack = []
+        for index in xrange(len(self.names)):
+            level = self.levels[index]
+            del stack[level:]
+            if level == 0:
+                parent = None
+            else:
+                parent = stack[-1]
+            act = ActionInContext(self.actions[index], self.names[index],
+                                  parent)
+            stack.append(act)
+            yield act
+
+    def print_tree(self, stream):
+        for index in xrange(len(self.names)):
+            stream.write("%s%i: %s\n" % ("  " * self.levels[index], index,
+                                         self.names[index]))
+
+    def filter(self, label):
+        # Equivalent to filter_tree() on the node: keeps the subtrees
+        # whose names match "label", and the nodes above them.
+        # Returns None if nothing matches.
+        count = len(self.names)
+        keep = bytearray(count)
+        ancestors = []
+        index = 1
+        while index < count:
+            level = self.levels[index]
+            del ancestors[level - 1:]
+            if self.names[index] == label:
+                for ancestor in reversed(ancestors):
+                    if keep[ancestor]:
+                        break
+                    keep[ancestor] = 1
+                keep[0] = 1
+                for below in xrange(index, self.ends[index]):
+                    keep[below] = 1
+                index = self.ends[index]
+            else:
+                ancestors.append(index)
+                index += 1
+        if not keep[0]:
+            return None
+        # new_index[i] is the number of nodes kept before node i.
+        new_index = array.array("i", [0] * (count + 1))
+        for index in xrange(count):
+            new_index[index + 1] = new_index[index] + keep[index]
+        kept = [index for index in xrange(count) if keep[index]]
+        tree = FlatTree([self.names[index] for index in kept],
+                        [self.actions[index] for index in kept],
+                        array.array("i", [self.levels[index]
+                                          for index in kept]),
+                        array.array("i", [new_index[self.ends[index]]
+                                          for index in kept]))
+        tree._rebuild_nodes()
+        return tree
+
+    def _rebuild_nodes(self):
+        # Replaces the interior nodes that have lost children, and
+        # those above them, with nodes that have only the children
+        # that are left.  Other nodes are shared with the original
+        # tree.
+        for index in reversed(xrange(len(self.names))):
+            action = self.actions[index]
+            if not isinstance(action, ActionTreeNode):
+                continue
+            children = [(self.names[child], self.actions[child])
+                        for child in self.get_children(index)]
+            if (len(children) != len(action.children) or
+                any(new_node is not old_node
+                    for (name, new_node), (old_name, old_node)
+                    in zip(children, action.children))):
+                self.actions[index] = ActionTreeNode(
+                    children, action.__name__,
+                    dependencies=action.dependencies)
+
+
+def make_flat_tree(action, name=None):
+    if name is None:
+        name = action.__name__
+    names = [intern_name(name)]
+    actions = [action]
+    levels = array.array("i", [0])
+    ends = array.array("i", [1])
+    stack = []
     if isinstance(action, ActionTreeNode):
-        return ActionTreeNode(
-            [(subname, negative_filter_tree(subnode, label))
-             for subname, subnode in action.children
-             if subname != label], "top")
-    return action
+        stack.append((0, iter(action.children)))
+    while len(stack) > 0:
+        parent, children = stack[-1]
+        for subname, subnode in children:
+            index = len(names)
+            names.append(subname)
+            actions.append(subnode)
+            levels.append(levels[parent] + 1)
+            ends.append(index + 1)
+            if isinstance(subnode, ActionTreeNode):
+                stack.append((index, iter(subnode.children)))
+            break
+        else:
+            stack.pop()
+            ends[parent] = len(names)
+    return FlatTree(names, actions, levels, ends)
 
 
 # Originally from build_log.py.
@@ -155,31 +907,135 @@ class DummyLogWriter(object):
         pass
 
 
-def action_main(action, args, stdout=sys.stdout,
-                log=DummyLogWriter()):
+class NameIndex(object):
+
+    # Looks up nodes by index, or by a dotted suffix of their path
+    # ("foo", "subtree1.foo", etc.).  Rather than storing every
+    # suffix, which takes quadratic space in deep trees, nodes are
+    # indexed by the last component of their name, and a suffix is
+    # checked against each candidate's parents.
+
+    def __init__(self, flattened):
+        self.flattened = flattened
+        self._by_last_name = {}
+        for index, act in enumerate(flattened):
+            act.index = index
+            self._by_last_name.setdefault(act.name.rsplit(".", 1)[-1],
+                                          []).append(act)
+
+    def _matches(self, act, dotted_name):
+        end = len(dotted_name)
+        while act is not None:
+            start = end - len(act.name)
+            if start < 0 or not dotted_name.startswith(act.name, start, end):
+                return False
+            if start == 0:
+                return True
+            if dotted_name[start - 1] != ".":
+                return False
+            end = start - 1
+            act = act.parent
+        return False
+
+    def get(self, name):
+        # Returns the list of nodes that "name" refers to.
+        found = [act for act in self._by_last_name.get(name.rsplit(".", 1)[-1],
+                                                       ())
+                 if self._matches(act, name)]
+        if (name.isdigit() and str(int(name)) == name and
+            int(name) < len(self.flattened)):
+            found.append(self.flattened[int(name)])
+        return found
+
+    def __getitem__(self, name):
+        found = self.get(name)
+        if len(found) == 0:
+            raise KeyError(name)
+        return found
+
+
+def make_name_index(flattened):
+    return NameIndex(flattened)
+
+
+_name_indexes = {}
+_name_indexes_lock = threading.Lock()
+_max_name_indexes = 16
+
+
+def get_name_index(action):
+    # Returns a NameIndex for the tree, reusing the one made last time
+    # for the same tree.  Together with get_query(), this makes
+    # repeated calls to run_with_options() on one tree cheap (see
+    # build_daemon.py).  Trees must not be changed once they are made.
+    _name_indexes_lock.acquire()
+    try:
+        if action not in _name_indexes:
+            if len(_name_indexes) >= _max_name_indexes:
+                _name_indexes.clear()
+            _name_indexes[action] = make_name_index(list(flatten_tree(action)))
+        return _name_indexes[action]
+    finally:
+        _name_indexes_lock.release()
+
+
+def make_option_parser():
     parser = optparse.OptionParser()
     parser.add_option("-f", "--filter", dest="filters", default=[],
-                      action="append", help="Filter to a subset of the tree")
+                      action="append",
+                      help="Filter to the subtrees with the given names "
+                      "(comma-separated, glob patterns allowed), or remove "
+                      "them with -NAME")
     parser.add_option("-t", "--start-at", dest="start_at", default=[],
                       action="append", help="Start at the given action")
-    options, args = parser.parse_args(args)
-    for filter_name in options.filters:
-        if filter_name.startswith("-"):
-            action = negative_filter_tree(action, filter_name[1:])
-        else:
-            action = filter_tree(action, filter_name)
-    if len(args) == 0 and len(options.start_at) == 0:
+    parser.add_option("-j", "--jobs", dest="jobs", default=None, type="int",
+                      help="Number of independent actions to run at once")
+    parser.add_option("--resume", dest="resume", default=False,
+                      action="store_true",
+                      help="Skip actions whose inputs are unchanged since "
+                      "they last succeeded (runs the whole tree if no "
+                      "action is given)")
+    return parser
+
+
+# This is split out from action_main() so that callers can look at
+# the options before constructing the tree.
+def run_with_options(action, options, args, stdout=sys.stdout,
+                     log=DummyLogWriter(), durations=None, token_pool=None,
+                     journal=None):
+    if len(options.filters) > 0:
+        if isinstance(action, FlatTree):
+            action = action.get_action()
+        action = get_query(options.filters).apply(action)
+        if action is None:
+            raise Exception("Nothing in the tree matches the filters: %s"
+                            % " ".join(options.filters))
+    if len(args) == 0 and len(options.start_at) == 0 and not options.resume:
         print_tree(action, stdout)
+    elif len(args) == 0 and len(options.start_at) == 0:
+        if isinstance(action, FlatTree):
+            action = action.get_action()
+        run_action(action, log, jobs=options.jobs or 1, durations=durations,
+                   token_pool=token_pool, journal=journal, resume=True)
     else:
-        flattened = list(flatten_tree(action))
-        by_index = {}
-        for index, act in enumerate(flattened):
-            act.index = index
-            for name in list(act.get_names()) + [str(index)]:
-                by_index.setdefault(name, []).append(act)
+        by_index = get_name_index(action)
+        flattened = by_index.flattened
         for arg in args:
-            get_one(by_index[arg]).action(log)
+            act = get_one(by_index[arg])
+            run_action(act.action, log, jobs=options.jobs or 1,
+                       durations=durations, path=".".join(act.path),
+                       token_pool=token_pool, journal=journal,
+                       resume=options.resume)
         for arg in options.start_at:
             start_action = get_one(by_index[arg])
             for act in flattened[start_action.index:]:
                 act.run_leaf(log)
+
+
+def action_main(action, args, stdout=sys.stdout,
+                log=DummyLogWriter(), durations=None, token_pool=None,
+                journal=None):
+    options, args = make_option_parser().parse_args(args)
+    run_with_options(action, options, args, stdout=stdout, log=log,
+                     durations=durations, token_pool=token_pool,
+                     journal=journal)
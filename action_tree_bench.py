@@ -0,0 +1,159 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Times the action_tree operations on generated trees, and writes the
+# results as JSON so that runs can be compared:
+#
+#   action_tree_bench.py -o before.json
+#   action_tree_bench.py -o after.json --max-nodes 1000000
+
+import json
+import optparse
+import sys
+import time
+
+import action_tree
+
+
+class NullStream(object):
+
+    def write(self, data):
+        pass
+
+
+def make_leaf(cost):
+    # "cost" is the number of loop iterations the leaf spends when run.
+    def leaf(log):
+        for index in xrange(cost):
+            pass
+    return leaf
+
+
+def make_tree(depth, fanout, leaf_cost=0, name="all"):
+    # Makes a tree with "fanout" children per interior node and leaves
+    # at the given depth.  Names repeat between subtrees, as they do
+    # between modules in build.py.
+    if depth == 0:
+        return make_leaf(leaf_cost)
+    return action_tree.make_node(
+        [("node%i" % index, make_tree(depth - 1, fanout, leaf_cost,
+                                      "node%i" % index))
+         for index in range(fanout)], name)
+
+
+def count_nodes(depth, fanout):
+    return sum(fanout ** level for level in range(depth + 1))
+
+
+# (depth, fanout) pairs, from wide and shallow to narrow and deep.
+# Depth is limited by Python's recursion limit, since some of the tree
+# operations are recursive.
+shapes = [(1, 1000), (3, 10), (2, 100), (4, 10), (2, 300), (5, 10),
+          (10, 3), (16, 2), (6, 10), (19, 2), (100, 1), (500, 1)]
+
+
+def get_operations(tree, depth, jobs=4):
+    # Each operation is a function that does the work once.  The
+    # run_action timings show the scheduler's overhead, serially and
+    # with "jobs" steps run in parallel.
+    label = "node0"
+    leaf_name = ".".join(["all"] + ["node0"] * depth)
+    def flatten():
+        list(action_tree.flatten_tree(tree))
+    def name_index():
+        by_index = action_tree.make_name_index(
+            list(action_tree.flatten_tree(tree)))
+        action_tree.get_one(by_index[leaf_name])
+    def two_stage_run():
+        tree.two_stage_run(action_tree.DummyLogWriter())()
+    def run_action(jobs):
+        return lambda: action_tree.run_action(
+            tree, action_tree.DummyLogWriter(), jobs=jobs)
+    flat = action_tree.make_flat_tree(tree)
+    return [("flatten_tree", flatten),
+            ("filter_tree", lambda: action_tree.filter_tree(tree, label)),
+            ("negative_filter_tree",
+             lambda: action_tree.negative_filter_tree(tree, label)),
+            # filter_tree() reuses memoized results after the first
+            # run, so this times a query made afresh each time.
+            ("query_cold", lambda: action_tree.parse_filters(
+                    ["%s,node1" % label, "-node2"]).apply(tree)),
+            ("name_index", name_index),
+            ("print_tree", lambda: action_tree.print_tree(tree, NullStream())),
+            ("two_stage_run", two_stage_run),
+            ("run_action", run_action(1)),
+            ("run_action_j%i" % jobs, run_action(jobs)),
+            ("make_flat_tree", lambda: action_tree.make_flat_tree(tree)),
+            ("flat_flatten_tree",
+             lambda: list(action_tree.flatten_tree(flat))),
+            ("flat_filter_tree", lambda: action_tree.filter_tree(flat, label)),
+            ("flat_print_tree",
+             lambda: action_tree.print_tree(flat, NullStream()))]
+
+
+def time_operation(func, repeat):
+    # Returns the best of "repeat" runs, which is the least affected
+    # by whatever else the machine is doing.
+    times = []
+    for index in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def run_benchmarks(shapes, repeat=3, leaf_cost=0, max_nodes=None, jobs=4,
+                   progress=None):
+    results = []
+    for depth, fanout in shapes:
+        nodes = count_nodes(depth, fanout)
+        if max_nodes is not None and nodes > max_nodes:
+            continue
+        start = time.time()
+        tree = make_tree(depth, fanout, leaf_cost)
+        build_time = time.time() - start
+        results.append({"depth": depth, "fanout": fanout, "nodes": nodes,
+                        "leaf_cost": leaf_cost, "operation": "make_tree",
+                        "seconds": build_time})
+        for name, func in get_operations(tree, depth, jobs):
+            results.append({"depth": depth, "fanout": fanout,
+                            "nodes": nodes, "leaf_cost": leaf_cost,
+                            "operation": name,
+                            "seconds": time_operation(func, repeat)})
+            if progress is not None:
+                progress.write("%8i nodes  depth %3i  fanout %4i  %-20s %.4fs\n"
+                               % (nodes, depth, fanout, name,
+                                  results[-1]["seconds"]))
+    return results
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Write the results as JSON to this file")
+    parser.add_option("--repeat", dest="repeat", default=3, type="int",
+                      help="Number of times to time each operation")
+    parser.add_option("--leaf-cost", dest="leaf_cost", default=0, type="int",
+                      help="Loop iterations each leaf spends when run")
+    parser.add_option("-j", "--jobs", dest="jobs", default=4, type="int",
+                      help="Number of jobs for the parallel run_action "
+                      "timing")
+    parser.add_option("--max-nodes", dest="max_nodes", default=100000,
+                      type="int", help="Skip trees with more nodes than this")
+    options, args = parser.parse_args(args)
+    all_shapes = shapes + [(3, 100), (4, 32), (20, 2)]
+    results = run_benchmarks(all_shapes, repeat=options.repeat,
+                             leaf_cost=options.leaf_cost,
+                             max_nodes=options.max_nodes, jobs=options.jobs,
+                             progress=sys.stderr)
+    if options.output is not None:
+        fh = open(options.output, "w")
+        try:
+            json.dump(results, fh, sort_keys=True, indent=2)
+        finally:
+            fh.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
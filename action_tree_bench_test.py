@@ -0,0 +1,36 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import unittest
+
+import action_tree
+import action_tree_bench
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_tree_shape(self):
+        tree = action_tree_bench.make_tree(3, 2)
+        self.assertEquals(len(list(action_tree.flatten_tree(tree))),
+                          action_tree_bench.count_nodes(3, 2))
+
+    def test_run_benchmarks(self):
+        results = action_tree_bench.run_benchmarks(
+            [(2, 3), (3, 2), (8, 1), (20, 2)], repeat=1, leaf_cost=10,
+            max_nodes=100, jobs=2)
+        self.assertEquals(
+            sorted(set((result["depth"], result["nodes"])
+                       for result in results)),
+            [(2, 13), (3, 15), (8, 9)])
+        self.assertEquals(
+            [result["operation"] for result in results
+             if result["depth"] == 2],
+            ["make_tree", "flatten_tree", "filter_tree",
+             "negative_filter_tree", "query_cold", "name_index", "print_tree",
+             "two_stage_run", "run_action", "run_action_j2", "make_flat_tree",
+             "flat_flatten_tree", "flat_filter_tree", "flat_print_tree"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,7 +16,13 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import fnmatch
+import os
+import shutil
 import StringIO
+import tempfile
+import threading
+import time
 import unittest
 
 import action_tree
@@ -77,6 +83,94 @@ class TreeWithFailure(object):
         return [self.failer, self.subtree]
 
 
+class TreeWithDependencies(object):
+
+    # "left" and "right" each wait for the other to have started, so
+    # they only complete if they are run concurrently.
+
+    def __init__(self):
+        self.got = []
+        self._left_started = threading.Event()
+        self._right_started = threading.Event()
+
+    def setup(self, log):
+        self.got.append("setup")
+
+    def left(self, log):
+        self._left_started.set()
+        self._right_started.wait(10)
+        assert self._right_started.isSet()
+        self.got.append("left")
+
+    def right(self, log):
+        self._right_started.set()
+        self._left_started.wait(10)
+        assert self._left_started.isSet()
+        self.got.append("right")
+
+    def join(self, log):
+        self.got.append("join")
+
+    @action_tree.action_node
+    def left_tree(self):
+        return [self.left]
+
+    @property
+    def all_steps(self):
+        return action_tree.make_node(
+            [self.setup, self.left_tree, self.right, self.join],
+            name="all_steps",
+            dependencies={"left_tree": ["setup"],
+                          "right": ["setup"],
+                          "join": ["left_tree", "right"]})
+
+
+class FakeDurations(object):
+
+    def __init__(self, durations):
+        self.durations = durations
+        self.saved = False
+
+    def get(self, path):
+        return self.durations.get(path, 0)
+
+    def record(self, path, duration):
+        self.durations[path] = duration
+
+    def save(self):
+        self.saved = True
+
+
+class SemaphorePool(object):
+
+    def __init__(self, size):
+        self._semaphore = threading.Semaphore(size)
+
+    def acquire(self):
+        self._semaphore.acquire()
+        return "token"
+
+    def release(self, token):
+        assert token == "token"
+        self._semaphore.release()
+
+
+class StartOrderLog(object):
+
+    def __init__(self, started, name="top"):
+        self._started = started
+        self._name = name
+
+    def start(self):
+        self._started.append(self._name)
+
+    def child_log(self, name, do_start=True):
+        return StartOrderLog(self._started, name)
+
+    def finish(self, result):
+        pass
+
+
 class SimpleLog(object):
 
     def __init__(self, name="top"):
@@ -120,6 +214,31 @@ def iostring(func):
     return stream.getvalue()
 
 
+# Straightforward recursive filters, to check TreeQuery against.
+def reference_filter(action, labels):
+    if isinstance(action, action_tree.ActionTreeNode):
+        got = []
+        for subname, subnode in action.children:
+            if any(fnmatch.fnmatchcase(subname, label) for label in labels):
+                got.append((subname, subnode))
+            else:
+                new_node = reference_filter(subnode, labels)
+                if new_node is not None:
+                    got.append((subname, new_node))
+        if len(got) > 0:
+            return action_tree.ActionTreeNode(got, action.__name__)
+    return None
+
+
+def reference_negative_filter(action, label):
+    if isinstance(action, action_tree.ActionTreeNode):
+        return action_tree.ActionTreeNode(
+            [(subname, reference_negative_filter(subnode, label))
+             for subname, subnode in action.children
+             if subname != label], action.__name__)
+    return action
+
+
 class ActionTreeTest(unittest.TestCase):
 
     def test_running(self):
@@ -161,6 +280,150 @@ class ActionTreeTest(unittest.TestCase):
         action_tree.action_main(example.all_steps, ["-f", "-bar", "0"])
         self.assertEquals(pop_all(example.got), ["foo", "baz", "qux", "quux"])
 
+    def test_name_index(self):
+        flattened = list(action_tree.flatten_tree(ExampleTree().all_steps))
+        index = action_tree.make_name_index(flattened)
+        for name, expected in [("foo", [2]), ("subtree1.foo", [2]),
+                               ("all_steps.subtree1.foo", [2]), ("6", [6]),
+                               ("subtree2.foo", []), ("tree1.foo", []),
+                               ("all_steps.foo", []), ("06", [])]:
+            self.assertEquals([act.index for act in index.get(name)], expected)
+        self.assertEquals(index["subtree2.qux"][0].path,
+                          ["all_steps", "subtree2", "qux"])
+        self.assertRaises(KeyError, lambda: index["nonexistent"])
+
+    def test_deep_tree(self):
+        # This is deeper than Python's recursion limit.
+        tree = lambda log: None
+        for level in range(5000):
+            tree = action_tree.make_node([("node", tree)], "node")
+        flattened = list(action_tree.flatten_tree(tree))
+        self.assertEquals(len(flattened), 5001)
+        self.assertEquals(flattened[-1].get_level(), 5000)
+        index = action_tree.make_name_index(flattened)
+        self.assertEquals(
+            action_tree.get_one(index[".".join(["node"] * 5001)]).index, 5000)
+
+    def test_flat_tree(self):
+        tree = ExampleTree().all_steps
+        flat = action_tree.make_flat_tree(tree)
+        self.assertEquals(len(flat), 8)
+        self.assertEquals(list(flat.get_children(0)), [1, 5])
+        self.assertEquals(iostring(lambda stream: action_tree.print_tree(
+                    flat, stream)),
+                          iostring(lambda stream: action_tree.print_tree(
+                    tree, stream)))
+        self.assertEquals(
+            [(act.path, act.action) for act in action_tree.flatten_tree(flat)],
+            [(act.path, act.action) for act in action_tree.flatten_tree(tree)])
+        for label in ["foo", "subtree2", "all_steps", "nonexistent"]:
+            filtered = action_tree.filter_tree(flat, label)
+            expected = action_tree.filter_tree(tree, label)
+            if expected is None:
+                self.assertEquals(filtered, None)
+                continue
+            self.assertEquals(
+                iostring(lambda stream: action_tree.print_tree(filtered,
+                                                               stream)),
+                iostring(lambda stream: action_tree.print_tree(expected,
+                                                               stream)))
+            # The filtered tree's nodes have only the children that
+            # are left.
+            self.assertEquals(
+                iostring(lambda stream: action_tree.print_tree(
+                        filtered.get_action(), stream)),
+                iostring(lambda stream: action_tree.print_tree(expected,
+                                                               stream)))
+        # Subtrees that are kept whole are shared.
+        filtered = action_tree.filter_tree(flat, "subtree2")
+        self.assertTrue(filtered.actions[1] is
+                        dict(tree.children)["subtree2"])
+        example = ExampleTree()
+        action_tree.action_main(action_tree.make_flat_tree(example.all_steps),
+                                ["-f", "bar", "subtree1"])
+        self.assertEquals(example.got, ["bar"])
+
+    def test_compact_nodes(self):
+        tree = ExampleTree().all_steps
+        self.assertFalse(hasattr(tree, "__dict__"))
+        act = action_tree.get_one([act for act in
+                                   action_tree.flatten_tree(tree)
+                                   if act.name == "foo"])
+        self.assertFalse(hasattr(act, "__dict__"))
+        self.assertTrue(act.name is intern("foo"))
+
+    def test_queries(self):
+        tree = ExampleTree().all_steps
+        def get_names(filters):
+            result = action_tree.parse_filters(filters).apply(tree)
+            if result is None:
+                return None
+            return [act.name for act in action_tree.flatten_tree(result)]
+        self.assertEquals(get_names(["foo,qux"]),
+                          ["all_steps", "subtree1", "foo", "subtree2", "qux"])
+        self.assertEquals(get_names(["qu*"]),
+                          ["all_steps", "subtree2", "qux", "quux"])
+        self.assertEquals(get_names(["subtree1", "ba?"]),
+                          ["all_steps", "subtree1", "bar", "baz"])
+        self.assertEquals(get_names(["-bar,subtree2"]),
+                          ["all_steps", "subtree1", "foo", "baz"])
+        self.assertEquals(get_names(["subtree*", "-foo", "-q*"]),
+                          ["all_steps", "subtree1", "bar", "baz", "subtree2"])
+        self.assertEquals(get_names(["subtree1", "qux"]), None)
+        # Filters combine as they would if applied one at a time.
+        for filters in [["subtree1", "bar"], ["foo", "-bar"],
+                        ["-subtree1", "qux"], ["subtree2", "all_steps"],
+                        ["subtree*", "foo,qu*"], ["all_steps", "foo"],
+                        ["subtree1", "baz,quux", "-foo"]]:
+            expected = tree
+            for filter_name in filters:
+                if expected is None:
+                    break
+                if filter_name.startswith("-"):
+                    expected = reference_negative_filter(expected,
+                                                         filter_name[1:])
+                else:
+                    expected = reference_filter(expected,
+                                                filter_name.split(","))
+            result = action_tree.parse_filters(filters).apply(tree)
+            if expected is None:
+                self.assertEquals(result, None)
+            else:
+                self.assertEquals(
+                    iostring(lambda stream: action_tree.print_tree(result,
+                                                                   stream)),
+                    iostring(lambda stream: action_tree.print_tree(expected,
+                                                                   stream)))
+        assert_equals(
+            iostring(lambda stream: action_tree.print_tree(
+                    action_tree.parse_filters(["subtree*", "foo,qu*"])
+                    .apply(tree), stream)), """\
+0: all_steps
+  1: subtree1
+    2: foo
+  3: subtree2
+    4: qux
+    5: quux
+""")
+
+    def test_query_sharing(self):
+        tree = ExampleTree().all_steps
+        subtrees = dict(tree.children)
+        # Unchanged subtrees are shared, and so is the whole tree if
+        # nothing is removed.
+        result = action_tree.negative_filter_tree(tree, "foo")
+        self.assertTrue(dict(result.children)["subtree2"] is
+                        subtrees["subtree2"])
+        self.assertTrue(action_tree.negative_filter_tree(tree, "none") is tree)
+        # Names are kept.
+        self.assertEquals(result.__name__, "all_steps")
+        # Results are memoized.
+        query = action_tree.get_query(["subtree1,qux"])
+        self.assertTrue(query is action_tree.get_query(["subtree1,qux"]))
+        self.assertTrue(query.apply(tree) is query.apply(tree))
+        self.assertTrue(dict(query.apply(tree).children)["subtree1"] is
+                        subtrees["subtree1"])
+
     def test_formatting(self):
         tree = ExampleTree().all_steps
         stream = StringIO.StringIO()
@@ -215,6 +478,176 @@ top [None]
     leaf2 [None]
 """)
 
+    def test_parallel_running(self):
+        example = TreeWithDependencies()
+        log = SimpleLog()
+        action_tree.action_main(example.all_steps, ["-j", "2", "0"], log=log)
+        self.assertEquals(example.got[0], "setup")
+        self.assertEquals(sorted(example.got[1:3]), ["left", "right"])
+        self.assertEquals(example.got[3], "join")
+        assert_equals(iostring(log.format), """\
+top [None]
+  setup [0]
+  left_tree [0]
+    left [0]
+  right [0]
+  join [0]
+""")
+
+    def test_parallel_running_sequential_tree(self):
+        example = ExampleTree()
+        action_tree.action_main(example.all_steps, ["-j", "3", "0"])
+        self.assertEquals(example.got, ["foo", "bar", "baz", "qux", "quux"])
+
+    def test_parallel_failure(self):
+        tree = TreeWithFailure().all_steps
+        log = SimpleLog()
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.action_main(tree, ["-j", "2", "0"], log=log))
+        assert_equals(iostring(log.format), """\
+top [None]
+  failer [1]
+  subtree [None]
+    leaf1 [None]
+    leaf2 [None]
+""")
+
+    def test_parallel_failure_stops_started_nodes(self):
+        got = []
+        def fail(log):
+            raise Exception("lose")
+        def leaf(log):
+            got.append("leaf")
+        tree = action_tree.make_node(
+            [action_tree.make_node([("fail", fail), ("after", leaf)],
+                                   name="subtree"),
+             ("other", leaf)],
+            name="all_steps", dependencies={})
+        log = SimpleLog()
+        self.assertRaises(
+            Exception, lambda: action_tree.run_action(tree, log, jobs=1))
+        self.assertEquals(got, [])
+        assert_equals(iostring(log.format), """\
+top [None]
+  subtree [1]
+    fail [1]
+    after [None]
+  other [None]
+""")
+
+    def test_critical_path_ordering(self):
+        def leaf(log):
+            pass
+        tree = action_tree.make_node(
+            [("short1", leaf), ("short2", leaf),
+             action_tree.make_node([("long1", leaf), ("long2", leaf)],
+                                   name="chain")],
+            name="all_steps", dependencies={})
+        durations = FakeDurations({"all_steps.chain.long1": 10,
+                                   "all_steps.chain.long2": 10,
+                                   "all_steps.short1": 1,
+                                   "all_steps.short2": 15})
+        started = []
+        action_tree.action_main(tree, ["-j", "2", "0"],
+                                log=StartOrderLog(started),
+                                durations=durations)
+        # The chain takes 20 in total, so it goes first.
+        self.assertEquals(started[:3], ["chain", "long1", "short2"])
+        self.assertTrue(durations.saved)
+        self.assertTrue(durations.durations["all_steps.short1"] < 1)
+
+        # Without concurrency, the tree order is kept.
+        started = []
+        action_tree.action_main(tree, ["0"], log=StartOrderLog(started),
+                                durations=FakeDurations({}))
+        self.assertEquals(started,
+                          ["short1", "short2", "chain", "long1", "long2"])
+
+    def test_forward_dependency(self):
+        got = []
+        def make_leaf(name):
+            return lambda log: got.append(name)
+        tree = action_tree.make_node(
+            [(name, make_leaf(name)) for name in "abc"], name="top",
+            dependencies={"a": ["b"], "c": ["a"]})
+        for jobs in (1, 2):
+            action_tree.run_action(tree, action_tree.DummyLogWriter(),
+                                   jobs=jobs)
+            self.assertEquals(pop_all(got), ["b", "a", "c"])
+
+    def test_dependency_cycle(self):
+        tree = action_tree.make_node(
+            [("a", lambda log: None), ("b", lambda log: None)], name="top",
+            dependencies={"a": ["b"], "b": ["a"]})
+        try:
+            action_tree.run_action(tree, action_tree.DummyLogWriter(), jobs=2)
+        except Exception, exn:
+            self.assertEquals(str(exn), "Dependency cycle in action tree "
+                              "among the children of 'top': a, b")
+        else:
+            self.fail("Expected an error")
+
+    def test_token_pool_limits_concurrency(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+        def leaf(log):
+            lock.acquire()
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            lock.release()
+            time.sleep(0.01)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+        tree = action_tree.make_node(
+            [("leaf%i" % index, leaf) for index in range(6)],
+            name="all_steps", dependencies={})
+        action_tree.action_main(tree, ["-j", "6", "0"],
+                                token_pool=SemaphorePool(2))
+        self.assertEquals(max_running[0], 2)
+
+    def test_resume(self):
+        temp_dir = tempfile.mkdtemp(prefix="action_tree_test")
+        try:
+            journal_file = os.path.join(temp_dir, "journal.json")
+            got = []
+            inputs = {"a": "1", "b": "1", "c": "1", "d": "1"}
+            failing = set(["c"])
+            def make_leaf(name):
+                def leaf(log):
+                    got.append(name)
+                    if name in failing:
+                        raise Exception("failed")
+                return action_tree.with_fingerprint(
+                    leaf, lambda: inputs[name])
+            # "b" and "c" depend on "a"; "d" depends on "c".
+            tree = action_tree.make_node(
+                [(name, make_leaf(name)) for name in "abcd"], name="top",
+                dependencies={"b": ["a"], "c": ["a"], "d": ["c"]})
+            def run():
+                del got[:]
+                action_tree.action_main(
+                    tree, ["--resume"],
+                    journal=action_tree.StepJournal(journal_file))
+            self.assertRaises(Exception, run)
+            self.assertEquals(sorted(got), ["a", "b", "c"])
+            failing.clear()
+            run()
+            self.assertEquals(got, ["c", "d"])
+            run()
+            self.assertEquals(got, [])
+            # A change invalidates everything that depends on the leaf.
+            inputs["a"] = "2"
+            run()
+            self.assertEquals(got, ["a", "b", "c", "d"])
+            inputs["c"] = "2"
+            run()
+            self.assertEquals(got, ["c", "d"])
+        finally:
+            shutil.rmtree(temp_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -4,13 +4,30 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os
+import Queue
+import re
 import shutil
+import stat
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 
 import action_tree
+import capture
 import cmd_env
+import jobserver
+import timing_log
+import unidiff
 
 
 script_dir = os.path.abspath(os.path.dirname(__file__))
@@ -29,18 +46,175 @@ subdirs = [
 search_path = [os.path.join(nacl_src, subdir) for subdir in subdirs]
 
 
+def version_sort_key(name):
+    # Compares runs of digits numerically, so that "gcc-4.2.10" sorts
+    # after "gcc-4.2.2".
+    return [(int(part), "") if part.isdigit() else (-1, part)
+            for part in re.findall(r"\d+|\D+", name)]
+
+
+class FileIndex(object):
+
+    # Lists each directory in the search path once rather than
+    # checking for each file in turn, which is slow when the search
+    # path is on network storage.  The listings are cached on disk,
+    # keyed on each directory's mtime, which changes whenever entries
+    # are added or removed.  Earlier directories take precedence, as
+    # with a search path.
+
+    def __init__(self, dir_paths, cache_file=None):
+        self._dir_paths = dir_paths
+        self._cache_file = cache_file
+        self._listings = None
+        self._lock = threading.Lock()
+
+    def _read_cache(self):
+        if self._cache_file is None or not os.path.exists(self._cache_file):
+            return {}
+        try:
+            return dict((dir_path.encode("utf-8"),
+                         (mtime, [name.encode("utf-8") for name in names]))
+                        for dir_path, (mtime, names)
+                        in json.loads(read_file(self._cache_file)).iteritems())
+        except ValueError:
+            # Ignore a corrupt cache.
+            return {}
+
+    def _write_cache(self, listings):
+        temp_file = "%s.tmp.%i" % (self._cache_file, os.getpid())
+        try:
+            write_file(temp_file, json.dumps(listings, sort_keys=True))
+            os.rename(temp_file, self._cache_file)
+        except (IOError, OSError):
+            # The cache is only an optimisation; the directory might
+            # not be writable.
+            pass
+
+    def _get_listings(self):
+        self._lock.acquire()
+        try:
+            if self._listings is None:
+                cached = self._read_cache()
+                listings = {}
+                for dir_path in self._dir_paths:
+                    try:
+                        mtime = os.stat(dir_path).st_mtime
+                    except OSError, exn:
+                        if exn.errno != errno.ENOENT:
+                            raise
+                        mtime = None
+                    if dir_path in cached and cached[dir_path][0] == mtime:
+                        listings[dir_path] = cached[dir_path]
+                    elif mtime is None:
+                        listings[dir_path] = (mtime, [])
+                    else:
+                        listings[dir_path] = (
+                            mtime, sorted(os.listdir(dir_path),
+                                          key=version_sort_key))
+                if listings != cached and self._cache_file is not None:
+                    self._write_cache(listings)
+                self._listings = [(dir_path, set(listings[dir_path][1]),
+                                   listings[dir_path][1])
+                                  for dir_path in self._dir_paths]
+            return self._listings
+        finally:
+            self._lock.release()
+
+    def find_file(self, name):
+        for dir_path, names, sorted_names in self._get_listings():
+            if name in names:
+                return os.path.join(dir_path, name)
+        raise Exception("Couldn't find %r in %r" % (name, self._dir_paths))
+
+    def find_files(self, pattern):
+        # Returns the files matching the glob pattern, sorted by
+        # version.
+        found = {}
+        for dir_path, names, sorted_names in self._get_listings():
+            for name in fnmatch.filter(sorted_names, pattern):
+                if name not in found:
+                    found[name] = os.path.join(dir_path, name)
+        return [found[name] for name in sorted(found, key=version_sort_key)]
+
+
+file_index = FileIndex(search_path,
+                       os.path.join(script_dir, ".file_index_cache.json"))
+
+
 def find_file(name):
-    for dir_path in search_path:
-        filename = os.path.join(dir_path, name)
-        if os.path.exists(filename):
-            return filename
-    raise Exception("Couldn't find %r in %r" % (name, search_path))
+    return file_index.find_file(name)
+
+
+def find_files(pattern):
+    return file_index.find_files(pattern)
+
+
+class SourceFile(object):
+
+    # A file in search_path that is looked up when first needed, so
+    # that importing this module and listing or filtering the build
+    # steps do no filesystem work, and a missing file is only an
+    # error for the steps that use it.
+
+    def __init__(self, name):
+        self._name = name
+        self._path = None
+
+    def get_path(self):
+        if self._path is None:
+            self._path = find_file(self._name)
+        return self._path
+
+    def __repr__(self):
+        return "SourceFile(%r)" % self._name
+
+
+class SourceGlob(object):
+
+    # Like SourceFile, for a glob pattern matching one or more files.
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+        self._paths = None
+
+    def get_paths(self):
+        if self._paths is None:
+            paths = find_files(self._pattern)
+            if len(paths) == 0:
+                raise Exception("No files match %r in %r"
+                                % (self._pattern, search_path))
+            self._paths = paths
+        return self._paths
+
+    def __repr__(self):
+        return "SourceGlob(%r)" % self._pattern
+
+
+def get_source_path(filename):
+    # Accepts either a SourceFile or a plain pathname.
+    if isinstance(filename, SourceFile):
+        return filename.get_path()
+    return filename
+
+
+def get_source_paths(filenames):
+    # Accepts either a SourceGlob or a list for get_source_path().
+    if isinstance(filenames, SourceGlob):
+        return filenames.get_paths()
+    return [get_source_path(filename) for filename in filenames]
 
 
 def get_one(lst):
     assert len(lst) == 1, lst
     return lst[0]
 
+def read_file(filename):
+    fh = open(filename, "r")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
 def write_file(filename, data):
     fh = open(filename, "w")
     try:
@@ -52,6 +226,64 @@ def mkdir_p(dir_path):
     subprocess.check_call(["mkdir", "-p", dir_path])
 
 
+# Maps filename to ((size, mtime), digest).
+_file_hashes = {}
+
+def hash_file(filename):
+    stat_info = os.stat(filename)
+    stamp = (stat_info.st_size, stat_info.st_mtime)
+    cached = _file_hashes.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    digest = hashlib.sha1()
+    fh = open(filename, "rb")
+    try:
+        while True:
+            data = fh.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            digest.update(data)
+    finally:
+        fh.close()
+    _file_hashes[filename] = (stamp, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def get_manifest(dir_path):
+    # Maps the path of each entry below dir_path to a list of [kind,
+    # mode, size, digest], where digest is the hash of a file's
+    # contents or a symlink's target.
+    manifest = {}
+    for parent_dir, dirnames, filenames in os.walk(dir_path):
+        for leafname in dirnames + filenames:
+            path = os.path.join(parent_dir, leafname)
+            stat_info = os.lstat(path)
+            mode = stat.S_IMODE(stat_info.st_mode)
+            if stat.S_ISLNK(stat_info.st_mode):
+                entry = ["link", 0, 0, os.readlink(path)]
+            elif stat.S_ISDIR(stat_info.st_mode):
+                entry = ["dir", mode, 0, ""]
+            elif stat.S_ISREG(stat_info.st_mode):
+                entry = ["file", mode, stat_info.st_size, hash_file(path)]
+            else:
+                entry = ["other", stat_info.st_mode, 0, ""]
+            manifest[os.path.relpath(path, dir_path)] = entry
+    return manifest
+
+
+def hash_tree(dir_path):
+    if not os.path.exists(dir_path):
+        return hash_values(["missing"])
+    return hash_values(sorted(get_manifest(dir_path).items()))
+
+
+def hash_values(values):
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update("%r\n" % (value,))
+    return digest.hexdigest()
+
+
 class DirTree(object):
 
     # write_tree(dest_dir) makes a fresh copy of the tree in dest_dir.
@@ -60,28 +292,175 @@ class DirTree(object):
     def write_tree(self, env, dest_dir):
         raise NotImplementedError()
 
+    # get_key() returns a hash of the tree's inputs.
+    def get_key(self):
+        raise NotImplementedError()
+
 
 class EmptyTree(DirTree):
 
     def write_tree(self, env, dest_dir):
         pass
 
+    def get_key(self):
+        return hash_values(["EmptyTree"])
+
+
+def find_program(name):
+    for dir_path in os.environ.get("PATH", "").split(os.pathsep):
+        filename = os.path.join(dir_path, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+# Decompressors that can use several cores, keyed by the magic number
+# of the format they handle.
+parallel_decompressors = [("BZh", "pbzip2"), ("\x1f\x8b", "pigz")]
+
+
+class TarballReader(object):
+
+    # Reads a tarball as a stream.  If a parallel decompressor is
+    # installed we pipe through that, otherwise the tarfile module
+    # decompresses in-process.
+
+    def __init__(self, env, tar_path):
+        self._tar_path = tar_path
+        self._process = None
+        fh = open(tar_path, "rb")
+        try:
+            magic = fh.read(3)
+        finally:
+            fh.close()
+        for prefix, program in parallel_decompressors:
+            if magic.startswith(prefix) and find_program(program) is not None:
+                self._process = env.cmd([program, "-dc", tar_path],
+                                        do_wait=False, stdout=subprocess.PIPE)
+                self.tar_file = tarfile.open(fileobj=self._process.stdout,
+                                             mode="r|")
+                return
+        self.tar_file = tarfile.open(tar_path, mode="r|*")
+
+    def close(self, check=True):
+        self.tar_file.close()
+        if self._process is not None:
+            if not check:
+                # We might not have read to the end.
+                self._process.kill()
+            self._process.stdout.close()
+            rc = self._process.wait()
+            if check and rc != 0:
+                raise cmd_env.CommandFailedError(
+                    "Decompressing %s failed with return code %i"
+                    % (self._tar_path, rc), rc)
+
+
+def strip_top_dir(path, top_names):
+    # Tarballs normally contain a single top-level directory with a
+    # name like foo-module-1.2.3.  Returns the path with this removed,
+    # adding the directory's name to top_names.
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path == ".." or path.startswith("../"):
+        raise Exception("Unsafe path in tarball: %r" % path)
+    top_name, sep, rest = path.partition("/")
+    top_names.add(top_name)
+    if len(top_names) != 1:
+        raise Exception("Expected a single top-level directory, got %r"
+                        % sorted(top_names))
+    return rest
+
+
+def extract_tarballs(env, tar_paths, dest_dir, patch_set=None):
+    # Unpacks the tarballs on top of each other into dest_dir,
+    # stripping their top-level directory as members are extracted,
+    # so that nothing needs renaming afterwards.  Regular files that
+    # patch_set changes are patched as they are extracted.  Returns
+    # the paths that were patched.
+    assert os.listdir(dest_dir) == []
+    assert patch_set is None or len(tar_paths) == 1
+    if patch_set is not None:
+        to_patch = set(patch_set.get_paths())
+    else:
+        to_patch = set()
+    patched = set()
+    patch_failures = []
+    top_names = set()
+    dir_members = {}
+    for tar_path in tar_paths:
+        reader = TarballReader(env, tar_path)
+        try:
+            for member in reader.tar_file:
+                path = strip_top_dir(member.name, top_names)
+                if path == "":
+                    if not member.isdir():
+                        raise Exception("Expected a directory: %r"
+                                        % member.name)
+                    continue
+                member.name = path
+                if member.islnk():
+                    member.linkname = strip_top_dir(member.linkname,
+                                                    top_names)
+                if member.isdir():
+                    # Like extractall(), set the permissions and time
+                    # at the end, in case the directory is read-only.
+                    dir_members[path] = member
+                    member = tarfile.TarInfo(path)
+                    member.type = tarfile.DIRTYPE
+                    member.mode = 0700
+                elif member.isfile() and path in to_patch:
+                    patch_member(reader.tar_file, member, dest_dir,
+                                 patch_set, patch_failures)
+                    patched.add(path)
+                    continue
+                reader.tar_file.extract(member, dest_dir)
+        except:
+            reader.close(check=False)
+            raise
+        reader.close()
+    for path in sorted(dir_members, reverse=True):
+        member = dir_members[path]
+        dir_path = os.path.join(dest_dir, path)
+        os.chmod(dir_path, member.mode)
+        os.utime(dir_path, (member.mtime, member.mtime))
+    if len(patch_failures) > 0:
+        raise unidiff.PatchError(patch_failures)
+    return patched
+
+
+def patch_member(tar_file, member, dest_dir, patch_set, failures):
+    # Like patch(1), this leaves the file with the current time as its
+    # mtime.
+    fh = tar_file.extractfile(member)
+    try:
+        data = fh.read()
+    finally:
+        fh.close()
+    try:
+        data = patch_set.apply_to_data(member.name, data)
+    except unidiff.PatchError, exn:
+        failures.extend(exn.failures)
+    if data is not None:
+        filename = os.path.join(dest_dir, member.name)
+        dir_path = os.path.dirname(filename)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        write_file(filename, data)
+        os.chmod(filename, member.mode)
+
 
 class TarballTree(DirTree):
 
     def __init__(self, tar_path):
         self._tar_path = tar_path
 
-    def write_tree(self, env, dest_dir):
-        # Tarballs normally contain a single top-level directory with
-        # a name like foo-module-1.2.3.  We strip this off.
-        assert os.listdir(dest_dir) == []
-        env.cmd(["tar", "-C", dest_dir, "-xf", self._tar_path])
-        tar_name = get_one(os.listdir(dest_dir))
-        for leafname in os.listdir(os.path.join(dest_dir, tar_name)):
-            os.rename(os.path.join(dest_dir, tar_name, leafname),
-                      os.path.join(dest_dir, leafname))
-        os.rmdir(os.path.join(dest_dir, tar_name))
+    def get_key(self):
+        return hash_values(["TarballTree",
+                            hash_file(get_source_path(self._tar_path))])
+
+    def write_tree(self, env, dest_dir, patch_set=None):
+        return extract_tarballs(env, [get_source_path(self._tar_path)],
+                                dest_dir, patch_set=patch_set)
 
 
 # This handles gcc, where two source tarballs must be unpacked on top
@@ -91,62 +470,295 @@ class MultiTarballTree(DirTree):
     def __init__(self, tar_paths):
         self._tar_paths = tar_paths
 
+    def get_key(self):
+        return hash_values(["MultiTarballTree"] +
+                           [hash_file(get_source_path(tar_path))
+                            for tar_path in self._tar_paths])
+
     def write_tree(self, env, dest_dir):
-        assert os.listdir(dest_dir) == []
-        for tar_file in self._tar_paths:
-            env.cmd(["tar", "-C", dest_dir, "-xf", tar_file])
-        tar_name = get_one(os.listdir(dest_dir))
-        for leafname in os.listdir(os.path.join(dest_dir, tar_name)):
-            os.rename(os.path.join(dest_dir, tar_name, leafname),
-                      os.path.join(dest_dir, leafname))
-        os.rmdir(os.path.join(dest_dir, tar_name))
+        extract_tarballs(env, [get_source_path(tar_path)
+                               for tar_path in self._tar_paths], dest_dir)
 
 
 class PatchedTree(DirTree):
 
-    def __init__(self, orig_tree, patch_file):
-        self._orig_tree = orig_tree
-        self._patch_file = patch_file
-
-    def write_tree(self, env, dest_dir):
-        self._orig_tree.write_tree(env, dest_dir)
-        env.cmd(["patch", "-d", dest_dir, "-p1", "-i", self._patch_file])
+    # patch_files is a list of patches to apply in order, or a
+    # SourceGlob.
 
+    def __init__(self, orig_tree, patch_files):
+        self._orig_tree = orig_tree
+        self._patch_files = patch_files
 
-class EnvVarEnv(object):
-
-    def __init__(self, envvars, env):
-        self._envvars = envvars
-        self._env = env
+    def get_key(self):
+        return hash_values(["PatchedTree", self._orig_tree.get_key()] +
+                           [hash_file(patch_file) for patch_file
+                            in get_source_paths(self._patch_files)])
 
-    def cmd(self, args, **kwargs):
-        return self._env.cmd(
-            ["env"] + ["%s=%s" % (key, value) for key, value in self._envvars]
-            + args, **kwargs)
+    def write_tree(self, env, dest_dir):
+        patch_set = unidiff.read_patches(get_source_paths(self._patch_files))
+        if isinstance(self._orig_tree, TarballTree):
+            # Patch files as they are unpacked, and then apply any
+            # remaining changes, such as new files.
+            patched = self._orig_tree.write_tree(env, dest_dir,
+                                                 patch_set=patch_set)
+            patch_set.apply_to_dir(dest_dir, skip=patched)
+        else:
+            self._orig_tree.write_tree(env, dest_dir)
+            patch_set.apply_to_dir(dest_dir)
+
+
+# These do not affect what gets built.  MAKEFLAGS just passes on the
+# jobserver.
+uncached_env_vars = ["MAKEFLAGS"]
+
+
+class StepCache(object):
+
+    # Records the install tree of each module build, keyed on a hash
+    # of everything that went into the build.
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+
+    def get(self, key):
+        # Returns the recorded install tree, or None.
+        install_dir = os.path.join(self._cache_dir, key)
+        if os.path.exists(install_dir):
+            return install_dir
+        return None
+
+    def put(self, key, install_dir):
+        dest_dir = os.path.join(self._cache_dir, key)
+        temp_dir = "%s.tmp" % dest_dir
+        remove_tree(temp_dir)
+        mkdir_p(self._cache_dir)
+        subprocess.check_call(["cp", "-a", install_dir, temp_dir])
+        remove_tree(dest_dir)
+        os.rename(temp_dir, dest_dir)
+
+
+def link_tree(src_dir, dest_dir, allow_hardlinks=True):
+    # Fills the empty dest_dir with a copy of src_dir, sharing file
+    # data via reflinks, or else hard links, if the filesystem
+    # supports them.  Hard links are only safe if nothing will write
+    # to the copied files in place.
+    methods = [["--reflink=always"]]
+    if allow_hardlinks:
+        methods.append(["-l"])
+    devnull = open(os.devnull, "w")
+    try:
+        for flags in methods:
+            rc = subprocess.call(["cp", "-a"] + flags +
+                                 [os.path.join(src_dir, "."), dest_dir],
+                                 stderr=devnull)
+            if rc == 0:
+                return
+            for leafname in os.listdir(dest_dir):
+                path = os.path.join(dest_dir, leafname)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+    finally:
+        devnull.close()
+    subprocess.check_call(["cp", "-a", os.path.join(src_dir, "."), dest_dir])
+
+
+def get_tree_size(dir_path):
+    size = 0
+    for parent_dir, dirnames, filenames in os.walk(dir_path):
+        for leafname in filenames:
+            size += os.lstat(os.path.join(parent_dir, leafname)).st_size
+    return size
+
+
+class SourceCache(object):
+
+    # A cache of unpacked and patched source trees, keyed on
+    # DirTree.get_key(), which can be shared between workspaces.
+    # Each entry is a directory containing "tree" and "size".  The
+    # entry's mtime records when it was last used, and the least
+    # recently used entries are evicted to keep the total size under
+    # max_size bytes.  Checkouts hold a shared lock on the cache so
+    # that entries are not evicted while being copied.
+
+    def __init__(self, cache_dir, max_size):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+
+    def _lock(self, mode):
+        fh = open(os.path.join(self._cache_dir, "lock"), "a")
+        fcntl.flock(fh.fileno(), mode)
+        return fh
+
+    def checkout(self, env, tree, dest_dir, allow_hardlinks=True):
+        mkdir_p(self._cache_dir)
+        entry_dir = os.path.join(self._cache_dir, tree.get_key())
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            if os.path.exists(entry_dir):
+                os.utime(entry_dir, None)
+                link_tree(os.path.join(entry_dir, "tree"), dest_dir,
+                          allow_hardlinks)
+                return
+        finally:
+            lock.close()
+        self._add(env, tree, entry_dir)
+        self.checkout(env, tree, dest_dir, allow_hardlinks)
+
+    def _add(self, env, tree, entry_dir):
+        temp_dir = tempfile.mkdtemp(dir=self._cache_dir, prefix="tmp-")
+        try:
+            tree_dir = os.path.join(temp_dir, "tree")
+            os.mkdir(tree_dir)
+            tree.write_tree(env, tree_dir)
+            write_file(os.path.join(temp_dir, "size"),
+                       str(get_tree_size(tree_dir)))
+            lock = self._lock(fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(entry_dir):
+                    os.rename(temp_dir, entry_dir)
+                self._evict(keep=entry_dir)
+            finally:
+                lock.close()
+        finally:
+            remove_tree(temp_dir)
+
+    def _evict(self, keep):
+        entries = []
+        for leafname in os.listdir(self._cache_dir):
+            if leafname.startswith("tmp-"):
+                # Another process's entry that is still being written.
+                continue
+            entry_dir = os.path.join(self._cache_dir, leafname)
+            size_file = os.path.join(entry_dir, "size")
+            if os.path.exists(size_file):
+                entries.append((os.stat(entry_dir).st_mtime, entry_dir,
+                                int(read_file(size_file))))
+        total = sum(size for mtime, entry_dir, size in entries)
+        for mtime, entry_dir, size in sorted(entries):
+            if total <= self._max_size:
+                break
+            if entry_dir != keep:
+                # Remove the size file first so that a partly deleted
+                # entry is not treated as valid.
+                os.unlink(os.path.join(entry_dir, "size"))
+                shutil.rmtree(entry_dir)
+                total -= size
 
 
 class ModuleBase(object):
 
-    def __init__(self, source_dir, build_dir, prefix, install_dir, env_vars):
-        self._env = cmd_env.VerboseWrapper(cmd_env.BasicEnv())
+    # Names of the modules that must be installed before this one
+    # can be built.
+    dependencies = []
+    # Modules built from the NaCl tree with scons are not cacheable,
+    # because we do not hash their sources.
+    cacheable = True
+    # Whether the build writes into the source tree, in which case
+    # the source tree must not be hard linked from the source cache.
+    writes_to_source = False
+
+    def __init__(self, source_dir, build_dir, prefix, install_dir, env_vars,
+                 upstream=(), step_cache=None, source_cache=None):
+        # Output goes to the step's capture when there is one.
+        self._env = cmd_env.VerboseWrapper(
+            capture.CaptureEnv(cmd_env.DirectEnv()),
+            stream=capture.current_output)
         self._source_dir = source_dir
         self._build_dir = build_dir
         self._prefix = prefix
         self._install_dir = install_dir
-        self._build_env = cmd_env.PrefixCmdEnv(
-            cmd_env.in_dir(self._build_dir), EnvVarEnv(env_vars, self._env))
+        self._env_vars = env_vars
+        self._upstream = upstream
+        self._step_cache = step_cache
+        self._source_cache = source_cache
+        self._build_env = cmd_env.InDirEnv(
+            self._build_dir, cmd_env.SetEnvironVarsEnv(env_vars, self._env))
+        self._nacl_env = cmd_env.InDirEnv(
+            nacl_dir, cmd_env.SetEnvironVarsEnv(env_vars, self._env))
         self._args = {"prefix": self._prefix,
                       "source_dir": self._source_dir}
 
     def all(self):
         return action_tree.make_node(
-            [self.unpack, self.configure, self.make, self.install], self.name)
+            [("unpack", self._step("unpack",
+                                   self._unless_cached(self.unpack))),
+             ("configure", self._step("configure",
+                                      self._unless_cached(self.configure))),
+             ("make", self._step("make", self._unless_cached(self.make))),
+             ("install", self._step("install", self._install_or_restore))],
+            self.name)
+
+    def get_cache_inputs(self):
+        # By default, the source code of the module class stands in
+        # for the commands that it runs.
+        return [inspect.getsource(type(self))]
+
+    def get_input_key(self):
+        return hash_values(
+            [self.name, self.source.get_key(), sorted(self._args.items()),
+             [(key, value) for key, value in self._env_vars
+              if key not in uncached_env_vars]]
+            + self.get_cache_inputs()
+            + [(mod.name, mod.get_cache_key()) for mod in self._upstream])
+
+    def get_cache_key(self):
+        if not self.cacheable:
+            # Downstream modules depend on what we installed.
+            return hash_tree(self._install_dir)
+        return self.get_input_key()
+
+    def _step(self, name, func):
+        # The fingerprint lets --resume skip the step.  For modules
+        # built from the NaCl tree, it does not cover changes to that
+        # tree.
+        return action_tree.with_fingerprint(
+            capture.with_log_output(func),
+            lambda: hash_values([self.get_input_key(), name]))
+
+    def _get_cached_install(self):
+        # Returns the recorded install tree for the current inputs, or
+        # None if the module needs to be built.
+        if self._step_cache is None or not self.cacheable:
+            return None
+        return self._step_cache.get(self.get_cache_key())
+
+    def _unless_cached(self, step):
+        def run(log):
+            if self._get_cached_install() is None:
+                step(log)
+        return run
+
+    def _install_or_restore(self, log):
+        cached_dir = self._get_cached_install()
+        key_file = "%s.cache_key" % self._install_dir
+        if cached_dir is None:
+            self.install(log)
+            if self._step_cache is not None and self.cacheable:
+                key = self.get_cache_key()
+                self._step_cache.put(key, self._install_dir)
+                write_file(key_file, key)
+        elif not (os.path.exists(self._install_dir) and
+                  os.path.exists(key_file) and
+                  read_file(key_file) == self.get_cache_key()):
+            restore_install(self._prefix, self._install_dir, cached_dir)
+            write_file(key_file, self.get_cache_key())
+        else:
+            # The install dir is up to date, but the prefix might have
+            # been deleted or overwritten since.
+            merge_into_prefix(self._prefix, self._install_dir)
 
     def unpack(self, log):
         if not os.path.exists(self._source_dir):
             temp_dir = "%s.temp" % self._source_dir
             os.makedirs(temp_dir)
-            self.source.write_tree(self._env, temp_dir)
+            if self._source_cache is None:
+                self.source.write_tree(self._env, temp_dir)
+            else:
+                self._source_cache.checkout(
+                    self._env, self.source, temp_dir,
+                    allow_hardlinks=not self.writes_to_source)
             os.rename(temp_dir, self._source_dir)
 
 
@@ -155,39 +767,290 @@ def remove_tree(dir_path):
         shutil.rmtree(dir_path)
 
 
-def copy_onto(source_dir, dest_dir):
-    for leafname in os.listdir(source_dir):
-        subprocess.check_call(["cp", "-a", os.path.join(source_dir, leafname),
-                               "-t", dest_dir])
+# From linux/fs.h.  Makes the destination file share the source
+# file's data on filesystems that support it, such as btrfs.
+FICLONE = 0x40049409
+
+
+def lstat_or_none(path):
+    try:
+        return os.lstat(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def is_same_file(src_stat, dest_stat):
+    # os.utime() only sets mtimes to microsecond precision.
+    return ((src_stat.st_dev, src_stat.st_ino) ==
+            (dest_stat.st_dev, dest_stat.st_ino) or
+            (src_stat.st_mode == dest_stat.st_mode and
+             src_stat.st_size == dest_stat.st_size and
+             abs(src_stat.st_mtime - dest_stat.st_mtime) < 1e-6))
+
+
+def clone_file(src_path, dest_path, src_stat):
+    src_fh = open(src_path, "rb")
+    try:
+        dest_fh = open(dest_path, "wb")
+        try:
+            try:
+                fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+            except IOError:
+                shutil.copyfileobj(src_fh, dest_fh, 1024 * 1024)
+        finally:
+            dest_fh.close()
+    finally:
+        src_fh.close()
+    os.chmod(dest_path, stat.S_IMODE(src_stat.st_mode))
+    os.utime(dest_path, (src_stat.st_atime, src_stat.st_mtime))
+
+
+def replace_path(temp_path, dest_path, dest_stat):
+    if dest_stat is not None and stat.S_ISDIR(dest_stat.st_mode):
+        shutil.rmtree(dest_path)
+    os.rename(temp_path, dest_path)
+
+
+def get_merge_temp_path(dest_path):
+    # Modules that do not depend on each other can be merged into the
+    # same prefix at once, so the name must be unique to the thread.
+    return "%s.merge-tmp.%i.%i" % (dest_path, os.getpid(),
+                                   threading.current_thread().ident)
+
+
+def merge_file(src_path, dest_path, src_stat, use_hardlinks):
+    dest_stat = lstat_or_none(dest_path)
+    if dest_stat is not None and is_same_file(src_stat, dest_stat):
+        return
+    # The new file is created beside the old one and renamed over it,
+    # so the old file is never written in place.  This is what makes
+    # hard linking safe.
+    temp_path = get_merge_temp_path(dest_path)
+    if lstat_or_none(temp_path) is not None:
+        os.unlink(temp_path)
+    if use_hardlinks:
+        try:
+            os.link(src_path, temp_path)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+        else:
+            replace_path(temp_path, dest_path, dest_stat)
+            return
+    clone_file(src_path, temp_path, src_stat)
+    replace_path(temp_path, dest_path, dest_stat)
+
+
+def merge_symlink(src_path, dest_path):
+    target = os.readlink(src_path)
+    dest_stat = lstat_or_none(dest_path)
+    if (dest_stat is not None and stat.S_ISLNK(dest_stat.st_mode) and
+        os.readlink(dest_path) == target):
+        return
+    temp_path = get_merge_temp_path(dest_path)
+    if lstat_or_none(temp_path) is not None:
+        os.unlink(temp_path)
+    os.symlink(target, temp_path)
+    replace_path(temp_path, dest_path, dest_stat)
+
+
+def copy_onto(source_dir, dest_dir, use_hardlinks=True, threads=8,
+              paths=None):
+    # Merges the contents of source_dir into dest_dir, like
+    # "cp -a source_dir/. dest_dir".  This thread walks the tree,
+    # creating directories and symlinks, while a pool of threads
+    # copies the files.  Files that are already present (the same
+    # inode, or the same mode, size and mtime) are skipped, as are
+    # files and symlinks whose relative path is not in "paths", if
+    # it is given.
+    queue = Queue.Queue()
+    errors = []
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if len(errors) == 0:
+                try:
+                    merge_file(*item)
+                except:
+                    errors.append(sys.exc_info())
+    workers = [threading.Thread(target=worker) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    dirs = []
+    try:
+        for parent_dir, dirnames, filenames in os.walk(source_dir):
+            dest_parent = os.path.join(
+                dest_dir, os.path.relpath(parent_dir, source_dir))
+            for leafname in sorted(dirnames + filenames):
+                src_path = os.path.join(parent_dir, leafname)
+                dest_path = os.path.join(dest_parent, leafname)
+                src_stat = os.lstat(src_path)
+                if (paths is not None and
+                    not stat.S_ISDIR(src_stat.st_mode) and
+                    os.path.relpath(src_path, source_dir) not in paths):
+                    continue
+                if stat.S_ISDIR(src_stat.st_mode):
+                    dest_stat = lstat_or_none(dest_path)
+                    if dest_stat is not None and not stat.S_ISDIR(
+                            dest_stat.st_mode):
+                        os.unlink(dest_path)
+                        dest_stat = None
+                    if dest_stat is None:
+                        try:
+                            os.mkdir(dest_path)
+                        except OSError, e:
+                            # Another merge into the same prefix may
+                            # have created it.
+                            if not (e.errno == errno.EEXIST and
+                                    os.path.isdir(dest_path)):
+                                raise
+                    dirs.append((dest_path, src_stat))
+                elif stat.S_ISLNK(src_stat.st_mode):
+                    merge_symlink(src_path, dest_path)
+                elif stat.S_ISREG(src_stat.st_mode):
+                    queue.put((src_path, dest_path, src_stat, use_hardlinks))
+                else:
+                    subprocess.check_call(["cp", "-a", src_path, dest_path])
+            if len(errors) > 0:
+                break
+    finally:
+        for thread in workers:
+            queue.put(None)
+        for thread in workers:
+            thread.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    for dest_path, src_stat in reversed(dirs):
+        os.chmod(dest_path, stat.S_IMODE(src_stat.st_mode))
+        os.utime(dest_path, (src_stat.st_atime, src_stat.st_mtime))
+
+
+def read_manifest(install_dir):
+    manifest_file = "%s.manifest" % install_dir
+    if os.path.exists(manifest_file):
+        # Convert back from JSON's unicode strings to byte strings.
+        return dict((path.encode("utf-8"),
+                     [kind.encode("utf-8"), mode, size, digest.encode("utf-8")])
+                    for path, (kind, mode, size, digest)
+                    in json.loads(read_file(manifest_file)).iteritems())
+    elif os.path.exists(install_dir):
+        return get_manifest(install_dir)
+    else:
+        return {}
+
+
+def write_manifest(install_dir, manifest):
+    manifest_file = "%s.manifest" % install_dir
+    write_file("%s.tmp" % manifest_file, json.dumps(manifest))
+    os.rename("%s.tmp" % manifest_file, manifest_file)
+
+
+def is_unchanged_in_prefix(prefix_path, entry):
+    kind, mode, size, digest = entry
+    if kind == "file":
+        return os.path.isfile(prefix_path) and hash_file(prefix_path) == digest
+    elif kind == "link":
+        return os.path.islink(prefix_path) and os.readlink(prefix_path) == digest
+    return False
+
+
+def is_installed_in_prefix(install_dir, prefix_dir, path, entry):
+    # Whether prefix_dir has install_dir's copy of path: either the
+    # same file, or one with the same contents or link target.  The
+    # latter check catches a copy that another module has overwritten.
+    prefix_path = os.path.join(prefix_dir, path)
+    prefix_stat = lstat_or_none(prefix_path)
+    if prefix_stat is None:
+        return False
+    if (entry[0] == "file" and
+        is_same_file(os.lstat(os.path.join(install_dir, path)), prefix_stat)):
+        return True
+    return is_unchanged_in_prefix(prefix_path, entry)
+
+
+def update_prefix(prefix_dir, install_dir, old_manifest, new_manifest):
+    # Copies the files in install_dir that differ from prefix_dir's
+    # copies, which might have been changed or deleted since, or
+    # overwritten by another module that installs the same path.
+    # Then removes the files that went away since old_manifest, unless
+    # another module has overwritten them.
+    changed = set(path for path, entry in new_manifest.iteritems()
+                  if entry[0] != "dir" and
+                  not is_installed_in_prefix(install_dir, prefix_dir,
+                                             path, entry))
+    copy_onto(install_dir, prefix_dir, paths=changed)
+    removed = [path for path in old_manifest if path not in new_manifest]
+    for path in sorted(removed, reverse=True):
+        prefix_path = os.path.join(prefix_dir, path)
+        if old_manifest[path][0] == "dir":
+            # Other modules might have installed files here too.
+            try:
+                os.rmdir(prefix_path)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTEMPTY,
+                                   errno.ENOTDIR):
+                    raise
+        elif is_unchanged_in_prefix(prefix_path, old_manifest[path]):
+            os.unlink(prefix_path)
+
+
+def replace_install_dir(prefix_dir, install_dir, new_dir):
+    # Moves new_dir into place as install_dir, and updates prefix_dir
+    # with whatever changed compared with the old install_dir.
+    old_manifest = read_manifest(install_dir)
+    remove_tree(install_dir)
+    os.rename(new_dir, install_dir)
+    new_manifest = get_manifest(install_dir)
+    mkdir_p(prefix_dir)
+    update_prefix(prefix_dir, install_dir, old_manifest, new_manifest)
+    write_manifest(install_dir, new_manifest)
 
 
 def install_destdir(prefix_dir, install_dir, func):
     temp_dir = "%s.tmp" % install_dir
     remove_tree(temp_dir)
     func(temp_dir)
-    remove_tree(install_dir)
     # Tree is installed into $DESTDIR/$prefix.
     # We need to strip $prefix.
     assert prefix_dir.startswith("/")
-    os.rename(os.path.join(temp_dir, prefix_dir.lstrip("/")), install_dir)
+    replace_install_dir(prefix_dir, install_dir,
+                        os.path.join(temp_dir, prefix_dir.lstrip("/")))
     # TODO: assert that temp_dir doesn't contain anything except prefix dirs
     remove_tree(temp_dir)
+
+
+def merge_into_prefix(prefix_dir, install_dir):
+    # Puts back whatever in install_dir is missing from prefix_dir or
+    # differs from it, e.g. because the prefix was deleted or another
+    # module has installed the same path since.
+    manifest = read_manifest(install_dir)
     mkdir_p(prefix_dir)
-    copy_onto(install_dir, prefix_dir)
+    update_prefix(prefix_dir, install_dir, manifest, manifest)
+
+
+def restore_install(prefix_dir, install_dir, cached_dir):
+    temp_dir = "%s.tmp" % install_dir
+    remove_tree(temp_dir)
+    subprocess.check_call(["cp", "-a", cached_dir, temp_dir])
+    replace_install_dir(prefix_dir, install_dir, temp_dir)
 
 
-binutils_tree = PatchedTree(TarballTree(find_file("binutils-2.20.tar.bz2")),
-                            find_file("binutils-2.20.patch"))
-# TODO: Need to glob for multiple patch files
+binutils_tree = PatchedTree(TarballTree(SourceFile("binutils-2.20.tar.bz2")),
+                            [SourceFile("binutils-2.20.patch")])
 gcc_tree = PatchedTree(MultiTarballTree(
-                           [find_file("gcc-core-4.2.2.tar.bz2"),
-                            find_file("gcc-g++-4.2.2.tar.bz2")]),
-                       find_file("000-gcc-4.2.2.patch"))
-newlib_tree = PatchedTree(TarballTree(find_file("newlib-1.17.0.tar.gz")),
-                          find_file("newlib-1.17.0.patch"))
+                           [SourceFile("gcc-core-4.2.2.tar.bz2"),
+                            SourceFile("gcc-g++-4.2.2.tar.bz2")]),
+                       SourceGlob("*-gcc-4.2.2*.patch"))
+newlib_tree = PatchedTree(TarballTree(SourceFile("newlib-1.17.0.tar.gz")),
+                          [SourceFile("newlib-1.17.0.patch")])
 
 
-def Module(name, source, configure_cmd, make_cmd, install_cmd):
+def Module(name, source, configure_cmd, make_cmd, install_cmd,
+           dependencies=()):
     # TODO: this nested class is ugly
     class Mod(ModuleBase):
 
@@ -198,6 +1061,10 @@ def Module(name, source, configure_cmd, make_cmd, install_cmd):
         def _subst(self, cmd):
             return [arg % self._args for arg in cmd]
 
+        def get_cache_inputs(self):
+            return [self._subst(configure_cmd), self._subst(make_cmd),
+                    install_cmd]
+
         def configure(self, log):
             mkdir_p(self._build_dir)
             self._build_env.cmd(self._subst(configure_cmd))
@@ -213,6 +1080,7 @@ def Module(name, source, configure_cmd, make_cmd, install_cmd):
 
     Mod.name = name
     Mod.source = source
+    Mod.dependencies = list(dependencies)
     return Mod
 
 
@@ -225,7 +1093,7 @@ ModuleBinutils = Module(
         'CFLAGS="-DNACL_ALIGN_BYTES=32 -DNACL_ALIGN_POW2=5" '
         "--prefix=%(prefix)s "
         "--target=nacl"],
-    make_cmd=["make", "-j4"],
+    make_cmd=["make"],
     install_cmd=["make", "install", "DESTDIR=%(destdir)s"])
 
 
@@ -256,8 +1124,9 @@ ModulePregcc = Module(
         + common_gcc_options],
     # The default make target doesn't work - it gives libiberty
     # configure failures.  Need to do "all-gcc" instead.
-    make_cmd=["make", "all-gcc", "-j2"],
-    install_cmd=["make", "install-gcc", "DESTDIR=%(destdir)s"])
+    make_cmd=["make", "all-gcc"],
+    install_cmd=["make", "install-gcc", "DESTDIR=%(destdir)s"],
+    dependencies=["binutils"])
 
 ModuleFullgcc = Module(
     name="fullgcc",
@@ -275,14 +1144,24 @@ ModuleFullgcc = Module(
         "--disable-libgomp "
         '--enable-languages="c,c++" '
         + common_gcc_options],
-    make_cmd=["make", "all", "-j2"],
-    install_cmd=["make", "install", "DESTDIR=%(destdir)s"])
+    make_cmd=["make", "all"],
+    install_cmd=["make", "install", "DESTDIR=%(destdir)s"],
+    dependencies=["newlib", "nc_threads"])
 
 
 class ModuleNewlib(ModuleBase):
 
     name = "newlib"
     source = newlib_tree
+    dependencies = ["pregcc"]
+    # configure exports headers into the source tree.
+    writes_to_source = True
+
+    def get_cache_inputs(self):
+        # configure copies headers from the NaCl tree.
+        return (ModuleBase.get_cache_inputs(self) +
+                [hash_tree(os.path.join(
+                            nacl_dir, "src/trusted/service_runtime/include"))])
 
     def configure(self, log):
         # This is like exporting the kernel headers to glibc.
@@ -307,7 +1186,7 @@ class ModuleNewlib(ModuleBase):
                 % self._args])
 
     def make(self, log):
-        self._build_env.cmd(["sh", "-c", "make"])
+        self._build_env.cmd(["make"])
 
     def install(self, log):
         install_destdir(
@@ -320,6 +1199,8 @@ class ModuleNcthreads(ModuleBase):
 
     name = "nc_threads"
     source = EmptyTree()
+    cacheable = False
+    dependencies = ["newlib"]
 
     def configure(self, log):
         pass
@@ -330,8 +1211,7 @@ class ModuleNcthreads(ModuleBase):
     def install(self, log):
         mkdir_p(self._build_dir)
         def do_make(dest):
-            self._build_env.cmd(
-                cmd_env.in_dir(nacl_dir) +
+            self._nacl_env.cmd(
                 ["./scons", "MODE=nacl_extra_sdk", "install_libpthread",
                  "USE_PATH=1",
                  "naclsdk_mode=custom:%s" %
@@ -345,6 +1225,7 @@ class ModuleLibnaclHeaders(ModuleBase):
 
     name = "libnacl_headers"
     source = EmptyTree()
+    cacheable = False
 
     def configure(self, log):
         pass
@@ -360,8 +1241,7 @@ class ModuleLibnaclHeaders(ModuleBase):
         # scons-out is already populated, scons won't try to run
         # nacl-gcc.
         def do_make(dest):
-            self._build_env.cmd(
-                cmd_env.in_dir(nacl_dir) +
+            self._nacl_env.cmd(
                 ["./scons", "MODE=nacl_extra_sdk", "extra_sdk_update_header",
                  "USE_PATH=1",
                  "nocpp=yes",
@@ -377,6 +1257,8 @@ class ModuleLibnacl(ModuleBase):
     # Covers libnacl.a, crt[1ni].o and misc libraries built with Scons.
     name = "libnacl"
     source = EmptyTree()
+    cacheable = False
+    dependencies = ["fullgcc", "libnacl_headers"]
 
     def configure(self, log):
         pass
@@ -392,8 +1274,7 @@ class ModuleLibnacl(ModuleBase):
         # scons-out is already populated, scons won't try to run
         # nacl-gcc.
         def do_make(dest):
-            self._build_env.cmd(
-                cmd_env.in_dir(nacl_dir) +
+            self._nacl_env.cmd(
                 ["./scons", "MODE=nacl_extra_sdk", "extra_sdk_update",
                  "USE_PATH=1",
                  "naclsdk_mode=custom:%s" %
@@ -407,6 +1288,8 @@ class TestModule(ModuleBase):
 
     name = "test"
     source = EmptyTree()
+    cacheable = False
+    dependencies = ["libnacl"]
 
     def configure(self, log):
         pass
@@ -420,7 +1303,7 @@ int main() {
   return 0;
 }
 """)
-        self._build_env.cmd(["sh", "-c", "nacl-gcc hellow.c -o hellow"])
+        self._build_env.cmd(["nacl-gcc", "hellow.c", "-o", "hellow"])
 
     def install(self, log):
         pass
@@ -442,10 +1325,24 @@ mods = [
     ]
 
 
-def all_mods(top_dir, use_shared_prefix):
+def get_source_cache():
+    # The source cache is shared by all workspaces of the current user.
+    cache_dir = os.environ.get(
+        "NACL_SOURCE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "nacl-modular-build",
+                     "sources"))
+    return SourceCache(cache_dir, max_size=5 * 1024 * 1024 * 1024)
+
+
+def all_mods(top_dir, use_shared_prefix, use_step_cache=True,
+             source_cache=None, jobserver=None):
     nodes = []
     env_vars = []
     path_dirs = []
+    builders = {}
+    if jobserver is not None:
+        # Every make we run shares the jobserver's limit.
+        env_vars.append(("MAKEFLAGS", jobserver.get_makeflags()))
 
     source_base = os.path.join(top_dir, "source")
     if use_shared_prefix:
@@ -455,6 +1352,10 @@ def all_mods(top_dir, use_shared_prefix):
     else:
         base_dir = os.path.join(top_dir, "split")
         prefix_base = os.path.join(base_dir, "prefixes")
+    if use_step_cache:
+        step_cache = StepCache(os.path.join(base_dir, "step_cache"))
+    else:
+        step_cache = None
 
     for mod in mods:
         if not use_shared_prefix:
@@ -465,18 +1366,72 @@ def all_mods(top_dir, use_shared_prefix):
         source_dir = os.path.join(source_base, mod.name)
         build_dir = os.path.join(base_dir, "build", mod.name)
         install_dir = os.path.join(base_dir, "install", mod.name)
-        builder = mod(source_dir, build_dir, prefix, install_dir, env_vars)
+        builder = mod(source_dir, build_dir, prefix, install_dir, env_vars,
+                      upstream=[builders[name] for name in mod.dependencies],
+                      step_cache=step_cache, source_cache=source_cache)
+        builders[mod.name] = builder
         nodes.append(builder.all())
 
     env_vars.append(("PATH",
                      reduce(add_to_path, path_dirs, os.environ["PATH"])))
-    return action_tree.make_node(nodes, name="all")
+    # With "-j", modules whose dependencies are installed are built
+    # concurrently.
+    dependencies = dict((mod.name, mod.dependencies) for mod in mods)
+    return action_tree.make_node(nodes, name="all", dependencies=dependencies)
+
+
+def get_jobserver(options):
+    # "-j" sets both the number of modules built at once and the
+    # total number of jobs their makes may run.
+    return jobserver.JobServer(options.jobs or multiprocessing.cpu_count())
+
+
+def make_option_parser():
+    parser = action_tree.make_option_parser()
+    parser.add_option("--capture", dest="capture", default=False,
+                      action="store_true",
+                      help="Write each step's output to logs/ rather than "
+                      "the terminal (the default with -j)")
+    return parser
 
 
 def main(args):
     base_dir = os.getcwd()
-    top = all_mods(base_dir, use_shared_prefix=True)
-    action_tree.action_main(top, args)
+    options, args = make_option_parser().parse_args(args)
+    server = get_jobserver(options)
+    top = all_mods(base_dir, use_shared_prefix=True,
+                   source_cache=get_source_cache(), jobserver=server)
+    run_with_timing_log(top, options, args, base_dir, server)
+
+
+def run_with_timing_log(top, options, args, base_dir, server,
+                        stdout=sys.stdout, stderr=sys.stderr):
+    # Summarise the log with "timing_log.py timing.log".
+    # durations.json is used to order concurrent steps.  journal.json
+    # records the steps that succeeded, for --resume.
+    if len(args) == 0 and len(options.start_at) == 0 and not options.resume:
+        # This only lists the steps, so leave the logs alone.
+        action_tree.run_with_options(top, options, args, stdout=stdout)
+        return
+    fh = open(os.path.join(base_dir, "timing.log"), "a")
+    try:
+        log = timing_log.TimingLogWriter(fh)
+        if options.capture or (options.jobs or 1) > 1:
+            # Concurrent steps' output would be interleaved.
+            log = capture.CaptureLogWriter(log, os.path.join(base_dir, "logs"),
+                                           stream=stderr)
+        elif stdout is not sys.stdout:
+            # Commands would otherwise write to our own stdout.
+            log = capture.StreamLogWriter(log, stdout)
+        action_tree.run_with_options(
+            top, options, args, stdout=stdout, log=log,
+            durations=timing_log.DurationDb(
+                os.path.join(base_dir, "durations.json")),
+            token_pool=server,
+            journal=action_tree.StepJournal(
+                os.path.join(base_dir, "journal.json")))
+    finally:
+        fh.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Keeps the build's action tree in a long-lived process, along with
+# the caches that build up as it is used (the file index, file hashes,
+# the mount table, and filtered trees and their name indexes).  This
+# way, running a single step does not mean importing the build modules
+# and constructing the tree again:
+#
+#   build_daemon.py serve -j 8 &
+#   build_daemon.py run all.binutils.make
+#   build_daemon.py stop
+#
+# "run" takes the same arguments as build.py and is run from the same
+# directory as "serve".  If no daemon is listening, it runs build.py
+# itself.  The daemon runs one request at a time.  Interrupting "run"
+# does not stop a step that the daemon has started.
+#
+# The daemon does not notice changes to the build scripts.  Instead,
+# if any of the modules it has loaded have changed since it started,
+# it stops and tells the client to run the request itself.
+#
+# Requests use remote_env's message framing.  The client sends a "C"
+# message with its arguments as JSON.  The daemon replies with "O" and
+# "E" messages for output and an "X" message with the exit code, or
+# an "R" message if the client should run the request itself.
+
+import errno
+import json
+import optparse
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import remote_env
+
+
+socket_name = "build_daemon.sock"
+
+
+def get_socket_path():
+    return os.environ.get("NACL_BUILD_DAEMON_SOCKET",
+                          os.path.join(os.getcwd(), socket_name))
+
+
+def get_source_filename(module):
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        return None
+    if filename.endswith((".pyc", ".pyo")):
+        filename = filename[:-1]
+    return os.path.abspath(filename)
+
+
+def get_module_stamps(dir_path):
+    # Returns the mtimes of the loaded modules' source files that are
+    # in dir_path.
+    stamps = {}
+    for module in sys.modules.values():
+        filename = get_source_filename(module)
+        if (filename is not None and
+            os.path.dirname(filename) == dir_path and
+            os.path.exists(filename)):
+            stamps[filename] = os.stat(filename).st_mtime
+    return stamps
+
+
+class ClientStream(object):
+
+    # A file-like object that sends data to the client as messages of
+    # the given kind.  If the client goes away, its output is
+    # discarded and the request carries on.
+
+    def __init__(self, writer, kind):
+        self._writer = writer
+        self._kind = kind
+        self._closed = False
+
+    def write(self, data):
+        if len(data) > 0 and not self._closed:
+            try:
+                self._writer.write(self._kind, data)
+            except (socket.error, IOError):
+                self._closed = True
+
+    def flush(self):
+        pass
+
+
+def parse_args(parser, args, stdout, stderr):
+    # optparse writes --help and errors to sys.stdout and sys.stderr.
+    # Returns (options, args), or the exit code if it exited.
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        try:
+            return parser.parse_args(args)
+        except SystemExit, exn:
+            return exn.code
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+
+class BuildDaemon(object):
+
+    # "run" is called with (options, args, stdout, stderr) for each
+    # request, where "options" comes from parser.
+
+    def __init__(self, parser, run, scripts_dir=None):
+        self._parser = parser
+        self._run = run
+        self._scripts_dir = scripts_dir
+        if scripts_dir is not None:
+            self._stamps = get_module_stamps(scripts_dir)
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def is_stale(self):
+        return (self._scripts_dir is not None and
+                get_module_stamps(self._scripts_dir) != self._stamps)
+
+    def handle_request(self, args, stdout, stderr):
+        # Returns the exit code.
+        parsed = parse_args(self._parser, args, stdout, stderr)
+        if not isinstance(parsed, tuple):
+            return parsed or 0
+        options, args = parsed
+        try:
+            self._run(options, args, stdout, stderr)
+        except SystemExit, exn:
+            return exn.code or 0
+        except Exception:
+            traceback.print_exc(file=stderr)
+            return 1
+        return 0
+
+    def _handle_connection(self, reader, writer):
+        while True:
+            message = remote_env.read_message(reader)
+            if message is None:
+                break
+            kind, data = message
+            if kind != "C":
+                raise remote_env.RemoteError("Unexpected message kind: %r"
+                                             % kind)
+            request = remote_env.encode_strings(json.loads(data))
+            if request.get("stop"):
+                writer.write("X", "0")
+                self.stop()
+                break
+            self._lock.acquire()
+            try:
+                if self.is_stale():
+                    writer.write("R", "")
+                    self.stop()
+                    break
+                rc = self.handle_request(request["args"],
+                                         ClientStream(writer, "O"),
+                                         ClientStream(writer, "E"))
+            finally:
+                self._lock.release()
+            writer.write("X", str(rc))
+
+    def serve(self, sock):
+        # Handles connections until stop() is called.
+        self._sock = sock
+        while True:
+            try:
+                conn, address = sock.accept()
+            except socket.error:
+                self._sock = None
+                break
+            def handle(conn=conn):
+                reader = conn.makefile("rb")
+                try:
+                    self._handle_connection(
+                        reader, remote_env.MessageWriter(conn.makefile("wb")))
+                except (socket.error, IOError):
+                    # The client went away.
+                    pass
+                finally:
+                    reader.close()
+                    conn.close()
+            thread = threading.Thread(target=handle)
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # The socket has already been shut down or closed.
+                pass
+
+
+def send_request(socket_path, request, stdout=sys.stdout, stderr=sys.stderr):
+    # Returns the exit code, or None if there is no daemon or it asked
+    # us to run the request ourselves.
+    try:
+        connection = remote_env.UnixSocketTransport(socket_path).connect()
+    except socket.error, exn:
+        if exn.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    try:
+        connection.writer.write("C", json.dumps(request))
+        outputs = {"O": stdout, "E": stderr}
+        while True:
+            message = remote_env.read_message(connection.reader)
+            if message is None:
+                raise remote_env.RemoteError(
+                    "Build daemon closed the connection")
+            kind, data = message
+            if kind == "X":
+                return int(data)
+            elif kind == "R":
+                return None
+            outputs[kind].write(data)
+            outputs[kind].flush()
+    finally:
+        connection.close()
+
+
+def is_listening(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, exn:
+        if exn.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return False
+        raise
+    finally:
+        sock.close()
+    return True
+
+
+def listen(socket_path):
+    # Replaces a socket left behind by a daemon that has exited.
+    if os.path.exists(socket_path):
+        if is_listening(socket_path):
+            raise Exception("A build daemon is already listening on %s"
+                            % socket_path)
+        os.unlink(socket_path)
+    return remote_env.listen_unix(socket_path)
+
+
+def make_build_daemon(base_dir, options, use_shared_prefix):
+    # Imported here so that "run" does not have to load the build
+    # modules when there is a daemon.
+    import build
+    server = build.get_jobserver(options)
+    top = build.all_mods(base_dir, use_shared_prefix=use_shared_prefix,
+                         source_cache=build.get_source_cache(),
+                         jobserver=server)
+    def run(options, args, stdout, stderr):
+        build.run_with_timing_log(top, options, args, base_dir, server,
+                                  stdout=stdout, stderr=stderr)
+    return BuildDaemon(build.make_option_parser(), run,
+                       scripts_dir=build.script_dir)
+
+
+def serve(args):
+    parser = optparse.OptionParser(usage="%prog serve [options]")
+    parser.add_option("-j", "--jobs", dest="jobs", default=None, type="int",
+                      help="Total number of jobs for the makes that the "
+                      "daemon runs")
+    parser.add_option("--split-prefix", dest="use_shared_prefix",
+                      default=True, action="store_false",
+                      help="Build as build_splitprefix.py does")
+    options, args = parser.parse_args(args)
+    if len(args) != 0:
+        parser.error("Unexpected arguments: %r" % args)
+    socket_path = get_socket_path()
+    daemon = make_build_daemon(os.getcwd(), options, options.use_shared_prefix)
+    sock = listen(socket_path)
+    try:
+        daemon.serve(sock)
+    finally:
+        sock.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def run(args):
+    rc = send_request(get_socket_path(), {"args": args})
+    if rc is None:
+        import build
+        build.main(args)
+        rc = 0
+    return rc
+
+
+def main(args):
+    usage = "Usage: %s serve [-j N] [--split-prefix] | run ARGS... | stop\n" \
+        % os.path.basename(sys.argv[0])
+    if len(args) == 0:
+        sys.stderr.write(usage)
+        return 2
+    command, args = args[0], args[1:]
+    if command == "serve":
+        serve(args)
+        return 0
+    elif command == "run":
+        return run(args)
+    elif command == "stop":
+        if send_request(get_socket_path(), {"stop": True}) is None:
+            sys.stderr.write("No build daemon is running\n")
+            return 1
+        return 0
+    else:
+        sys.stderr.write(usage)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
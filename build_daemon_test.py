@@ -0,0 +1,116 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+import action_tree
+import build
+import build_daemon
+import capture
+import cmd_env
+
+
+def make_tree(got):
+    env = capture.CaptureEnv(cmd_env.DirectEnv())
+    def step(log):
+        got.append("step")
+        capture.current_output.write("from step\n")
+        env.cmd(["sh", "-c", "echo from command; echo error >&2"])
+    def failing(log):
+        raise Exception("Step failed")
+    return action_tree.make_node(
+        [("mod", action_tree.make_node(
+                    [("step", capture.with_log_output(step)),
+                     ("failing", failing)], "mod"))], "all")
+
+
+class BuildDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix="build_daemon_test")
+        self._socket_path = os.path.join(self._temp_dir, "socket")
+        self.got = []
+        tree = make_tree(self.got)
+        def run(options, args, stdout, stderr):
+            build.run_with_timing_log(tree, options, args, self._temp_dir,
+                                      None, stdout=stdout, stderr=stderr)
+        self._daemon = build_daemon.BuildDaemon(build.make_option_parser(),
+                                                run)
+        self._sock = build_daemon.listen(self._socket_path)
+        self._thread = threading.Thread(target=self._daemon.serve,
+                                        args=(self._sock,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def tearDown(self):
+        self._daemon.stop()
+        self._sock.close()
+        shutil.rmtree(self._temp_dir)
+
+    def request(self, args):
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        rc = build_daemon.send_request(self._socket_path, {"args": args},
+                                       stdout=stdout, stderr=stderr)
+        return rc, stdout.getvalue(), stderr.getvalue()
+
+    def test_requests(self):
+        self.assertEquals(self.request([]),
+                          (0, "0: all\n  1: mod\n    2: step\n"
+                           "    3: failing\n", ""))
+        rc, stdout, stderr = self.request(["mod.step"])
+        self.assertEquals(rc, 0)
+        self.assertEquals(stdout, "from step\nfrom command\nerror\n")
+        self.assertEquals(self.got, ["step"])
+        rc, stdout, stderr = self.request(["-f", "mod", "failing"])
+        self.assertEquals(rc, 1)
+        self.assertTrue(stderr.endswith("Exception: Step failed\n"), stderr)
+        rc, stdout, stderr = self.request(["--no-such-option"])
+        self.assertEquals(rc, 2)
+        self.assertTrue("no such option" in stderr, stderr)
+
+    def test_stop(self):
+        self.assertTrue(build_daemon.is_listening(self._socket_path))
+        self.assertRaises(Exception,
+                          lambda: build_daemon.listen(self._socket_path))
+        self.assertEquals(build_daemon.send_request(self._socket_path,
+                                                    {"stop": True}), 0)
+        self._thread.join()
+        self._sock.close()
+        self.assertFalse(build_daemon.is_listening(self._socket_path))
+        # The socket left behind is replaced.
+        build_daemon.listen(self._socket_path).close()
+        os.unlink(self._socket_path)
+        self.assertEquals(self.request([]), (None, "", ""))
+
+    def test_stale_daemon(self):
+        build.write_file(os.path.join(self._temp_dir, "daemon_test_mod.py"),
+                         "")
+        sys.path.insert(0, self._temp_dir)
+        try:
+            __import__("daemon_test_mod")
+        finally:
+            sys.path.remove(self._temp_dir)
+        self._daemon._scripts_dir = self._temp_dir
+        self._daemon._stamps = build_daemon.get_module_stamps(self._temp_dir)
+        self.assertEquals(self._daemon._stamps.keys(),
+                          [os.path.join(self._temp_dir, "daemon_test_mod.py")])
+        self.assertEquals(self.request([])[0], 0)
+        os.utime(os.path.join(self._temp_dir, "daemon_test_mod.py"),
+                 (0, 0))
+        # The client is told to run the request itself, and the daemon
+        # stops.
+        self.assertEquals(self.request([]), (None, "", ""))
+        self._thread.join()
+        del sys.modules["daemon_test_mod"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,6 @@
 import os
 import sys
 
-import action_tree
 import build
 
 
@@ -17,8 +16,12 @@ import build
 
 def main(args):
     base_dir = os.getcwd()
-    top = build.all_mods(base_dir, use_shared_prefix=False)
-    action_tree.action_main(top, args)
+    options, args = build.make_option_parser().parse_args(args)
+    server = build.get_jobserver(options)
+    top = build.all_mods(base_dir, use_shared_prefix=False,
+                         source_cache=build.get_source_cache(),
+                         jobserver=server)
+    build.run_with_timing_log(top, options, args, base_dir, server)
 
 
 if __name__ == "__main__":
@@ -7,8 +7,10 @@ import os
 import shutil
 import subprocess
 import tempfile
+import threading
 import unittest
 
+import action_tree
 import build
 import cmd_env
 
@@ -66,6 +68,449 @@ class Test(TempDirTestCase):
         tree.write_tree(cmd_env.BasicEnv(), dest_dir)
         self.assertEquals(os.listdir(dest_dir), ["README"])
 
+    def make_tarball(self, temp_dir, tar_file, files, tar_flag,
+                     setup=lambda top_dir: None):
+        top_dir = os.path.join(temp_dir, "foo-1.0")
+        for path, data in files:
+            if not os.path.exists(os.path.dirname(os.path.join(top_dir, path))):
+                os.makedirs(os.path.dirname(os.path.join(top_dir, path)))
+            write_file(os.path.join(top_dir, path), data)
+        setup(top_dir)
+        subprocess.check_call(["tar", tar_flag, "-cf", tar_file, "foo-1.0"],
+                              cwd=temp_dir)
+        subprocess.check_call(["chmod", "-R", "u+w", top_dir])
+        shutil.rmtree(top_dir)
+
+    def check_untar_overlay(self):
+        temp_dir = self.make_temp_dir()
+        core_tar = os.path.join(temp_dir, "core.tar.bz2")
+        self.make_tarball(temp_dir, core_tar,
+                          [("README", "core"), ("gcc/c.c", "c")], "-j")
+        # Includes a hard link, a symlink and a read-only directory.
+        def setup(top_dir):
+            os.link(os.path.join(top_dir, "readonly", "file"),
+                    os.path.join(top_dir, "link"))
+            os.symlink("readonly/file", os.path.join(top_dir, "sym"))
+            os.chmod(os.path.join(top_dir, "readonly"), 0555)
+        gxx_tar = os.path.join(temp_dir, "gxx.tar.gz")
+        self.make_tarball(temp_dir, gxx_tar,
+                          [("gcc/cp/cp.c", "c++"), ("readonly/file", "")],
+                          "-z", setup)
+
+        dest_dir = self.make_temp_dir()
+        tree = build.MultiTarballTree([core_tar, gxx_tar])
+        tree.write_tree(cmd_env.BasicEnv(), dest_dir)
+        self.assertEquals(sorted(os.listdir(dest_dir)),
+                          ["README", "gcc", "link", "readonly", "sym"])
+        self.assertEquals(sorted(os.listdir(os.path.join(dest_dir, "gcc"))),
+                          ["c.c", "cp"])
+        self.assertEquals(read_file(os.path.join(dest_dir, "gcc/cp/cp.c")),
+                          "c++")
+        self.assertEquals(os.readlink(os.path.join(dest_dir, "sym")),
+                          "readonly/file")
+        self.assertEquals(
+            os.stat(os.path.join(dest_dir, "link")).st_ino,
+            os.stat(os.path.join(dest_dir, "readonly", "file")).st_ino)
+        self.assertEquals(
+            os.stat(os.path.join(dest_dir, "readonly")).st_mode & 0777, 0555)
+        os.chmod(os.path.join(dest_dir, "readonly"), 0755)
+
+    def test_untar_overlay(self):
+        self.check_untar_overlay()
+
+    def test_untar_overlay_with_decompressor(self):
+        decompressors = build.parallel_decompressors
+        build.parallel_decompressors = [("BZh", "bzip2"), ("\x1f\x8b", "gzip")]
+        try:
+            self.check_untar_overlay()
+        finally:
+            build.parallel_decompressors = decompressors
+
+    def test_untar_rejects_multiple_top_dirs(self):
+        temp_dir = self.make_temp_dir()
+        write_file(os.path.join(temp_dir, "a"), "")
+        write_file(os.path.join(temp_dir, "b"), "")
+        tar_file = os.path.join(temp_dir, "bad.tar")
+        subprocess.check_call(["tar", "-cf", tar_file, "a", "b"], cwd=temp_dir)
+        tree = build.TarballTree(tar_file)
+        self.assertRaises(Exception, lambda: tree.write_tree(
+                cmd_env.BasicEnv(), self.make_temp_dir()))
+
+    def test_patched_tree(self):
+        temp_dir = self.make_temp_dir()
+        tar_file = os.path.join(temp_dir, "foo.tar.gz")
+        self.make_tarball(temp_dir, tar_file,
+                          [("src/a.c", "int a;\n"), ("src/b.c", "int b;\n")],
+                          "-z", lambda top_dir: os.chmod(
+                              os.path.join(top_dir, "src/a.c"), 0751))
+        patch1 = os.path.join(temp_dir, "1.patch")
+        write_file(patch1, """\
+--- foo-1.0.orig/src/a.c
++++ foo-1.0/src/a.c
+@@ -1 +1 @@
+-int a;
++int a = 1;
+--- /dev/null
++++ foo-1.0/src/new.c
+@@ -0,0 +1 @@
++int c;
+""")
+        patch2 = os.path.join(temp_dir, "2.patch")
+        write_file(patch2, """\
+--- foo-1.0.orig/src/a.c
++++ foo-1.0/src/a.c
+@@ -1 +1 @@
+-int a = 1;
++int a = 2;
+""")
+        expected = {"a.c": "int a = 2;\n", "b.c": "int b;\n",
+                    "new.c": "int c;\n"}
+        # Patches are applied during extraction for a single tarball,
+        # and afterwards otherwise.
+        for orig_tree in (build.TarballTree(tar_file),
+                          build.MultiTarballTree([tar_file])):
+            dest_dir = self.make_temp_dir()
+            tree = build.PatchedTree(orig_tree, [patch1, patch2])
+            tree.write_tree(cmd_env.BasicEnv(), dest_dir)
+            src_dir = os.path.join(dest_dir, "src")
+            self.assertEquals(
+                dict((name, read_file(os.path.join(src_dir, name)))
+                     for name in os.listdir(src_dir)), expected)
+            self.assertEquals(
+                os.stat(os.path.join(src_dir, "a.c")).st_mode & 0777, 0751)
+
+        write_file(patch2, read_file(patch2).replace("int a = 1", "int a = 3"))
+        tree = build.PatchedTree(build.TarballTree(tar_file), [patch1, patch2])
+        self.assertRaises(build.unidiff.PatchError, lambda: tree.write_tree(
+                cmd_env.BasicEnv(), self.make_temp_dir()))
+
+
+class FileIndexTest(TempDirTestCase):
+
+    def test_find_files(self):
+        temp_dir = self.make_temp_dir()
+        dir1 = os.path.join(temp_dir, "dir1")
+        dir2 = os.path.join(temp_dir, "dir2")
+        os.mkdir(dir1)
+        os.mkdir(dir2)
+        for filename in ("dir1/010-gcc-4.2.2.patch", "dir1/shadowed",
+                         "dir2/002-gcc-4.2.2.patch", "dir2/shadowed",
+                         "dir2/001-gcc-4.2.2-foo.patch", "dir2/gcc.tar"):
+            write_file(os.path.join(temp_dir, filename), "")
+        cache_file = os.path.join(temp_dir, "cache")
+        index = build.FileIndex([dir1, dir2, os.path.join(temp_dir, "none")],
+                                cache_file)
+        self.assertEquals(index.find_file("shadowed"),
+                          os.path.join(dir1, "shadowed"))
+        self.assertEquals(index.find_file("gcc.tar"),
+                          os.path.join(dir2, "gcc.tar"))
+        self.assertRaises(Exception, lambda: index.find_file("missing"))
+        self.assertEquals(index.find_files("*-gcc-4.2.2*.patch"),
+                          [os.path.join(dir2, "001-gcc-4.2.2-foo.patch"),
+                           os.path.join(dir2, "002-gcc-4.2.2.patch"),
+                           os.path.join(dir1, "010-gcc-4.2.2.patch")])
+
+        # The cached listing is used while the mtime matches.
+        cache = read_file(cache_file)
+        write_file(cache_file, cache.replace("gcc.tar", "cached.tar"))
+        index = build.FileIndex([dir1, dir2], cache_file)
+        self.assertEquals(index.find_file("cached.tar"),
+                          os.path.join(dir2, "cached.tar"))
+        os.utime(dir2, (0, 0))
+        index = build.FileIndex([dir1, dir2], cache_file)
+        self.assertRaises(Exception, lambda: index.find_file("cached.tar"))
+        self.assertEquals(index.find_file("gcc.tar"),
+                          os.path.join(dir2, "gcc.tar"))
+
+    def test_source_file_is_lazy(self):
+        temp_dir = self.make_temp_dir()
+        old_index = build.file_index
+        build.file_index = build.FileIndex([temp_dir])
+        try:
+            tree = build.TarballTree(build.SourceFile("foo.tar.gz"))
+            self.assertRaises(Exception, tree.get_key)
+            write_file(os.path.join(temp_dir, "foo.tar.gz"), "")
+            build.file_index = build.FileIndex([temp_dir])
+            self.assertEquals(build.get_source_path(build.SourceFile(
+                        "foo.tar.gz")), os.path.join(temp_dir, "foo.tar.gz"))
+            tree.get_key()
+        finally:
+            build.file_index = old_index
+
+    def test_version_sort(self):
+        names = ["gcc-4.2.10", "gcc-4.2.2", "gcc-4.10", "gcc-4.2"]
+        self.assertEquals(sorted(names, key=build.version_sort_key),
+                          ["gcc-4.2", "gcc-4.2.2", "gcc-4.2.10", "gcc-4.10"])
+
+
+class CopyOntoTest(TempDirTestCase):
+
+    def check_copy_onto(self, use_hardlinks):
+        src_dir = self.make_temp_dir()
+        dest_dir = self.make_temp_dir()
+        os.makedirs(os.path.join(src_dir, "bin"))
+        os.makedirs(os.path.join(src_dir, "lib", "sub"))
+        write_file(os.path.join(src_dir, "bin", "tool"), "new tool")
+        write_file(os.path.join(src_dir, "lib", "sub", "lib.a"), "library")
+        os.symlink("tool", os.path.join(src_dir, "bin", "link"))
+        os.makedirs(os.path.join(dest_dir, "bin"))
+        write_file(os.path.join(dest_dir, "bin", "tool"), "old tool")
+        write_file(os.path.join(dest_dir, "bin", "other"), "other")
+        build.copy_onto(src_dir, dest_dir, use_hardlinks=use_hardlinks)
+        self.assertEquals(sorted(os.listdir(os.path.join(dest_dir, "bin"))),
+                          ["link", "other", "tool"])
+        self.assertEquals(read_file(os.path.join(dest_dir, "bin", "tool")),
+                          "new tool")
+        self.assertEquals(
+            read_file(os.path.join(dest_dir, "lib", "sub", "lib.a")),
+            "library")
+        self.assertEquals(os.readlink(os.path.join(dest_dir, "bin", "link")),
+                          "tool")
+        same_inode = (
+            os.stat(os.path.join(src_dir, "bin", "tool")).st_ino ==
+            os.stat(os.path.join(dest_dir, "bin", "tool")).st_ino)
+        self.assertEquals(same_inode, use_hardlinks)
+        # Copying again leaves the existing files alone.
+        before = os.stat(os.path.join(dest_dir, "bin", "tool"))
+        build.copy_onto(src_dir, dest_dir, use_hardlinks=use_hardlinks)
+        after = os.stat(os.path.join(dest_dir, "bin", "tool"))
+        self.assertEquals(before.st_ino, after.st_ino)
+
+    def test_concurrent_copy_onto(self):
+        # Two modules merged into one prefix at once share directories.
+        dest_dir = self.make_temp_dir()
+        src_dirs = []
+        for index in range(2):
+            src_dir = self.make_temp_dir()
+            for subdir in range(20):
+                dir_path = os.path.join(src_dir, "dir%i" % subdir, "sub")
+                os.makedirs(dir_path)
+                write_file(os.path.join(dir_path, "file%i" % index), "data")
+            src_dirs.append(src_dir)
+        errors = []
+        def copy(src_dir):
+            try:
+                build.copy_onto(src_dir, dest_dir)
+            except Exception, exn:
+                errors.append(exn)
+        threads = [threading.Thread(target=copy, args=(src_dir,))
+                   for src_dir in src_dirs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        for subdir in range(20):
+            self.assertEquals(
+                sorted(os.listdir(os.path.join(dest_dir, "dir%i" % subdir,
+                                               "sub"))),
+                ["file0", "file1"])
+        # Each thread uses its own temporary names.
+        temp_paths = []
+        thread = threading.Thread(target=lambda: temp_paths.append(
+                build.get_merge_temp_path("file")))
+        thread.start()
+        thread.join()
+        self.assertNotEquals(temp_paths[0], build.get_merge_temp_path("file"))
+
+    def test_copy_onto_with_hardlinks(self):
+        self.check_copy_onto(use_hardlinks=True)
+
+    def test_copy_onto_with_copies(self):
+        self.check_copy_onto(use_hardlinks=False)
+
+
+class InstallDestdirTest(TempDirTestCase):
+
+    def install(self, temp_dir, files):
+        prefix_dir = os.path.join(temp_dir, "prefix")
+        def run(dest):
+            for path, data in files:
+                filename = os.path.join(dest, prefix_dir.lstrip("/"), path)
+                if not os.path.exists(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                write_file(filename, data)
+        build.install_destdir(prefix_dir, os.path.join(temp_dir, "install"),
+                              run)
+
+    def test_incremental_install(self):
+        temp_dir = self.make_temp_dir()
+        prefix_dir = os.path.join(temp_dir, "prefix")
+        self.install(temp_dir, [("bin/same", "same"), ("bin/changed", "v1"),
+                                ("bin/removed", "removed"),
+                                ("lib/gone/old", "old"),
+                                ("bin/overwritten", "ours")])
+        # Another module replaces one of our files.
+        write_file(os.path.join(prefix_dir, "bin", "overwritten"), "theirs")
+        inode = os.stat(os.path.join(prefix_dir, "bin", "same")).st_ino
+        self.install(temp_dir, [("bin/same", "same"), ("bin/changed", "v2"),
+                                ("bin/added", "added")])
+        self.assertEquals(
+            sorted(os.listdir(os.path.join(prefix_dir, "bin"))),
+            ["added", "changed", "overwritten", "same"])
+        self.assertEquals(os.listdir(os.path.join(prefix_dir)), ["bin"])
+        self.assertEquals(
+            read_file(os.path.join(prefix_dir, "bin", "changed")), "v2")
+        # A file that we no longer install is left alone if another
+        # module has replaced it.
+        self.assertEquals(
+            read_file(os.path.join(prefix_dir, "bin", "overwritten")), "theirs")
+        # Unchanged files are not copied again.
+        self.assertEquals(
+            os.stat(os.path.join(prefix_dir, "bin", "same")).st_ino, inode)
+
+
+class CountingTree(build.DirTree):
+
+    def __init__(self, name, size):
+        self._name = name
+        self._size = size
+        self.writes = 0
+
+    def get_key(self):
+        return build.hash_values(["CountingTree", self._name])
+
+    def write_tree(self, env, dest_dir):
+        self.writes += 1
+        os.mkdir(os.path.join(dest_dir, "subdir"))
+        write_file(os.path.join(dest_dir, "subdir", "file"), "x" * self._size)
+
+
+class SourceCacheTest(TempDirTestCase):
+
+    def test_checkout(self):
+        cache = build.SourceCache(self.make_temp_dir(), max_size=1000)
+        tree = CountingTree("foo", 100)
+        for allow_hardlinks in (True, False):
+            dest_dir = self.make_temp_dir()
+            cache.checkout(cmd_env.BasicEnv(), tree, dest_dir,
+                           allow_hardlinks=allow_hardlinks)
+            self.assertEquals(
+                read_file(os.path.join(dest_dir, "subdir", "file")), "x" * 100)
+        self.assertEquals(tree.writes, 1)
+
+    def test_eviction(self):
+        cache_dir = self.make_temp_dir()
+        cache = build.SourceCache(cache_dir, max_size=250)
+        # An entry that another process is still writing.
+        os.mkdir(os.path.join(cache_dir, "tmp-other"))
+        write_file(os.path.join(cache_dir, "tmp-other", "size"), "1000")
+        os.utime(os.path.join(cache_dir, "tmp-other"), (0, 0))
+        trees = [CountingTree(name, 100) for name in ("a", "b", "c")]
+        for index, tree in enumerate(trees):
+            cache.checkout(cmd_env.BasicEnv(), tree, self.make_temp_dir())
+            # Make sure the entries get distinct mtimes.
+            os.utime(os.path.join(cache_dir, tree.get_key()), (index, index))
+        # The least recently used tree was evicted.
+        cache.checkout(cmd_env.BasicEnv(), trees[1], self.make_temp_dir())
+        cache.checkout(cmd_env.BasicEnv(), trees[2], self.make_temp_dir())
+        self.assertEquals([tree.writes for tree in trees], [1, 1, 1])
+        cache.checkout(cmd_env.BasicEnv(), trees[0], self.make_temp_dir())
+        self.assertEquals([tree.writes for tree in trees], [2, 1, 1])
+        # It is neither counted nor evicted.
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, "tmp-other",
+                                                    "size")))
+
+
+class ExampleModule(build.ModuleBase):
+
+    name = "example"
+    source = build.EmptyTree()
+
+    def __init__(self, *args, **kwargs):
+        build.ModuleBase.__init__(self, *args, **kwargs)
+        self.contents = "hello"
+        self.got = []
+
+    def configure(self, log):
+        self.got.append("configure")
+
+    def make(self, log):
+        self.got.append("make")
+
+    def install(self, log):
+        self.got.append("install")
+        def run(dest):
+            dest_dir = os.path.join(dest, self._prefix.lstrip("/"), "bin")
+            os.makedirs(dest_dir)
+            write_file(os.path.join(dest_dir, "tool"), self.contents)
+        build.install_destdir(self._prefix, self._install_dir, run)
+
+
+class StepCacheTest(TempDirTestCase):
+
+    def make_module(self, temp_dir, env_vars):
+        return ExampleModule(
+            os.path.join(temp_dir, "source"), os.path.join(temp_dir, "build"),
+            os.path.join(temp_dir, "prefix"),
+            os.path.join(temp_dir, "install"), env_vars,
+            step_cache=build.StepCache(os.path.join(temp_dir, "cache")))
+
+    def test_step_cache(self):
+        temp_dir = self.make_temp_dir()
+        tool = os.path.join(temp_dir, "prefix", "bin", "tool")
+        mod = self.make_module(temp_dir, [("FOO", "1")])
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, ["configure", "make", "install"])
+        self.assertEquals(read_file(tool), "hello")
+
+        # Nothing is run when the inputs are unchanged.
+        mod = self.make_module(temp_dir, [("FOO", "1")])
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, [])
+
+        # The install dir is merged back into a prefix that has been
+        # deleted.
+        shutil.rmtree(os.path.join(temp_dir, "prefix"))
+        mod = self.make_module(temp_dir, [("FOO", "1")])
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, [])
+        self.assertEquals(read_file(tool), "hello")
+
+        # The recorded install tree is restored into the prefix.
+        shutil.rmtree(os.path.join(temp_dir, "install"))
+        shutil.rmtree(os.path.join(temp_dir, "prefix"))
+        mod = self.make_module(temp_dir, [("FOO", "1")])
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, [])
+        self.assertEquals(read_file(tool), "hello")
+
+        # Changing an input causes a rebuild.
+        mod = self.make_module(temp_dir, [("FOO", "2")])
+        mod.contents = "goodbye"
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, ["configure", "make", "install"])
+        self.assertEquals(read_file(tool), "goodbye")
+
+    def test_shared_prefix_path(self):
+        temp_dir = self.make_temp_dir()
+        tool = os.path.join(temp_dir, "prefix", "bin", "tool")
+        def make_module(name, env_vars, contents):
+            mod = ExampleModule(
+                os.path.join(temp_dir, "source"),
+                os.path.join(temp_dir, "build-" + name),
+                os.path.join(temp_dir, "prefix"),
+                os.path.join(temp_dir, "install-" + name), env_vars,
+                step_cache=build.StepCache(os.path.join(temp_dir, "cache")))
+            mod.name = name
+            mod.contents = contents
+            return mod
+        make_module("pregcc", [("FOO", "1")], "pregcc v1").all()(
+            action_tree.DummyLogWriter())
+        make_module("fullgcc", [("FOO", "1")], "fullgcc v1").all()(
+            action_tree.DummyLogWriter())
+        self.assertEquals(read_file(tool), "fullgcc v1")
+        make_module("pregcc", [("FOO", "2")], "pregcc v2").all()(
+            action_tree.DummyLogWriter())
+        self.assertEquals(read_file(tool), "pregcc v2")
+
+        # Re-running the unchanged module puts its copy back, even
+        # though its install dir and manifest are unchanged.
+        mod = make_module("fullgcc", [("FOO", "1")], "fullgcc v1")
+        mod.all()(action_tree.DummyLogWriter())
+        self.assertEquals(mod.got, [])
+        self.assertEquals(read_file(tool), "fullgcc v1")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,301 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Captures the output of each build step instead of letting it go to
+# the terminal, where concurrent steps' output would be interleaved
+# and a slow terminal would hold up the build.  The full output is
+# written to a gzipped file on a separate thread, and the last part
+# is kept in memory to show if the step fails.
+
+import collections
+import gzip
+import os
+import Queue
+import subprocess
+import sys
+import threading
+
+import cmd_env
+
+
+class RingBuffer(object):
+
+    # Keeps the last "size" bytes written.
+
+    def __init__(self, size):
+        self._size = size
+        self._chunks = collections.deque()
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        self._lock.acquire()
+        try:
+            self._chunks.append(data)
+            self._length += len(data)
+            while self._length - len(self._chunks[0]) >= self._size:
+                self._length -= len(self._chunks.popleft())
+        finally:
+            self._lock.release()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            return "".join(self._chunks)[-self._size:]
+        finally:
+            self._lock.release()
+
+
+class AsyncGzipWriter(object):
+
+    # Compresses and writes data on a separate thread.  The queue is
+    # bounded so that we do not buffer without limit if the disk is
+    # slower than the build.
+
+    def __init__(self, filename, max_queued=256):
+        self._fh = gzip.open(filename, "wb")
+        self._queue = Queue.Queue(max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_queued)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _write_queued(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is None:
+                try:
+                    self._fh.write(data)
+                except (IOError, OSError):
+                    self._error = sys.exc_info()
+
+    def write(self, data):
+        if len(data) > 0:
+            self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._fh.close()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+
+class OutputCapture(object):
+
+    # A file-like object for a step's output.
+
+    # The file is only created once there is some output.
+
+    def __init__(self, filename=None, tail_size=64 * 1024):
+        self.filename = filename
+        self._tail = RingBuffer(tail_size)
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        self._tail.write(data)
+        if self.filename is not None:
+            self._lock.acquire()
+            try:
+                if self._writer is None:
+                    self._writer = AsyncGzipWriter(self.filename)
+                self._writer.write(data)
+            finally:
+                self._lock.release()
+
+    def flush(self):
+        pass
+
+    def get_tail(self):
+        return self._tail.get()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        finally:
+            self._lock.release()
+
+
+current = threading.local()
+
+
+def get_current_capture():
+    return getattr(current, "capture", None)
+
+
+class CurrentOutput(object):
+
+    # A file-like object that writes to the calling thread's capture,
+    # or to stdout if there is none.
+
+    def write(self, data):
+        capture = get_current_capture()
+        if capture is None:
+            sys.stdout.write(data)
+        else:
+            capture.write(data)
+
+    def flush(self):
+        if get_current_capture() is None:
+            sys.stdout.flush()
+
+
+current_output = CurrentOutput()
+
+
+def with_log_output(func):
+    # Wraps an action so that, while it runs, commands run through a
+    # CaptureEnv write to the capture of the action's log, if it has
+    # one (see CaptureLogWriter).
+    def run(log):
+        get_capture = getattr(log, "get_capture", None)
+        if get_capture is None:
+            func(log)
+            return
+        old_capture = get_current_capture()
+        current.capture = get_capture()
+        try:
+            func(log)
+        finally:
+            current.capture = old_capture
+    return run
+
+
+def copy_to_capture(fh, capture):
+    while True:
+        data = os.read(fh.fileno(), 65536)
+        if data == "":
+            break
+        capture.write(data)
+    fh.close()
+
+
+class CaptureEnv(object):
+
+    # Sends the output of commands to the calling thread's capture,
+    # except for streams that the caller redirects itself.  Without a
+    # capture, commands inherit our stdout and stderr as usual.
+
+    def __init__(self, env):
+        self._env = env
+
+    @property
+    def can_fold(self):
+        return cmd_env.can_fold(self._env)
+
+    def cmd(self, args, do_wait=True, **kwargs):
+        capture = get_current_capture()
+        if capture is None or ("stdout" in kwargs and "stderr" in kwargs):
+            return self._env.cmd(args, do_wait=do_wait, **kwargs)
+        if "stdout" not in kwargs:
+            kwargs["stdout"] = subprocess.PIPE
+            kwargs.setdefault("stderr", subprocess.STDOUT)
+            pipe_name = "stdout"
+        else:
+            kwargs["stderr"] = subprocess.PIPE
+            pipe_name = "stderr"
+        process = self._env.cmd(args, do_wait=False, **kwargs)
+        thread = threading.Thread(target=copy_to_capture,
+                                  args=(getattr(process, pipe_name), capture))
+        thread.setDaemon(True)
+        thread.start()
+        if do_wait:
+            thread.join()
+            rc = process.wait()
+            if rc != 0:
+                raise cmd_env.CommandFailedError(
+                    "Command failed with return code %i: %s" % (rc, args), rc)
+        return process
+
+
+class CaptureLogWriter(object):
+
+    # Wraps a log writer (see action_tree.DummyLogWriter) to give each
+    # node a capture for its output, written to
+    # log_dir/<dotted path>.log.gz.  If the node fails, the end of its
+    # output is written to "stream".
+
+    def __init__(self, log, log_dir, path=(), tail_size=64 * 1024,
+                 stream=sys.stderr):
+        self._log = log
+        self._log_dir = log_dir
+        self._path = list(path)
+        self._tail_size = tail_size
+        self._stream = stream
+        self._capture = None
+        self._lock = threading.Lock()
+
+    def get_capture(self):
+        self._lock.acquire()
+        try:
+            if self._capture is None:
+                if not os.path.exists(self._log_dir):
+                    try:
+                        os.makedirs(self._log_dir)
+                    except OSError:
+                        # Another step may have created it.
+                        if not os.path.isdir(self._log_dir):
+                            raise
+                self._capture = OutputCapture(
+                    os.path.join(self._log_dir,
+                                 "%s.log.gz" % ".".join(self._path)),
+                    tail_size=self._tail_size)
+            return self._capture
+        finally:
+            self._lock.release()
+
+    def start(self):
+        self._log.start()
+
+    def child_log(self, name, do_start=True):
+        return CaptureLogWriter(self._log.child_log(name, do_start=do_start),
+                                self._log_dir, self._path + [name],
+                                tail_size=self._tail_size,
+                                stream=self._stream)
+
+    def finish(self, result):
+        capture = self._capture
+        if capture is not None:
+            capture.close()
+            if result != 0:
+                tail = capture.get_tail()
+                if tail != "" and not tail.endswith("\n"):
+                    tail += "\n"
+                self._stream.write(
+                    "--- End of output from %s (full log in %s) ---\n%s"
+                    "--- End of %s ---\n"
+                    % (".".join(self._path), capture.filename, tail,
+                       ".".join(self._path)))
+                self._stream.flush()
+        self._log.finish(result)
+
+
+class StreamLogWriter(object):
+
+    # Wraps a log writer to send the output of every node to "stream",
+    # for when the output cannot simply be inherited from our stdout
+    # (see build_daemon.py).
+
+    def __init__(self, log, stream):
+        self._log = log
+        self._stream = stream
+
+    def get_capture(self):
+        return self._stream
+
+    def start(self):
+        self._log.start()
+
+    def child_log(self, name, do_start=True):
+        return StreamLogWriter(self._log.child_log(name, do_start=do_start),
+                               self._stream)
+
+    def finish(self, result):
+        self._log.finish(result)
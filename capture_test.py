@@ -0,0 +1,82 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import action_tree
+import capture
+import cmd_env
+
+
+def read_gzip(filename):
+    fh = gzip.open(filename, "rb")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix="capture_test")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_ring_buffer(self):
+        ring = capture.RingBuffer(10)
+        for index in range(10):
+            ring.write("%i..." % index)
+        self.assertEquals(ring.get(), "..8...9...")
+        ring.write("x" * 20)
+        self.assertEquals(ring.get(), "x" * 10)
+
+    def test_output_capture(self):
+        filename = os.path.join(self._temp_dir, "log.gz")
+        output = capture.OutputCapture(filename, tail_size=5)
+        output.close()
+        # Nothing is written for a step without output.
+        self.assertFalse(os.path.exists(filename))
+        output = capture.OutputCapture(filename, tail_size=5)
+        output.write("hello ")
+        output.write("world")
+        output.close()
+        self.assertEquals(output.get_tail(), "world")
+        self.assertEquals(read_gzip(filename), "hello world")
+
+    def test_capture_steps(self):
+        env = cmd_env.VerboseWrapper(capture.CaptureEnv(cmd_env.DirectEnv()),
+                                     stream=capture.current_output)
+        def step1(log):
+            env.cmd(["sh", "-c", "echo out; echo err >&2"])
+        def step2(log):
+            env.cmd(["sh", "-c", "echo step2 output; exit 1"])
+        tree = action_tree.make_node(
+            [("step1", capture.with_log_output(step1)),
+             ("step2", capture.with_log_output(step2))], "top",
+            dependencies={})
+        log_dir = os.path.join(self._temp_dir, "logs")
+        stream = StringIO.StringIO()
+        log = capture.CaptureLogWriter(action_tree.DummyLogWriter(), log_dir,
+                                       stream=stream)
+        self.assertRaises(cmd_env.CommandFailedError,
+                          lambda: action_tree.run_action(tree, log, jobs=2))
+        self.assertEquals(
+            read_gzip(os.path.join(log_dir, "step1.log.gz")),
+            "['sh', '-c', 'echo out; echo err >&2']\nout\nerr\n")
+        self.assertEquals(
+            stream.getvalue(),
+            "--- End of output from step2 (full log in %s) ---\n"
+            "['sh', '-c', 'echo step2 output; exit 1']\nstep2 output\n"
+            "--- End of step2 ---\n" % os.path.join(log_dir, "step2.log.gz"))
+
+
+if __name__ == "__main__":
+    unittest.main()
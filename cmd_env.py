@@ -15,11 +15,18 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import bisect
 import errno
+import fcntl
 import os
+import pipes
 import pprint
+import re
+import select
 import signal
 import subprocess
+import sys
+import threading
 import time
 
 
@@ -64,17 +71,82 @@ class BasicEnv(object):
             os.execvp(args[0], args)
 
 
+# Wrappers that can do so pass the effect they would otherwise get
+# from a prefix command (such as "sh -c 'cd ...'" or "env") down to
+# the innermost env as keyword arguments instead, provided every env
+# between them and DirectEnv can take those arguments.  This saves a
+# fork and exec per wrapper.  The arguments are:
+#  * cwd: as for subprocess.Popen.
+#  * environ_ops: a list of functions, each taking and returning an
+#    environment dict, applied in order to os.environ.
+#  * chroot: a directory to chroot into before changing to cwd.
+
+def can_fold(env):
+    return getattr(env, "can_fold", False)
+
+
+def apply_environ_ops(environ_ops, environ=None):
+    if environ is None:
+        environ = os.environ
+    environ = dict(environ)
+    for op in environ_ops:
+        environ = op(environ)
+    return environ
+
+
+class DirectEnv(BasicEnv):
+
+    # Like BasicEnv, but applies the folded arguments in the one
+    # process it creates.
+
+    can_fold = True
+
+    def cmd(self, args, environ_ops=(), chroot=None, **kwargs):
+        if len(environ_ops) > 0:
+            kwargs["env"] = apply_environ_ops(environ_ops, kwargs.get("env"))
+        if chroot is not None:
+            # Like chroot(8), start in the new root directory unless
+            # told otherwise.
+            cwd = kwargs.pop("cwd", None) or "/"
+            def enter_chroot():
+                os.chroot(chroot)
+                os.chdir(cwd)
+            kwargs["preexec_fn"] = enter_chroot
+        if kwargs.pop("fork", True):
+            return BasicEnv.cmd(self, args, **kwargs)
+        kwargs.pop("do_wait", None)
+        preexec_fn = kwargs.pop("preexec_fn", None)
+        if preexec_fn is not None:
+            preexec_fn()
+        elif "cwd" in kwargs:
+            os.chdir(kwargs.pop("cwd"))
+        environ = kwargs.pop("env", None)
+        assert len(kwargs) == 0, kwargs
+        if environ is None:
+            os.execvp(args[0], args)
+        else:
+            os.execvpe(args[0], args, environ)
+
+
 def call(args, **kwargs):
     return BasicEnv().cmd(args, **kwargs)
 
 
 class VerboseWrapper(object):
 
-    def __init__(self, env):
+    # Prints each command to "stream", which defaults to whatever
+    # sys.stdout is at the time.
+
+    def __init__(self, env, stream=None):
         self._env = env
+        self._stream = stream
+
+    @property
+    def can_fold(self):
+        return can_fold(self._env)
 
     def cmd(self, args, **kwargs):
-        pprint.pprint(args)
+        pprint.pprint(args, stream=self._stream)
         return self._env.cmd(args, **kwargs)
 
 
@@ -93,6 +165,30 @@ def in_dir(dir_path):
             "inline_chdir_script", dir_path]
 
 
+class InDirEnv(object):
+
+    # Equivalent to PrefixCmdEnv(in_dir(dir_path), env).
+
+    def __init__(self, dir_path, env):
+        self._dir_path = dir_path
+        self._env = env
+
+    @property
+    def can_fold(self):
+        return can_fold(self._env)
+
+    def cmd(self, args, **kwargs):
+        if not can_fold(self._env):
+            return self._env.cmd(in_dir(self._dir_path) + args, **kwargs)
+        if "chroot" not in kwargs:
+            # A cwd passed from an outer wrapper takes effect after
+            # ours.  A chroot from an outer wrapper resets the
+            # directory, making ours irrelevant.
+            kwargs["cwd"] = os.path.join(self._dir_path,
+                                         kwargs.get("cwd") or ".")
+        return self._env.cmd(args, **kwargs)
+
+
 def write_file_cmd(filename, data):
     return ["sh", "-c", 'echo -n "$1" >"$2"', "inline_script", data, filename]
 
@@ -101,30 +197,196 @@ def append_file_cmd(filename, data):
     return ["sh", "-c", 'echo -n "$1" >>"$2"', "inline_script", data, filename]
 
 
-def clean_environ_except_home_env(env):
+CLEAN_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+
+class EnvironOpEnv(object):
+
+    # Base class for wrappers that modify the environment.  Subclasses
+    # provide both a prefix command and the equivalent function on an
+    # environment dict.
+
+    def __init__(self, env):
+        self._env = env
+
+    @property
+    def can_fold(self):
+        return can_fold(self._env)
+
+    def cmd(self, args, **kwargs):
+        if not can_fold(self._env):
+            return self._env.cmd(self.get_prefix_cmd() + args, **kwargs)
+        # Wrappers further in take effect first.
+        kwargs["environ_ops"] = ([self.apply] +
+                                 list(kwargs.get("environ_ops", ())))
+        return self._env.cmd(args, **kwargs)
+
+
+class CleanEnvironEnv(EnvironOpEnv):
+
     # Resets everything except HOME, so make sure wrapped env sets
     # HOME correctly (e.g. sudo -H).
-    path = "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-    return PrefixCmdEnv(
-        ["sh", "-c", 'env -i HOME="$HOME" %s "$@"' % path,
-         "clean_environ_env"], env)
+
+    def get_prefix_cmd(self):
+        return ["sh", "-c", 'env -i HOME="$HOME" PATH=%s "$@"' % CLEAN_PATH,
+                "clean_environ_env"]
+
+    def apply(self, environ):
+        return {"HOME": environ.get("HOME", ""), "PATH": CLEAN_PATH}
+
+
+class SetEnvironVarsEnv(EnvironOpEnv):
+
+    # vars is a list of (key, value) pairs.  It is read each time a
+    # command is run, so the caller may add to it later.
+
+    def __init__(self, vars, env):
+        EnvironOpEnv.__init__(self, env)
+        self._vars = vars
+
+    def get_prefix_cmd(self):
+        return ["env"] + ["%s=%s" % (key, value) for key, value in self._vars]
+
+    def apply(self, environ):
+        environ = environ.copy()
+        environ.update(self._vars)
+        return environ
+
+
+def clean_environ_except_home_env(env):
+    return CleanEnvironEnv(env)
 
 
 def set_environ_vars_env(vars, env):
-    return PrefixCmdEnv(["env"] + ["%s=%s" % (key, value)
-                                   for key, value in vars], env)
+    return SetEnvironVarsEnv(list(vars), env)
+
+
+def decode_mount_path(path):
+    # The kernel escapes space, tab, newline and backslash as octal.
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)),
+                  path)
+
+
+# The 2.6.22-14 kernel on our buildbot machine seems to add this to
+# mount paths if the source directory of the bind mount gets deleted.
+DELETED_SUFFIX = " (deleted)"
+
+
+class Mount(object):
+
+    def __init__(self, mount_id, parent_id, path):
+        self.mount_id = mount_id
+        self.parent_id = parent_id
+        self.path = path
+
+
+def parse_mountinfo(data):
+    mounts = []
+    for line in data.split("\n"):
+        if line == "":
+            continue
+        fields = line.split(" ")
+        path = decode_mount_path(fields[4])
+        if path.endswith(DELETED_SUFFIX):
+            path = path[:-len(DELETED_SUFFIX)]
+        mounts.append(Mount(int(fields[0]), int(fields[1]), path))
+    return mounts
+
+
+class MountTable(object):
+
+    # A parsed copy of /proc/self/mountinfo, kept sorted by path so
+    # that queries are binary searches.  The kernel flags the open
+    # mountinfo file with POLLERR|POLLPRI when the mount table
+    # changes, so we only reread it after that.
+
+    def __init__(self, filename="/proc/self/mountinfo"):
+        self._filename = filename
+        self._fd = None
+        self._poller = None
+        self._mounts = None
+        self._paths = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._mounts = None
+
+    def _read(self):
+        if self._fd is None:
+            self._fd = os.open(self._filename, os.O_RDONLY)
+            # Commands we run should not inherit this.
+            fcntl.fcntl(self._fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self._poller = select.poll()
+            self._poller.register(self._fd, select.POLLERR | select.POLLPRI)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if chunk == "":
+                break
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def _has_changed(self):
+        # Polling also acknowledges the change, so a change made
+        # between this and the reread just causes another reread.
+        return any(events & (select.POLLERR | select.POLLPRI)
+                   for fd, events in self._poller.poll(0))
+
+    def _get_sorted(self):
+        self._lock.acquire()
+        try:
+            if self._mounts is None or self._has_changed():
+                mounts = sorted(parse_mountinfo(self._read()),
+                                key=lambda mount: mount.path)
+                self._paths = [mount.path for mount in mounts]
+                self._mounts = mounts
+            return self._mounts, self._paths
+        finally:
+            self._lock.release()
+
+    def get_mounts(self):
+        return list(self._get_sorted()[0])
+
+    def is_mounted(self, path):
+        mounts, paths = self._get_sorted()
+        path = os.path.realpath(path)
+        index = bisect.bisect_left(paths, path)
+        return index < len(paths) and paths[index] == path
+
+    def get_mounts_below(self, path):
+        # Returns mounts at or below path, in path order.  Paths
+        # strictly below path sort between path + "/" and path + "0",
+        # since "0" follows "/" in ASCII.
+        mounts, paths = self._get_sorted()
+        prefix = os.path.realpath(path).rstrip("/")
+        if prefix == "":
+            return list(mounts)
+        start = bisect.bisect_left(paths, prefix)
+        end = bisect.bisect_right(paths, prefix)
+        below_start = bisect.bisect_left(paths, prefix + "/")
+        below_end = bisect.bisect_left(paths, prefix + "0")
+        return mounts[start:end] + mounts[below_start:below_end]
+
+
+mount_table = None
+
+
+def get_mount_table():
+    global mount_table
+    if mount_table is None:
+        mount_table = MountTable()
+    return mount_table
 
 
 def get_all_mounts():
-    fh = open("/proc/mounts", "r")
-    for line in fh:
-        parts = line.split()
-        yield parts[1]
-    fh.close()
+    for mount in get_mount_table().get_mounts():
+        yield mount.path
 
 
 def is_mounted(path):
-    return os.path.realpath(path) in list(get_all_mounts())
+    return get_mount_table().is_mounted(path)
 
 
 def is_path_below(parent, child):
@@ -133,28 +395,94 @@ def is_path_below(parent, child):
     return parent == child or child.startswith(parent + "/")
 
 
-DELETED_SUFFIX = "\\040(deleted)"
-
-
 def get_mounts_below(pathname):
-    prefix = os.path.realpath(pathname)
-    for mount_path in get_all_mounts():
-        # The 2.6.22-14 kernel on our buildbot machine seems to add
-        # this to lines in /proc/mounts if the source directory of the
-        # bind mount gets deleted.
-        if mount_path.endswith(DELETED_SUFFIX):
-            mount_path = mount_path[:-len(DELETED_SUFFIX)]
-        if is_path_below(prefix, mount_path):
-            yield mount_path
-
-
-def unmount_below(as_root, dir_path):
-    # When you use "mount --rbind", you can end up with bind mounts
-    # under bind mounts, such as /dev and /dev/pts.  The latter needs
-    # to get unmounted first, so sort longest first.
-    mounts = sorted(get_mounts_below(dir_path), key=len, reverse=True)
-    for mount_path in mounts:
-        as_root.cmd(["umount", mount_path])
+    for mount in get_mount_table().get_mounts_below(pathname):
+        yield mount.path
+
+
+def get_unmount_waves(mounts):
+    # Groups the mounts into lists that can each be unmounted in
+    # parallel, in order.  When you use "mount --rbind", you can end
+    # up with bind mounts under bind mounts, such as /dev and
+    # /dev/pts.  The latter needs to get unmounted first, so each
+    # wave contains the mounts with nothing mounted on them.  Mounts
+    # stacked on the same path must be unmounted one at a time, top
+    # first.
+    remaining = dict((mount.mount_id, mount) for mount in mounts)
+    waves = []
+    while len(remaining) > 0:
+        parent_ids = set(mount.parent_id for mount in remaining.itervalues())
+        wave = []
+        paths = set()
+        for mount_id, mount in sorted(remaining.iteritems()):
+            if mount_id not in parent_ids and mount.path not in paths:
+                wave.append(mount)
+                paths.add(mount.path)
+        assert len(wave) > 0, "Mount parent IDs contain a cycle"
+        for mount in wave:
+            del remaining[mount.mount_id]
+        waves.append(wave)
+    return waves
+
+
+def run_in_parallel(funcs, threads):
+    # Runs the functions on up to the given number of threads and
+    # re-raises the first exception, if any, once they have finished.
+    funcs = list(funcs)
+    lock = threading.Lock()
+    errors = []
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if len(funcs) == 0:
+                    return
+                func = funcs.pop(0)
+            finally:
+                lock.release()
+            try:
+                func()
+            except Exception:
+                errors.append(sys.exc_info())
+    workers = [threading.Thread(target=worker)
+               for index in range(min(threads, len(funcs)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class UnmountError(Exception):
+    pass
+
+
+def unmount_below(as_root, dir_path, lazy=False, threads=8):
+    # With lazy=True, each top-level mount is detached along with
+    # everything below it with one "umount -R -l", even if it is
+    # busy.
+    table = get_mount_table()
+    if lazy:
+        while True:
+            mounts = table.get_mounts_below(dir_path)
+            if len(mounts) == 0:
+                break
+            mount_ids = set(mount.mount_id for mount in mounts)
+            top_paths = sorted(set(mount.path for mount in mounts
+                                   if mount.parent_id not in mount_ids))
+            for mount_path in top_paths:
+                as_root.cmd(["umount", "-R", "-l", mount_path])
+            if len(table.get_mounts_below(dir_path)) >= len(mounts):
+                break
+    else:
+        for wave in get_unmount_waves(table.get_mounts_below(dir_path)):
+            run_in_parallel(
+                [lambda path=mount.path: as_root.cmd(["umount", path])
+                 for mount in wave], threads)
+    left = [mount.path for mount in table.get_mounts_below(dir_path)]
+    if len(left) > 0:
+        raise UnmountError("Still mounted below %s: %s" % (dir_path, left))
 
 
 def mount_proc(root_env, chroot_dir):
@@ -191,6 +519,61 @@ def bind_mount_x11(root_env, chroot_dir):
         root_env.cmd(["mount", "--bind", "/tmp/.X11-unix", dest_path])
 
 
+class MountPlan(object):
+
+    # An env that records commands instead of running them, so that
+    # the mount_*() functions can be used to plan the mounts for a
+    # chroot and then run them all with one as_root.cmd() call, which
+    # means one sudo instead of one per mount.  The commands are run
+    # in order, stopping at the first failure, as when running them
+    # separately.
+
+    def __init__(self):
+        self._commands = []
+
+    def cmd(self, args, **kwargs):
+        assert len(kwargs) == 0, kwargs
+        self._commands.append(args)
+
+    def get_commands(self):
+        return list(self._commands)
+
+    def get_script(self):
+        # Each command reports its index and return code on stdout.
+        # The commands' own output goes to stderr so that it cannot
+        # be confused with this.
+        lines = ['run() { n="$1"; shift; "$@" >&2; rc=$?; '
+                 'echo "$n $rc"; return $rc; }']
+        for index, args in enumerate(self._commands):
+            lines.append("run %i %s || exit"
+                         % (index, " ".join(pipes.quote(arg) for arg in args)))
+        return "\n".join(lines) + "\n"
+
+    def run(self, as_root):
+        # Returns a list of (args, return code) for the commands that
+        # were run.
+        if len(self._commands) == 0:
+            return []
+        proc = as_root.cmd(["sh", "-c", self.get_script(), "batch_script"],
+                           do_wait=False, stdout=subprocess.PIPE)
+        stdout = proc.communicate()[0]
+        rc = proc.wait()
+        results = []
+        for line in stdout.splitlines():
+            index, command_rc = line.split()
+            results.append((self._commands[int(index)], int(command_rc)))
+        for args, command_rc in results:
+            if command_rc != 0:
+                raise CommandFailedError(
+                    "Command failed with return code %i: %s"
+                    % (command_rc, args), command_rc)
+        if rc != 0 or len(results) != len(self._commands):
+            raise CommandFailedError(
+                "Batch of commands failed with return code %i after %i of %i"
+                % (rc, len(results), len(self._commands)), rc)
+        return results
+
+
 class EnvWithHook(object):
 
     # Wrapper for an environment with a hook function that gets run
@@ -200,29 +583,67 @@ class EnvWithHook(object):
         self._hook_func = hook_func
         self._env = env
 
+    @property
+    def can_fold(self):
+        return can_fold(self._env)
+
     def cmd(self, args, **kwargs):
         self._hook_func()
         self._hook_func = lambda: None
         return self._env.cmd(args, **kwargs)
 
 
+class ChrootEnv(object):
+
+    # Equivalent to PrefixCmdEnv(["chroot", chroot_dir], env).  The
+    # chroot can only be folded in if we are root ourselves; otherwise
+    # the privilege change has to come from a prefix command in env.
+
+    def __init__(self, chroot_dir, env):
+        self._chroot_dir = chroot_dir
+        self._env = env
+
+    @property
+    def can_fold(self):
+        return can_fold(self._env) and os.getuid() == 0
+
+    def cmd(self, args, **kwargs):
+        if not self.can_fold:
+            return self._env.cmd(["chroot", self._chroot_dir] + args,
+                                 **kwargs)
+        if "chroot" in kwargs:
+            kwargs["chroot"] = os.path.join(
+                self._chroot_dir, make_relative_to_root(kwargs["chroot"]))
+        else:
+            kwargs["chroot"] = self._chroot_dir
+        return self._env.cmd(args, **kwargs)
+
+
 def chroot_env(chroot_dir, as_root, environ_vars,
-               do_forward_x11=False, do_forward_ssh_agent=False):
-    def hook():
-        # This reads the local /proc/mounts so will not work properly
+               do_forward_x11=False, do_forward_ssh_agent=False,
+               batch_mounts=False):
+    def set_up(root_env):
+        # This reads the local mount table so will not work properly
         # if as_root is remote.
-        mount_proc(as_root, chroot_dir)
-        mount_sys(as_root, chroot_dir)
-        bind_mount_dev_log(as_root, chroot_dir)
-        mount_dev_pts(as_root, chroot_dir)
+        mount_proc(root_env, chroot_dir)
+        mount_sys(root_env, chroot_dir)
+        bind_mount_dev_log(root_env, chroot_dir)
+        mount_dev_pts(root_env, chroot_dir)
         if do_forward_x11:
-            bind_mount_x11(as_root, chroot_dir)
-            as_root.cmd(["bash", "-c",
-                         """\
+            bind_mount_x11(root_env, chroot_dir)
+            root_env.cmd(["bash", "-c",
+                          """\
 xauth nlist | HOME=/root env -u XAUTHORITY chroot "$1" xauth nmerge -""",
-                         "inline_chroot_script", chroot_dir])
+                          "inline_chroot_script", chroot_dir])
         if do_forward_ssh_agent:
-            forward_ssh_agent(as_root, environ_vars, chroot_dir)
+            forward_ssh_agent(root_env, environ_vars, chroot_dir)
+    def hook():
+        if batch_mounts:
+            plan = MountPlan()
+            set_up(plan)
+            plan.run(as_root)
+        else:
+            set_up(as_root)
     after_hook = EnvWithHook(hook, as_root)
     if do_forward_x11:
         # Unset XAUTHORITY so that it is treated as defaulting to
@@ -230,15 +651,17 @@ xauth nlist | HOME=/root env -u XAUTHORITY chroot "$1" xauth nmerge -""",
         return PrefixCmdEnv(["env", "-u", "XAUTHORITY", "HOME=/root",
                              "chroot", chroot_dir], after_hook)
     else:
-        return PrefixCmdEnv(["chroot", chroot_dir], after_hook)
+        return ChrootEnv(chroot_dir, after_hook)
 
 
 # "user" is a string to pass to sudo, or None for root.
 def chroot_and_sudo_env(chroot_dir, as_root, environ_vars,
-                        user, do_forward_x11, do_forward_ssh_agent):
+                        user, do_forward_x11, do_forward_ssh_agent,
+                        batch_mounts=False):
     in_chroot = chroot_env(chroot_dir, as_root, environ_vars,
                            do_forward_x11=do_forward_x11,
-                           do_forward_ssh_agent=do_forward_ssh_agent)
+                           do_forward_ssh_agent=do_forward_ssh_agent,
+                           batch_mounts=batch_mounts)
     if user is not None:
         if do_forward_x11:
             in_chroot = xsudo_env(user, in_chroot)
@@ -330,47 +753,64 @@ def reenable_daemons(as_root):
     as_root.cmd(["rm", "/usr/sbin/policy-rc.d"])
 
 
+def read_cmdline(pid):
+    try:
+        args = read_file(os.path.join("/proc/%i/cmdline" % pid)).split("\0")
+    except (OSError, IOError), e:
+        if e.errno == errno.ENOENT:
+            # The process may have exited
+            return None
+        else:
+            raise
+    if args[-1] == "":
+        # There is usually a useless trailing \0 in the cmdline
+        # file, with the exception of /sbin/init and some programs
+        # that modify their argv such as avahi-daemon.
+        args.pop()
+    return args
+
+
+def read_root_dir(pid):
+    try:
+        return os.readlink(os.path.join("/proc/%i/root" % pid))
+    except (OSError, IOError), e:
+        if e.errno == errno.ENOENT:
+            # * If the process terminates, /proc/$pid will not exist
+            # * readlink can fail with ENOENT even if /proc/$pid/root shows
+            #   up in listdir
+            return None
+        elif e.errno == errno.EACCES:
+            # If we don't own the process we probably will not be
+            # allowed to read this
+            return None
+        else:
+            raise
+
+
+NOT_READ = object()
+
+
 class Process(object):
 
-    def __init__(self, pid):
+    # The cmdline and root directory are read on first use, so that
+    # scanning processes only reads the files it needs.
+
+    def __init__(self, pid, root_dir=NOT_READ):
         self._pid = pid
-        try:
-            args = read_file(
-                os.path.join("/proc/%i/cmdline" % pid)).split("\0")
-        except (OSError, IOError), e:
-            if e.errno == errno.ENOENT:
-                # The process may have exited
-                args = None
-            else:
-                raise
-        if args is not None and args[-1] == "":
-            # There is usually a useless trailing \0 in the cmdline
-            # file, with the exception of /sbin/init and some programs
-            # that modify their argv such as avahi-daemon.
-            args.pop()
-        self._cmdline = args
-        try:
-            self._root_dir = os.readlink(os.path.join("/proc/%i/root" % pid))
-        except (OSError, IOError), e:
-            if e.errno == errno.ENOENT:
-                # * If the process terminates, /proc/$pid will not exist
-                # * readlink can fail with ENOENT even if /proc/$pid/root shows
-                #   up in listdir
-                self._root_dir = None
-            elif e.errno == errno.EACCES:
-                # If we don't own the process we probably will not be
-                # allowed to read this
-                self._root_dir = None
-            else:
-                raise
+        self._cmdline = NOT_READ
+        self._root_dir = root_dir
 
     def get_pid(self):
         return self._pid
 
     def get_cmdline(self):
+        if self._cmdline is NOT_READ:
+            self._cmdline = read_cmdline(self._pid)
         return self._cmdline
 
     def get_root_dir(self):
+        if self._root_dir is NOT_READ:
+            self._root_dir = read_root_dir(self._pid)
         return self._root_dir
 
     def kill(self, signal_number):
@@ -390,28 +830,54 @@ class Process(object):
             return True
 
 
-def list_processes():
+def list_pids():
     for pid_string in os.listdir("/proc"):
-        try:
-            pid = int(pid_string)
-        except ValueError:
-            pass
-        else:
-            yield Process(pid)
+        if pid_string.isdigit():
+            yield int(pid_string)
+
+
+def list_processes():
+    for pid in list_pids():
+        yield Process(pid)
+
+
+def is_chrooted_below(chroot_realpath, pid):
+    root_dir = read_root_dir(pid)
+    return root_dir is not None and is_path_below(chroot_realpath, root_dir)
 
 
 def find_chrooted(chroot):
+    # Only /proc/$pid/root is read for each process.  The chroot
+    # directory is resolved once; the kernel gives us resolved root
+    # directories.
     chroot_realpath = os.path.realpath(chroot)
-    for proc in list_processes():
-        if (proc.get_root_dir() is not None 
-            and is_path_below(chroot_realpath, proc.get_root_dir())):
-            yield proc
+    for pid in list_pids():
+        root_dir = read_root_dir(pid)
+        if root_dir is not None and is_path_below(chroot_realpath, root_dir):
+            yield Process(pid, root_dir)
+
+
+def wait_until(predicate, timeout=None, initial_delay=0.001, max_delay=0.1):
+    # Polls with exponential backoff, so that we return soon after
+    # predicate() becomes true without spinning if it takes a while.
+    # Returns whether predicate() became true before the timeout.
+    delay = initial_delay
+    end_time = None
+    if timeout is not None:
+        end_time = time.time() + timeout
+    while not predicate():
+        if end_time is not None and time.time() >= end_time:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    return True
 
 
 def kill_chrooted(chroot):
+    chroot_realpath = os.path.realpath(chroot)
     found = set()
     while True:
-        procs = list(find_chrooted(chroot))
+        procs = list(find_chrooted(chroot_realpath))
         if len(procs) == 0:
             break
         for proc in procs:
@@ -420,4 +886,9 @@ def kill_chrooted(chroot):
                       proc.get_pid(), proc.get_cmdline()
             found.add(proc.get_pid())
             proc.kill(signal.SIGKILL)
-        time.sleep(0.5)
+        # A killed process stops showing a root directory once it
+        # has exited, even before it is reaped.  Rescan afterwards
+        # in case any forked in the meantime.
+        pids = [proc.get_pid() for proc in procs]
+        wait_until(lambda: not any(is_chrooted_below(chroot_realpath, pid)
+                                   for pid in pids))
@@ -15,7 +15,11 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import fcntl
 import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 
 import cmd_env
@@ -30,6 +34,27 @@ class ProcessListTest(unittest.TestCase):
         self.assertEquals(len(matches), 1)
         self.assertEquals(matches[0].get_root_dir(), "/")
 
+    def test_find_chrooted(self):
+        matches = [proc for proc in cmd_env.find_chrooted("/")
+                   if proc.get_pid() == os.getpid()]
+        self.assertEquals(len(matches), 1)
+        self.assertTrue("python" in " ".join(matches[0].get_cmdline()))
+        temp_dir = tempfile.mkdtemp(prefix="cmd_env_test")
+        try:
+            self.assertEquals(list(cmd_env.find_chrooted(temp_dir)), [])
+            cmd_env.kill_chrooted(temp_dir)
+        finally:
+            os.rmdir(temp_dir)
+
+    def test_wait_until(self):
+        calls = []
+        def predicate():
+            calls.append(None)
+            return len(calls) == 4
+        self.assertTrue(cmd_env.wait_until(predicate))
+        self.assertEquals(len(calls), 4)
+        self.assertFalse(cmd_env.wait_until(lambda: False, timeout=0.01))
+
 
 class IsPathBelowTest(unittest.TestCase):
 
@@ -42,5 +67,196 @@ class IsPathBelowTest(unittest.TestCase):
             self.assertEquals(cmd_env.is_path_below(parent, child), is_below)
 
 
+class RecordingEnv(cmd_env.DirectEnv):
+
+    def __init__(self):
+        self.commands = []
+
+    def cmd(self, args, **kwargs):
+        self.commands.append(args)
+        return cmd_env.DirectEnv.cmd(self, args, **kwargs)
+
+
+class FoldingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix="cmd_env_test")
+        os.mkdir(os.path.join(self._temp_dir, "subdir"))
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _run(self, base_env):
+        env = cmd_env.InDirEnv(
+            "subdir",
+            cmd_env.set_environ_vars_env(
+                [("FOO", "foo value")],
+                cmd_env.clean_environ_except_home_env(
+                    cmd_env.InDirEnv(self._temp_dir, base_env))))
+        proc = env.cmd(["sh", "-c", 'pwd; echo "$FOO"; echo "${BAR-unset}"'],
+                       stdout=subprocess.PIPE, do_wait=False)
+        stdout = proc.communicate()[0]
+        self.assertEquals(proc.wait(), 0)
+        return stdout
+
+    def test_folded_and_unfolded_match(self):
+        os.environ["BAR"] = "bar value"
+        try:
+            folded_env = RecordingEnv()
+            folded = self._run(folded_env)
+            unfolded_env = RecordingEnv()
+            unfolded = self._run(cmd_env.PrefixCmdEnv([], unfolded_env))
+        finally:
+            del os.environ["BAR"]
+        expected = "%s\nfoo value\nunset\n" % os.path.join(
+            os.path.realpath(self._temp_dir), "subdir")
+        self.assertEquals(folded, expected)
+        self.assertEquals(unfolded, expected)
+        # Folding means the command is run without any wrapper commands.
+        self.assertEquals(len(folded_env.commands[0]), 3)
+        self.assertEquals(folded_env.commands[0][0], "sh")
+        self.assertTrue(len(unfolded_env.commands[0]) > 3)
+
+    def test_outer_dir_is_relative_to_inner(self):
+        env = cmd_env.InDirEnv("/", cmd_env.InDirEnv(self._temp_dir,
+                                                     cmd_env.DirectEnv()))
+        proc = env.cmd(["pwd"], stdout=subprocess.PIPE, do_wait=False)
+        self.assertEquals(proc.communicate()[0], "/\n")
+
+    def test_failure(self):
+        env = cmd_env.InDirEnv(self._temp_dir, cmd_env.DirectEnv())
+        self.assertRaises(cmd_env.CommandFailedError,
+                          lambda: env.cmd(["false"]))
+
+
+class MountTableTest(unittest.TestCase):
+
+    def test_queries(self):
+        fd, filename = tempfile.mkstemp(prefix="cmd_env_test")
+        os.close(fd)
+        try:
+            cmd_env.write_file(filename, """\
+1 0 8:1 / / rw - ext4 /dev/sda1 rw
+2 1 0:3 / /chroot rw - ext4 /dev/sda1 rw
+3 2 0:4 / /chroot/proc rw - proc proc rw
+4 2 0:5 /deleted//deleted /chroot/with\\040space\\040(deleted) rw - ext4 x rw
+5 1 0:6 / /chroot.other rw - tmpfs tmpfs rw
+6 1 0:7 / /chrootx rw - tmpfs tmpfs rw
+""")
+            table = cmd_env.MountTable(filename)
+            self.assertTrue(table.is_mounted("/chroot/proc"))
+            # The fd that is kept open is not inherited by commands.
+            self.assertTrue(fcntl.fcntl(table._fd, fcntl.F_GETFD) &
+                            fcntl.FD_CLOEXEC)
+            self.assertTrue(table.is_mounted("/chroot/proc/"))
+            self.assertFalse(table.is_mounted("/chroot/pro"))
+            self.assertEquals(
+                [mount.path for mount in table.get_mounts_below("/chroot")],
+                ["/chroot", "/chroot/proc", "/chroot/with space"])
+            self.assertEquals(
+                [mount.mount_id for mount in table.get_mounts_below("/")],
+                [1, 2, 5, 3, 4, 6])
+            self.assertEquals(table.get_mounts_below("/chroot/dev"), [])
+
+            # Regular files never signal a change, so this needs an
+            # explicit invalidate.
+            cmd_env.write_file(filename, "1 0 8:1 / / rw - ext4 x rw\n")
+            self.assertTrue(table.is_mounted("/chroot"))
+            table.invalidate()
+            self.assertFalse(table.is_mounted("/chroot"))
+        finally:
+            os.unlink(filename)
+
+    def test_real_table(self):
+        # Assumes /proc is available
+        self.assertTrue(cmd_env.is_mounted("/proc"))
+        self.assertTrue("/proc" in cmd_env.get_mounts_below("/proc"))
+
+
+class CountingEnv(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def cmd(self, args, **kwargs):
+        self.calls += 1
+        return cmd_env.BasicEnv().cmd(args, **kwargs)
+
+
+class MountPlanTest(unittest.TestCase):
+
+    def test_plan(self):
+        # /proc is mounted, so only the other mount gets planned.
+        plan = cmd_env.MountPlan()
+        cmd_env.mount_proc(plan, "/")
+        cmd_env.mount_dev_pts(plan, "/nonexistent")
+        self.assertEquals(plan.get_commands(),
+                          [["mount", "-t", "devpts", "devpts",
+                            "/nonexistent/dev/pts"]])
+
+    def test_run(self):
+        plan = cmd_env.MountPlan()
+        plan.cmd(["echo", "output that is not a result"])
+        plan.cmd(["sh", "-c", 'test "$1" = "a \'b\'"', "-", "a 'b'"])
+        env = CountingEnv()
+        self.assertEquals(plan.run(env),
+                          [(plan.get_commands()[0], 0),
+                           (plan.get_commands()[1], 0)])
+        self.assertEquals(env.calls, 1)
+
+    def test_failure_stops(self):
+        temp_dir = tempfile.mkdtemp(prefix="cmd_env_test")
+        try:
+            plan = cmd_env.MountPlan()
+            plan.cmd(["sh", "-c", "exit 3"])
+            plan.cmd(["touch", os.path.join(temp_dir, "file")])
+            try:
+                plan.run(cmd_env.BasicEnv())
+            except cmd_env.CommandFailedError, exn:
+                self.assertEquals(exn.rc, 3)
+            else:
+                self.fail("Expected an error")
+            self.assertEquals(os.listdir(temp_dir), [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class UnmountTest(unittest.TestCase):
+
+    def test_waves(self):
+        def make_mount(mount_id, parent_id, path):
+            return cmd_env.Mount(mount_id, parent_id, path)
+        mounts = [make_mount(10, 1, "/c"),
+                  make_mount(11, 10, "/c/dev"),
+                  make_mount(12, 11, "/c/dev/pts"),
+                  make_mount(13, 10, "/c/proc"),
+                  make_mount(14, 13, "/c/proc"),
+                  make_mount(15, 10, "/c/sys")]
+        waves = cmd_env.get_unmount_waves(mounts)
+        self.assertEquals([[mount.mount_id for mount in wave]
+                           for wave in waves],
+                          [[12, 14, 15], [11, 13], [10]])
+
+    def test_unmount(self):
+        if os.getuid() != 0:
+            return
+        temp_dir = tempfile.mkdtemp(prefix="cmd_env_test")
+        try:
+            env = cmd_env.BasicEnv()
+            for lazy in (False, True):
+                env.cmd(["mount", "-t", "tmpfs", "tmpfs", temp_dir])
+                for subdir in ("a", "a/b", "c"):
+                    path = os.path.join(temp_dir, subdir)
+                    os.mkdir(path)
+                    env.cmd(["mount", "-t", "tmpfs", "tmpfs", path])
+                self.assertEquals(
+                    len(list(cmd_env.get_mounts_below(temp_dir))), 4)
+                cmd_env.unmount_below(env, temp_dir, lazy=lazy)
+                self.assertEquals(list(cmd_env.get_mounts_below(temp_dir)),
+                                  [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
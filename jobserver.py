@@ -0,0 +1,76 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import errno
+import os
+import threading
+
+
+class JobServer(object):
+
+    # A GNU make jobserver: a pipe holding a token for each job beyond
+    # the first.  Every make run with get_makeflags() in its
+    # environment draws from the same pool, instead of using its own
+    # -j limit.
+    #
+    # The first job belongs to us.  acquire() and release() share the
+    # pool with action_tree's executor: each running action holds a
+    # token, and the make it starts gets one more job for free.  This
+    # means the makes run for N concurrent actions use at most N
+    # extra jobs, rather than N times the limit.
+
+    def __init__(self, size):
+        assert size >= 1, size
+        self._size = size
+        self._fds = None
+        self._lock = threading.Lock()
+        self._own_token_free = True
+
+    def get_size(self):
+        return self._size
+
+    def _get_fds(self):
+        self._lock.acquire()
+        try:
+            if self._fds is None:
+                read_fd, write_fd = os.pipe()
+                os.write(write_fd, "+" * (self._size - 1))
+                self._fds = (read_fd, write_fd)
+            return self._fds
+        finally:
+            self._lock.release()
+
+    def get_makeflags(self):
+        # Older versions of make use --jobserver-fds; 4.2 and later
+        # use --jobserver-auth.
+        fds = "%i,%i" % self._get_fds()
+        return "-j --jobserver-fds=%s --jobserver-auth=%s" % (fds, fds)
+
+    def acquire(self):
+        # Returns a token, blocking until one is free.
+        self._lock.acquire()
+        try:
+            if self._own_token_free:
+                self._own_token_free = False
+                return None
+        finally:
+            self._lock.release()
+        read_fd, write_fd = self._get_fds()
+        while True:
+            try:
+                return os.read(read_fd, 1)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    def release(self, token):
+        if token is None:
+            self._lock.acquire()
+            try:
+                self._own_token_free = True
+            finally:
+                self._lock.release()
+        else:
+            read_fd, write_fd = self._get_fds()
+            os.write(write_fd, token)
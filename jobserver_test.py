@@ -0,0 +1,63 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import jobserver
+
+
+def write_file(filename, data):
+    fh = open(filename, "w")
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+
+
+class JobServerTest(unittest.TestCase):
+
+    def test_tokens(self):
+        server = jobserver.JobServer(3)
+        tokens = [server.acquire() for index in range(3)]
+        self.assertEquals(tokens, [None, "+", "+"])
+        # The pool is now empty.
+        read_fd = int(server.get_makeflags().split("=")[1].split(",")[0])
+        self.assertEquals(select.select([read_fd], [], [], 0)[0], [])
+        server.release(tokens[1])
+        self.assertEquals(select.select([read_fd], [], [], 0)[0], [read_fd])
+        server.release(tokens[0])
+        self.assertEquals(server.acquire(), None)
+
+    def test_make_uses_jobserver(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-jobserver_test-")
+        try:
+            write_file(os.path.join(temp_dir, "Makefile"), """\
+all: a b
+a b:
+\t@echo $@ $(findstring jobserver,$(MAKEFLAGS))
+""")
+            server = jobserver.JobServer(2)
+            env = os.environ.copy()
+            env["MAKEFLAGS"] = server.get_makeflags()
+            proc = subprocess.Popen(["make", "-s"], cwd=temp_dir, env=env,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+            self.assertEquals(proc.wait(), 0)
+            self.assertEquals(sorted(output.splitlines()),
+                              ["a jobserver", "b jobserver"])
+            # make has returned the tokens it took.
+            self.assertEquals(server.acquire(), None)
+            self.assertEquals(server.acquire(), "+")
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,445 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Runs commands on worker daemons, over a Unix socket or through ssh,
+# behind the same cmd() interface as cmd_env.BasicEnv.
+#
+# Start a worker with "remote_env.py --socket PATH", or let
+# ssh_transport() start one with "remote_env.py --stdio".  A connection
+# carries one command at a time, and is reused for the next command
+# once the previous one has finished.  Messages are a one-byte kind
+# and a four-byte length followed by the data:
+#  * "C": a command to run, as JSON (client to worker).
+#  * "O", "E": a chunk of the command's stdout or stderr.
+#  * "X": the command's return code, in decimal.
+
+import fcntl
+import json
+import optparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+import cmd_env
+
+
+class RemoteError(Exception):
+    pass
+
+
+def read_exactly(fh, size):
+    chunks = []
+    while size > 0:
+        chunk = fh.read(size)
+        if chunk == "":
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def read_message(fh):
+    # Returns (kind, data), or None at the end of the stream.
+    header = read_exactly(fh, 5)
+    if header == "":
+        return None
+    if len(header) != 5:
+        raise RemoteError("Truncated message header")
+    kind, size = struct.unpack("!cI", header)
+    data = read_exactly(fh, size)
+    if len(data) != size:
+        raise RemoteError("Truncated message")
+    return kind, data
+
+
+class MessageWriter(object):
+
+    # Writes whole messages, so that threads can share the stream.
+
+    def __init__(self, fh):
+        self._fh = fh
+        self._lock = threading.Lock()
+
+    def write(self, kind, data):
+        self._lock.acquire()
+        try:
+            self._fh.write(struct.pack("!cI", kind, len(data)) + data)
+            self._fh.flush()
+        finally:
+            self._lock.release()
+
+
+def encode_strings(value):
+    # Converts JSON's unicode strings back to byte strings.
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [encode_strings(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((encode_strings(key), encode_strings(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+# Worker side.
+
+def forward_output(fh, kind, writer):
+    while True:
+        data = os.read(fh.fileno(), 65536)
+        if data == "":
+            break
+        writer.write(kind, data)
+    fh.close()
+
+
+def run_request(request, writer):
+    devnull = open(os.devnull, "r")
+    try:
+        proc = subprocess.Popen(request["args"], cwd=request.get("cwd"),
+                                env=request.get("env"), stdin=devnull,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                close_fds=True)
+    except OSError, exn:
+        writer.write("E", "Failed to run %r: %s\n" % (request["args"], exn))
+        writer.write("X", "127")
+        return
+    finally:
+        devnull.close()
+    threads = [threading.Thread(target=forward_output,
+                                args=(proc.stdout, "O", writer)),
+               threading.Thread(target=forward_output,
+                                args=(proc.stderr, "E", writer))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.write("X", str(proc.wait()))
+
+
+def handle_connection(reader, writer):
+    while True:
+        message = read_message(reader)
+        if message is None:
+            break
+        kind, data = message
+        if kind != "C":
+            raise RemoteError("Unexpected message kind: %r" % kind)
+        run_request(encode_strings(json.loads(data)), writer)
+
+
+def serve_socket(sock):
+    # Handles each connection on its own thread, until the socket is
+    # shut down.
+    while True:
+        try:
+            conn, address = sock.accept()
+        except socket.error:
+            break
+        def handle(conn=conn):
+            reader = conn.makefile("rb")
+            try:
+                handle_connection(reader, MessageWriter(conn.makefile("wb")))
+            except (socket.error, IOError):
+                # The client went away.
+                pass
+            finally:
+                reader.close()
+                conn.close()
+        thread = threading.Thread(target=handle)
+        thread.setDaemon(True)
+        thread.start()
+
+
+def listen_unix(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(16)
+    return sock
+
+
+def serve_stdio():
+    # Keep our own stdout for messages, and send anything else that
+    # writes to fd 1 to stderr.
+    reader = os.fdopen(os.dup(0), "rb", 0)
+    writer = MessageWriter(os.fdopen(os.dup(1), "wb"))
+    os.dup2(2, 1)
+    handle_connection(reader, writer)
+
+
+# Client side.
+
+class Connection(object):
+
+    def __init__(self, reader, writer, close):
+        self.reader = reader
+        self.writer = MessageWriter(writer)
+        self._close = close
+
+    def close(self):
+        self._close()
+
+
+class UnixSocketTransport(object):
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self._socket_path)
+        reader = sock.makefile("rb")
+        writer = sock.makefile("wb")
+        def close():
+            reader.close()
+            writer.close()
+            sock.close()
+        return Connection(reader, writer, close)
+
+
+class CommandTransport(object):
+
+    # Runs a command that speaks the protocol on its stdin and stdout,
+    # such as "remote_env.py --stdio".
+
+    def __init__(self, command):
+        self._command = command
+
+    def connect(self):
+        proc = subprocess.Popen(self._command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, close_fds=True)
+        def close():
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+        return Connection(proc.stdout, proc.stdin, close)
+
+
+def ssh_transport(host, remote_command):
+    # remote_command starts "remote_env.py --stdio" on the host.
+    return CommandTransport(["ssh", "-T", host] + remote_command)
+
+
+class RemoteProcess(object):
+
+    # Similar to subprocess.Popen for a command run by a worker.  Its
+    # output is copied to the given files as it arrives.  "outputs"
+    # maps "O" and "E" to a file object.  "pipes" lists the write ends
+    # of local pipes among them, which are closed when the command
+    # finishes; the read ends are given as "stdout" and "stderr", as
+    # with subprocess.PIPE.
+
+    def __init__(self, connection, outputs, pipes, on_finish,
+                 stdout=None, stderr=None):
+        self.returncode = None
+        self.stdout = stdout
+        self.stderr = stderr
+        self._connection = connection
+        self._outputs = outputs
+        self._pipes = pipes
+        self._on_finish = on_finish
+        self._error = None
+        self._thread = threading.Thread(target=self._read)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _read(self):
+        connection = self._connection
+        try:
+            try:
+                while True:
+                    message = read_message(connection.reader)
+                    if message is None:
+                        raise RemoteError("Worker closed the connection")
+                    kind, data = message
+                    if kind == "X":
+                        self.returncode = int(data)
+                        break
+                    self._outputs[kind].write(data)
+                    self._outputs[kind].flush()
+            except Exception:
+                self._error = sys.exc_info()
+                connection.close()
+                connection = None
+        finally:
+            for fh in self._pipes:
+                try:
+                    fh.close()
+                except IOError:
+                    # The reader closed its end early.
+                    pass
+            self._on_finish(connection)
+
+    def wait(self):
+        # Joining with a timeout keeps us interruptible.
+        while self._thread.isAlive():
+            self._thread.join(0.1)
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self.returncode
+
+    def communicate(self):
+        # Returns (stdout, stderr), reading whichever are pipes.  Both
+        # are read at once so that the command cannot block on a full
+        # pipe.
+        results = {}
+        def read(name):
+            fh = getattr(self, name)
+            results[name] = fh.read()
+            fh.close()
+        threads = [threading.Thread(target=read, args=(name,))
+                   for name in ("stdout", "stderr")
+                   if getattr(self, name) is not None]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wait()
+        return results.get("stdout"), results.get("stderr")
+
+
+def open_pipe():
+    # Returns (read end, write end) as file objects.  Neither end is
+    # inherited by other commands we run, which would stop the read
+    # end from seeing the end of the output.
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb", 0)
+
+
+class RemoteWorker(object):
+
+    def __init__(self, transport, limit):
+        self.transport = transport
+        self.limit = limit
+        self.active = 0
+        self.idle_connections = []
+
+
+class RemoteWorkerPool(object):
+
+    # Sends each command to the least busy worker that is running
+    # fewer than per_worker_limit commands, waiting if they are all
+    # busy.
+
+    def __init__(self, transports, per_worker_limit=1):
+        self._workers = [RemoteWorker(transport, per_worker_limit)
+                         for transport in transports]
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        self._condition.acquire()
+        try:
+            while True:
+                free = [worker for worker in self._workers
+                        if worker.active < worker.limit]
+                if len(free) > 0:
+                    break
+                self._condition.wait(0.1)
+            worker = min(free, key=lambda worker: float(worker.active) /
+                                                  worker.limit)
+            worker.active += 1
+            if len(worker.idle_connections) > 0:
+                return worker, worker.idle_connections.pop()
+            return worker, None
+        finally:
+            self._condition.release()
+
+    def _release(self, worker, connection):
+        self._condition.acquire()
+        try:
+            worker.active -= 1
+            if connection is not None:
+                worker.idle_connections.append(connection)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def cmd(self, args, do_wait=True, fork=True, stdout=None, stderr=None,
+            cwd=None, env=None, **kwargs):
+        # stdout and stderr are file objects that the output is copied
+        # to, defaulting to ours, or subprocess.PIPE, or for stderr,
+        # subprocess.STDOUT.  Commands get no stdin.
+        if len(kwargs) > 0:
+            raise TypeError("RemoteWorkerPool.cmd() does not support: %s"
+                            % ", ".join(sorted(kwargs)))
+        assert fork, "Cannot exec a remote command in place"
+        pipes = []
+        pipe_ends = {}
+        outputs = {}
+        for kind, name, target, default in [
+                ("O", "stdout", stdout, sys.stdout),
+                ("E", "stderr", stderr, sys.stderr)]:
+            if target == subprocess.STDOUT and kind == "E":
+                outputs[kind] = outputs["O"]
+            elif target == subprocess.PIPE:
+                read_end, write_end = open_pipe()
+                pipe_ends[name] = read_end
+                pipes.append(write_end)
+                outputs[kind] = write_end
+            elif target is None:
+                outputs[kind] = default
+            elif hasattr(target, "write"):
+                outputs[kind] = target
+            else:
+                raise TypeError("Unsupported %s for RemoteWorkerPool.cmd(): %r"
+                                % (name, target))
+        worker, connection = self._acquire()
+        try:
+            if connection is None:
+                connection = worker.transport.connect()
+            request = {"args": args}
+            if cwd is not None:
+                request["cwd"] = cwd
+            if env is not None:
+                request["env"] = env
+            connection.writer.write("C", json.dumps(request))
+        except:
+            if connection is not None:
+                connection.close()
+            self._release(worker, None)
+            for fh in pipes + pipe_ends.values():
+                fh.close()
+            raise
+        process = RemoteProcess(
+            connection, outputs, pipes,
+            lambda connection: self._release(worker, connection),
+            stdout=pipe_ends.get("stdout"), stderr=pipe_ends.get("stderr"))
+        if do_wait:
+            if len(pipe_ends) > 0:
+                process.communicate()
+            rc = process.wait()
+            if rc != 0:
+                raise cmd_env.CommandFailedError(
+                    "Command failed with return code %i: %s" % (rc, args), rc)
+        return process
+
+    def close(self):
+        for worker in self._workers:
+            for connection in worker.idle_connections:
+                connection.close()
+            worker.idle_connections = []
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option("--socket", dest="socket_path", default=None,
+                      help="Listen on the given Unix socket")
+    parser.add_option("--stdio", dest="stdio", default=False,
+                      action="store_true",
+                      help="Handle one connection on stdin and stdout")
+    options, args = parser.parse_args(args)
+    if options.stdio:
+        serve_stdio()
+    elif options.socket_path is not None:
+        serve_socket(listen_unix(options.socket_path))
+    else:
+        parser.error("Expected --socket or --stdio")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import os
+import shutil
+import socket
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import capture
+import cmd_env
+import remote_env
+
+
+class RemoteEnvTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix="remote_env_test")
+        self._sock = remote_env.listen_unix(
+            os.path.join(self._temp_dir, "socket"))
+        thread = threading.Thread(target=remote_env.serve_socket,
+                                  args=(self._sock,))
+        thread.setDaemon(True)
+        thread.start()
+        self._transport = remote_env.UnixSocketTransport(
+            os.path.join(self._temp_dir, "socket"))
+
+    def tearDown(self):
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._sock.close()
+        shutil.rmtree(self._temp_dir)
+
+    def check_output(self, pool):
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        pool.cmd(["sh", "-c", "pwd; echo err >&2; echo $FOO"],
+                 cwd=self._temp_dir, env={"FOO": "bar"},
+                 stdout=stdout, stderr=stderr)
+        self.assertEquals(stdout.getvalue(),
+                          "%s\nbar\n" % os.path.realpath(self._temp_dir))
+        self.assertEquals(stderr.getvalue(), "err\n")
+        try:
+            pool.cmd(["sh", "-c", "exit 3"])
+        except cmd_env.CommandFailedError, exn:
+            self.assertEquals(exn.rc, 3)
+        else:
+            self.fail("Expected an error")
+        proc = pool.cmd(["nonexistent-command"], do_wait=False,
+                        stderr=StringIO.StringIO())
+        self.assertEquals(proc.wait(), 127)
+
+    def test_socket(self):
+        pool = remote_env.RemoteWorkerPool([self._transport])
+        self.check_output(pool)
+        pool.close()
+
+    def test_stdio(self):
+        pool = remote_env.RemoteWorkerPool([remote_env.CommandTransport(
+                    [sys.executable, os.path.abspath(remote_env.__file__)
+                     .replace(".pyc", ".py"), "--stdio"])])
+        self.check_output(pool)
+        pool.close()
+
+    def test_pipes(self):
+        pool = remote_env.RemoteWorkerPool([self._transport])
+        proc = pool.cmd(["sh", "-c", "echo out; echo err >&2"], do_wait=False,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEquals(proc.communicate(), ("out\n", "err\n"))
+        self.assertEquals(proc.wait(), 0)
+        proc = pool.cmd(["sh", "-c", "echo out; echo err >&2"], do_wait=False,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # The worker reads stdout and stderr separately, so their
+        # order is not kept.
+        self.assertEquals(sorted(proc.stdout.read().splitlines()),
+                          ["err", "out"])
+        self.assertEquals(proc.wait(), 0)
+        plan = cmd_env.MountPlan()
+        plan.cmd(["true"])
+        plan.cmd(["sh", "-c", "exit 4"])
+        try:
+            plan.run(pool)
+        except cmd_env.CommandFailedError, exn:
+            self.assertEquals(exn.rc, 4)
+        else:
+            self.fail("Expected an error")
+        self.assertRaises(TypeError, lambda: pool.cmd(["true"], stdin=None))
+        pool.close()
+
+    def test_capture_env(self):
+        pool = remote_env.RemoteWorkerPool([self._transport])
+        env = capture.CaptureEnv(pool)
+        output = capture.OutputCapture()
+        capture.current.capture = output
+        try:
+            env.cmd(["sh", "-c", "echo out; echo err >&2"])
+            env.cmd(["sh", "-c", "echo only err >&2"],
+                    stdout=StringIO.StringIO())
+            try:
+                env.cmd(["sh", "-c", "echo failing; exit 2"])
+            except cmd_env.CommandFailedError, exn:
+                self.assertEquals(exn.rc, 2)
+            else:
+                self.fail("Expected an error")
+        finally:
+            capture.current.capture = None
+        self.assertEquals(sorted(output.get_tail().splitlines()),
+                          ["err", "failing", "only err", "out"])
+        pool.close()
+
+    def test_limit(self):
+        # Each command fails if another one is running at the same
+        # time on the worker.
+        lock_dir = os.path.join(self._temp_dir, "lock")
+        script = 'mkdir "$1" || exit 1; sleep 0.05; rmdir "$1"'
+        pool = remote_env.RemoteWorkerPool([self._transport],
+                                            per_worker_limit=1)
+        procs = [pool.cmd(["sh", "-c", script, "-", lock_dir], do_wait=False,
+                          stderr=StringIO.StringIO())
+                 for index in range(4)]
+        self.assertEquals([proc.wait() for proc in procs], [0] * 4)
+        pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import json
+import optparse
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def get_io_counters():
+    # Returns (bytes read, bytes written) by this process and the
+    # children it has waited for.
+    try:
+        fh = open("/proc/self/io", "r")
+    except IOError:
+        # Fall back to block counts from rusage.
+        counts = [0, 0]
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+            usage = resource.getrusage(who)
+            counts[0] += usage.ru_inblock * 512
+            counts[1] += usage.ru_oublock * 512
+        return tuple(counts)
+    try:
+        fields = dict(line.split(":", 1) for line in fh)
+    finally:
+        fh.close()
+    return (int(fields["read_bytes"]), int(fields["write_bytes"]))
+
+
+def get_usage():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    read_bytes, write_bytes = get_io_counters()
+    return {"child_user_cpu": children.ru_utime,
+            "child_sys_cpu": children.ru_stime,
+            "self_cpu": self_usage.ru_utime + self_usage.ru_stime,
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes}
+
+
+class TimingLogWriter(object):
+
+    # Implements the same child_log/start/finish protocol as
+    # action_tree.DummyLogWriter, and writes a JSON record per node
+    # to the stream when the node finishes.
+    #
+    # The counters are process-wide, so when nodes run concurrently
+    # each node's figures include whatever ran alongside it.
+    # "children_max_rss_kb_so_far" is not a per-node figure: rusage
+    # only gives the largest RSS of any child waited for so far in the
+    # whole process, so it is only meaningful as a per-run peak.
+
+    def __init__(self, stream, path=(), run_id=None, lock=None):
+        self._stream = stream
+        self._path = list(path)
+        if run_id is None:
+            run_id = time.time()
+        self._run_id = run_id
+        if lock is None:
+            lock = threading.Lock()
+        self._lock = lock
+        self._start_time = None
+        self._start_usage = None
+
+    def start(self):
+        self._start_time = time.time()
+        self._start_usage = get_usage()
+
+    def child_log(self, name, do_start=True):
+        child = TimingLogWriter(self._stream, self._path + [name],
+                                run_id=self._run_id, lock=self._lock)
+        if do_start:
+            child.start()
+        return child
+
+    def finish(self, result):
+        if self._start_time is None:
+            return
+        end_time = time.time()
+        usage = get_usage()
+        record = {"run": self._run_id,
+                  "path": self._path,
+                  "result": result,
+                  "start": self._start_time,
+                  "end": end_time,
+                  "wall": end_time - self._start_time,
+                  "children_max_rss_kb_so_far": resource.getrusage(
+                      resource.RUSAGE_CHILDREN).ru_maxrss}
+        for key, value in usage.iteritems():
+            record[key] = value - self._start_usage[key]
+        self._lock.acquire()
+        try:
+            self._stream.write(json.dumps(record, sort_keys=True) + "\n")
+            self._stream.flush()
+        finally:
+            self._lock.release()
+
+
+class DurationDb(object):
+
+    # Stores how long each step took, keyed on its dotted path, for
+    # action_tree.run_action() to use when ordering steps.  We keep a
+    # moving average so that one unusual run does not dominate.
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._durations = None
+
+    def _load(self):
+        if self._durations is None:
+            if os.path.exists(self._filename):
+                fh = open(self._filename, "r")
+                try:
+                    self._durations = json.load(fh)
+                finally:
+                    fh.close()
+            else:
+                self._durations = {}
+        return self._durations
+
+    def get(self, path):
+        # Steps that have never run are assumed to be quick.
+        return self._load().get(path, 0)
+
+    def record(self, path, duration):
+        durations = self._load()
+        if path in durations:
+            duration = (durations[path] + duration) / 2.0
+        durations[path] = duration
+
+    def save(self):
+        if self._durations is None:
+            return
+        temp_file = "%s.tmp" % self._filename
+        fh = open(temp_file, "w")
+        try:
+            json.dump(self._durations, fh, sort_keys=True, indent=0)
+        finally:
+            fh.close()
+        os.rename(temp_file, self._filename)
+
+
+def read_records(stream):
+    for line in stream:
+        if line.strip() != "":
+            yield json.loads(line)
+
+
+def get_leaf_records(records):
+    # Interior nodes get records too.  Leaves are the records whose
+    # path is not a prefix of another record's path.
+    interior = set()
+    for record in records:
+        for index in range(len(record["path"])):
+            interior.add(tuple(record["path"][:index]))
+    return [record for record in records
+            if tuple(record["path"]) not in interior]
+
+
+def get_critical_path(leaves):
+    # Works backwards from the leaf that finished last, each time
+    # picking the leaf that finished most recently before the current
+    # one started.  This does not need to know the dependencies.
+    if len(leaves) == 0:
+        return []
+    by_end = sorted(leaves, key=lambda record: record["end"])
+    path = [by_end[-1]]
+    while True:
+        start = path[-1]["start"]
+        earlier = [record for record in by_end if record["end"] <= start]
+        if len(earlier) == 0:
+            break
+        path.append(earlier[-1])
+    path.reverse()
+    return path
+
+
+def format_path(record):
+    return ".".join(record["path"])
+
+
+def print_summary(records, stream, count=10):
+    # Summarises the most recent run in the records.
+    if len(records) == 0:
+        stream.write("No records\n")
+        return
+    run_id = max(record["run"] for record in records)
+    leaves = get_leaf_records([record for record in records
+                               if record["run"] == run_id])
+    total = (max(record["end"] for record in leaves) -
+             min(record["start"] for record in leaves))
+    max_rss = max(record["children_max_rss_kb_so_far"] for record in leaves)
+    stream.write("Run took %.1fs\n" % total)
+    stream.write("Peak RSS of any child process: %i kB\n" % max_rss)
+    stream.write("\nSlowest steps:\n")
+    for record in sorted(leaves, key=lambda record: record["wall"],
+                         reverse=True)[:count]:
+        stream.write("  %8.1fs  %8.1fs cpu  %s%s\n" % (
+                record["wall"],
+                record["child_user_cpu"] + record["child_sys_cpu"] +
+                record["self_cpu"],
+                format_path(record),
+                " (failed)" if record["result"] != 0 else ""))
+    critical_path = get_critical_path(leaves)
+    stream.write("\nCritical path (%.1fs):\n"
+                 % sum(record["wall"] for record in critical_path))
+    for record in critical_path:
+        stream.write("  %8.1fs  %s\n" % (record["wall"], format_path(record)))
+
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options] log_file")
+    parser.add_option("-n", dest="count", default=10, type="int",
+                      help="Number of slowest steps to list")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Expected a log file")
+    fh = open(args[0], "r")
+    try:
+        records = list(read_records(fh))
+    finally:
+        fh.close()
+    print_summary(records, sys.stdout, count=options.count)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
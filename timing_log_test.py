@@ -0,0 +1,95 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import os
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import unittest
+
+import action_tree
+import timing_log
+
+
+def make_record(path, start, end, result=0, max_rss=0):
+    return {"run": 1, "path": path, "result": result, "start": start,
+            "end": end, "wall": end - start,
+            "children_max_rss_kb_so_far": max_rss,
+            "child_user_cpu": 0, "child_sys_cpu": 0, "self_cpu": 0,
+            "read_bytes": 0, "write_bytes": 0}
+
+
+class TimingLogTest(unittest.TestCase):
+
+    def test_records(self):
+        def run_child(log):
+            subprocess.check_call(["true"])
+        def fail(log):
+            raise Exception("lose")
+        tree = action_tree.make_node(
+            [action_tree.make_node([("child", run_child)], name="subtree"),
+             ("fail", fail)], name="top")
+        stream = StringIO.StringIO()
+        log = timing_log.TimingLogWriter(stream)
+        self.assertRaises(Exception,
+                          lambda: action_tree.action_main(tree, ["0"], log=log))
+        records = list(timing_log.read_records(
+                StringIO.StringIO(stream.getvalue())))
+        self.assertEquals([(record["path"], record["result"])
+                           for record in records],
+                          [(["subtree", "child"], 0), (["subtree"], 0),
+                           (["fail"], 1)])
+        child = records[0]
+        self.assertTrue(child["wall"] >= 0)
+        self.assertTrue(child["child_user_cpu"] + child["child_sys_cpu"] >= 0)
+        self.assertTrue(child["children_max_rss_kb_so_far"] > 0)
+
+    def test_summary(self):
+        records = [
+            make_record(["all", "a", "make"], 0, 10, max_rss=100),
+            make_record(["all", "a"], 0, 10),
+            make_record(["all", "b", "make"], 0, 3),
+            make_record(["all", "b"], 0, 3),
+            make_record(["all", "c", "make"], 10, 12, max_rss=250),
+            make_record(["all", "c"], 10, 12),
+            make_record(["all"], 0, 12)]
+        leaves = timing_log.get_leaf_records(records)
+        self.assertEquals([timing_log.format_path(record) for record in leaves],
+                          ["all.a.make", "all.b.make", "all.c.make"])
+        self.assertEquals([timing_log.format_path(record) for record
+                           in timing_log.get_critical_path(leaves)],
+                          ["all.a.make", "all.c.make"])
+        stream = StringIO.StringIO()
+        timing_log.print_summary(records, stream, count=1)
+        self.assertEquals(stream.getvalue(), """\
+Run took 12.0s
+Peak RSS of any child process: 250 kB
+
+Slowest steps:
+      10.0s       0.0s cpu  all.a.make
+
+Critical path (12.0s):
+      10.0s  all.a.make
+       2.0s  all.c.make
+""")
+
+    def test_duration_db(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-timing_log_test-")
+        try:
+            filename = os.path.join(temp_dir, "durations.json")
+            durations = timing_log.DurationDb(filename)
+            self.assertEquals(durations.get("all.foo"), 0)
+            durations.record("all.foo", 10)
+            durations.save()
+            durations = timing_log.DurationDb(filename)
+            self.assertEquals(durations.get("all.foo"), 10)
+            durations.record("all.foo", 20)
+            self.assertEquals(durations.get("all.foo"), 15)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,350 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+# Applies unified diffs in-process, as "patch -p1" would.  A hunk may
+# be found at an offset from the line numbers given.  As with patch's
+# default of "--fuzz 2", if a hunk's context does not match anywhere,
+# up to two of its outermost context lines at either end are ignored.
+
+import collections
+import hashlib
+import os
+import re
+import threading
+
+
+class PatchError(Exception):
+
+    # "failures" lists a message per hunk or file that failed.
+
+    def __init__(self, failures):
+        Exception.__init__(self, "Patch failed:\n  " + "\n  ".join(failures))
+        self.failures = failures
+
+
+class Hunk(object):
+
+    def __init__(self, old_start, old_len, new_start, new_len):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        # List of (tag, line) where tag is " ", "-" or "+" and line
+        # includes its newline, if any.
+        self.lines = []
+
+    def get_old_lines(self):
+        return [line for tag, line in self.lines if tag != "+"]
+
+    def get_new_lines(self):
+        return [line for tag, line in self.lines if tag != "-"]
+
+    def get_context_lengths(self):
+        # Returns the numbers of context lines before the first change
+        # and after the last.
+        tags = [tag for tag, line in self.lines]
+        leading = 0
+        while leading < len(tags) and tags[leading] == " ":
+            leading += 1
+        trailing = 0
+        while trailing < len(tags) - leading and tags[-1 - trailing] == " ":
+            trailing += 1
+        return leading, trailing
+
+    def describe(self):
+        return "@@ -%i,%i +%i,%i @@" % (self.old_start, self.old_len,
+                                       self.new_start, self.new_len)
+
+
+class FilePatch(object):
+
+    def __init__(self, path, is_new, is_deleted):
+        self.path = path
+        self.is_new = is_new
+        self.is_deleted = is_deleted
+        self.hunks = []
+
+
+hunk_header_regexp = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def parse_filename(header, strip):
+    # Returns the filename from a "---" or "+++" line with "strip"
+    # leading components removed, as for "patch -p", or None for
+    # /dev/null.  Also returns whether the timestamp is the epoch,
+    # which "diff -N" uses for files that do not exist.
+    if "\t" in header:
+        name, timestamp = header.split("\t", 1)
+    else:
+        match = re.match(r"(.*?)\s+(\d{4}-\d\d-\d\d .*)$", header)
+        if match is None:
+            name, timestamp = header.rstrip(), ""
+        else:
+            name, timestamp = match.groups()
+    is_epoch = timestamp.startswith("1970-01-01")
+    if name == "/dev/null":
+        return None, True
+    parts = name.split("/")
+    if len(parts) <= strip:
+        raise PatchError(["Cannot strip %i components from %r"
+                          % (strip, name)])
+    return "/".join(parts[strip:]), is_epoch
+
+
+def parse_patch(data, strip=1):
+    # Returns a list of FilePatches.  Lines outside of the "---",
+    # "+++" headers and hunks, such as "diff" and "Only in" lines, are
+    # ignored.
+    lines = data.split("\n")
+    file_patches = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if (line.startswith("--- ") and index + 1 < len(lines) and
+            lines[index + 1].startswith("+++ ")):
+            old_path, old_missing = parse_filename(line[4:], strip)
+            new_path, new_missing = parse_filename(lines[index + 1][4:], strip)
+            if new_path is None and old_path is None:
+                raise PatchError(["Both files are /dev/null at line %i"
+                                  % (index + 1)])
+            file_patches.append(FilePatch(new_path or old_path,
+                                          is_new=old_missing,
+                                          is_deleted=new_missing))
+            index += 2
+        elif line.startswith("@@ "):
+            match = hunk_header_regexp.match(line)
+            if match is None or len(file_patches) == 0:
+                raise PatchError(["Bad hunk header at line %i: %r"
+                                  % (index + 1, line)])
+            old_start, old_len, new_start, new_len = match.groups()
+            hunk = Hunk(int(old_start), int(old_len or 1),
+                        int(new_start), int(new_len or 1))
+            index += 1
+            old_left = hunk.old_len
+            new_left = hunk.new_len
+            while old_left > 0 or new_left > 0:
+                # The data ends with "\n", so the last element of lines
+                # is always an empty string.
+                if index >= len(lines) - 1 and lines[index:] in ([], [""]):
+                    raise PatchError(["Truncated hunk %s in %s"
+                                      % (hunk.describe(),
+                                         file_patches[-1].path)])
+                line = lines[index]
+                index += 1
+                if line.startswith("\\"):
+                    # "\ No newline at end of file"
+                    tag, text = hunk.lines[-1]
+                    hunk.lines[-1] = (tag, text[:-1])
+                    continue
+                # Some editors strip the space from empty context lines.
+                tag = line[:1] or " "
+                if tag == " ":
+                    old_left -= 1
+                    new_left -= 1
+                elif tag == "-":
+                    old_left -= 1
+                elif tag == "+":
+                    new_left -= 1
+                else:
+                    raise PatchError(["Bad line in hunk %s in %s at line %i: "
+                                      "%r" % (hunk.describe(),
+                                              file_patches[-1].path,
+                                              index, line)])
+                hunk.lines.append((tag, line[1:] + "\n"))
+            if index < len(lines) and lines[index].startswith("\\"):
+                tag, text = hunk.lines[-1]
+                hunk.lines[-1] = (tag, text[:-1])
+                index += 1
+            if old_left < 0 or new_left < 0:
+                raise PatchError(["Hunk %s in %s has the wrong line counts"
+                                  % (hunk.describe(), file_patches[-1].path)])
+            file_patches[-1].hunks.append(hunk)
+        else:
+            index += 1
+    return file_patches
+
+
+def split_lines(data):
+    # Splits data into lines that keep their newlines, unlike
+    # splitlines(), which also splits on "\r" and others.
+    lines = [line + "\n" for line in data.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def find_hunk(lines, old_lines, start, expected):
+    # Looks for old_lines in lines at or after start, trying the
+    # expected position first and then moving outwards.
+    last = len(lines) - len(old_lines)
+    expected = min(max(expected, start), max(last, start))
+    for delta in xrange(max(expected - start, last - expected) + 1):
+        for pos in (expected - delta, expected + delta):
+            if start <= pos <= last and lines[pos:pos + len(old_lines)] == \
+                    old_lines:
+                return pos
+    return None
+
+
+max_fuzz = 2
+
+
+def find_hunk_with_fuzz(lines, hunk, start, expected):
+    # Returns (pos, before, after), where before and after are how
+    # many of the hunk's leading and trailing context lines had to be
+    # ignored for the rest of its old lines to be found at pos, or
+    # None if the hunk does not match.
+    old_lines = hunk.get_old_lines()
+    leading, trailing = hunk.get_context_lengths()
+    for fuzz in xrange(max_fuzz + 1):
+        before = min(fuzz, leading)
+        after = min(fuzz, trailing)
+        if fuzz > 0 and before < fuzz and after < fuzz:
+            # There is no more context to ignore.
+            break
+        found = find_hunk(lines, old_lines[before:len(old_lines) - after],
+                          start, expected + before)
+        if found is not None:
+            return found, before, after
+    return None
+
+
+def apply_hunks(path, data, hunks):
+    # Returns the patched data, or raises PatchError listing every
+    # hunk that did not apply.
+    lines = split_lines(data)
+    result = []
+    pos = 0
+    offset = 0
+    failures = []
+    for number, hunk in enumerate(hunks):
+        if hunk.old_len == 0:
+            # The hunk goes after line old_start.
+            expected = hunk.old_start
+        else:
+            expected = hunk.old_start - 1
+        match = find_hunk_with_fuzz(lines, hunk, pos, expected + offset)
+        if match is None:
+            failures.append("%s: hunk #%i %s does not match at or after "
+                            "line %i" % (path, number + 1, hunk.describe(),
+                                         pos + 1))
+            continue
+        found, before, after = match
+        old_lines = hunk.get_old_lines()
+        new_lines = hunk.get_new_lines()
+        # The file's own lines are kept in place of ignored context.
+        result.extend(lines[pos:found])
+        result.extend(new_lines[before:len(new_lines) - after])
+        pos = found + len(old_lines) - before - after
+        offset = found - before - expected
+    if len(failures) > 0:
+        raise PatchError(failures)
+    result.extend(lines[pos:])
+    return "".join(result)
+
+
+parse_cache = {}
+parse_cache_lock = threading.Lock()
+
+
+def read_patch(filename, strip=1):
+    # Parses the patch file, reusing the result for files with the
+    # same contents.  Patches are validated when they are parsed.
+    fh = open(filename, "rb")
+    try:
+        data = fh.read()
+    finally:
+        fh.close()
+    key = (hashlib.sha1(data).hexdigest(), strip)
+    parse_cache_lock.acquire()
+    try:
+        if key not in parse_cache:
+            parse_cache[key] = parse_patch(data, strip)
+        return parse_cache[key]
+    finally:
+        parse_cache_lock.release()
+
+
+def write_file_replacing(filename, data):
+    # Writes a new file rather than rewriting the old one in place,
+    # in case the old one is hard linked, keeping its permissions.
+    temp_file = "%s.patch-tmp" % filename
+    fh = open(temp_file, "wb")
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+    if os.path.exists(filename):
+        os.chmod(temp_file, os.stat(filename).st_mode & 07777)
+    os.rename(temp_file, filename)
+
+
+class PatchSet(object):
+
+    # The changes from one or more patches, applied in order.
+
+    def __init__(self, file_patches):
+        self._by_path = collections.OrderedDict()
+        for file_patch in file_patches:
+            self._by_path.setdefault(file_patch.path, []).append(file_patch)
+
+    def get_paths(self):
+        return self._by_path.keys()
+
+    def apply_to_data(self, path, data):
+        # data is None if the file does not exist.  Returns None if
+        # the patches delete the file.
+        for file_patch in self._by_path[path]:
+            if data is None:
+                if not file_patch.is_new:
+                    raise PatchError(["%s: file to patch does not exist"
+                                      % path])
+                data = ""
+            data = apply_hunks(path, data, file_patch.hunks)
+            if file_patch.is_deleted:
+                if data != "":
+                    raise PatchError(["%s: file is not empty after being "
+                                      "deleted" % path])
+                data = None
+        return data
+
+    def apply_to_dir(self, dest_dir, skip=()):
+        # Rewrites only the files that are patched.  Files are given
+        # the current time as their mtime, as patch(1) does.
+        failures = []
+        for path in self._by_path:
+            if path in skip:
+                continue
+            filename = os.path.join(dest_dir, path)
+            if os.path.exists(filename):
+                fh = open(filename, "rb")
+                try:
+                    data = fh.read()
+                finally:
+                    fh.close()
+            else:
+                data = None
+            try:
+                new_data = self.apply_to_data(path, data)
+            except PatchError, exn:
+                failures.extend(exn.failures)
+                continue
+            if new_data is None:
+                if data is not None:
+                    os.unlink(filename)
+            else:
+                dir_path = os.path.dirname(filename)
+                if not os.path.exists(dir_path):
+                    os.makedirs(dir_path)
+                write_file_replacing(filename, new_data)
+        if len(failures) > 0:
+            raise PatchError(failures)
+
+
+def read_patches(filenames, strip=1):
+    file_patches = []
+    for filename in filenames:
+        file_patches.extend(read_patch(filename, strip))
+    return PatchSet(file_patches)
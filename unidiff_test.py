@@ -0,0 +1,165 @@
+# Copyright 2010 The Native Client Authors.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import unidiff
+
+
+def write_file(filename, data):
+    fh = open(filename, "w")
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+
+
+def read_file(filename):
+    fh = open(filename, "r")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+def write_files(dir_path, files):
+    for path, data in files.iteritems():
+        filename = os.path.join(dir_path, path)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        write_file(filename, data)
+
+
+def read_files(dir_path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files[os.path.relpath(path, dir_path)] = read_file(path)
+    return files
+
+
+lines = "".join("line %i\n" % index for index in range(20))
+
+
+class UnidiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix="unidiff_test")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def make_diff(self, old_files, new_files):
+        # Uses diff(1) to get a realistic patch.
+        old_dir = os.path.join(self._temp_dir, "a")
+        new_dir = os.path.join(self._temp_dir, "b")
+        os.mkdir(old_dir)
+        os.mkdir(new_dir)
+        write_files(old_dir, old_files)
+        write_files(new_dir, new_files)
+        proc = subprocess.Popen(["diff", "-urN", "a", "b"],
+                                cwd=self._temp_dir, stdout=subprocess.PIPE)
+        diff = proc.communicate()[0]
+        self.assertEquals(proc.wait(), 1)
+        shutil.rmtree(old_dir)
+        shutil.rmtree(new_dir)
+        return diff
+
+    def test_apply_to_dir(self):
+        old_files = {"changed": lines,
+                     "dir/no_newline": "foo\nbar",
+                     "deleted": "gone\n",
+                     "unchanged": "same\n"}
+        new_files = {"changed": lines.replace("line 3\n", "line three\n")
+                                     .replace("line 17\n", ""),
+                     "dir/no_newline": "foo\nbaz",
+                     "dir/new": "new file\n",
+                     "unchanged": "same\n"}
+        diff = self.make_diff(old_files, new_files)
+        patch_set = unidiff.PatchSet(unidiff.parse_patch(diff))
+        self.assertEquals(sorted(patch_set.get_paths()),
+                          ["changed", "deleted", "dir/new", "dir/no_newline"])
+        dest_dir = os.path.join(self._temp_dir, "dest")
+        os.mkdir(dest_dir)
+        # Extra lines at the start check that hunks are found at an
+        # offset.
+        old_files["changed"] = "extra\nlines\n" + old_files["changed"]
+        new_files["changed"] = "extra\nlines\n" + new_files["changed"]
+        write_files(dest_dir, old_files)
+        patch_set.apply_to_dir(dest_dir)
+        self.assertEquals(read_files(dest_dir), new_files)
+
+    def test_several_patches(self):
+        diff1 = self.make_diff({"file": lines},
+                               {"file": lines.replace("line 5", "five")})
+        diff2 = self.make_diff({"file": lines.replace("line 5", "five")},
+                               {"file": lines.replace("line 5", "5")})
+        filenames = []
+        for index, diff in enumerate([diff1, diff2]):
+            filename = os.path.join(self._temp_dir, "%i.patch" % index)
+            write_file(filename, diff)
+            filenames.append(filename)
+        patch_set = unidiff.read_patches(filenames)
+        self.assertEquals(patch_set.apply_to_data("file", lines),
+                          lines.replace("line 5", "5"))
+        # The parsed patch is reused.
+        self.assertTrue(unidiff.read_patch(filenames[0]) is
+                        unidiff.read_patch(filenames[0]))
+
+    def test_fuzz(self):
+        diff = self.make_diff(
+            {"file": lines},
+            {"file": lines.replace("line 2\n", "two\n")
+                          .replace("line 10\n", "ten\n")})
+        patch_set = unidiff.PatchSet(unidiff.parse_patch(diff))
+        # The outermost context lines of each hunk have drifted, and
+        # the file's own versions of them are kept.
+        drifted = lines.replace("line 7\n", "seven\n") \
+                       .replace("line 12\n", "twelve\n") \
+                       .replace("line 13\n", "thirteen\n")
+        self.assertEquals(patch_set.apply_to_data("file", drifted),
+                          drifted.replace("line 2\n", "two\n")
+                                 .replace("line 10\n", "ten\n"))
+        # This agrees with patch(1).
+        write_file(os.path.join(self._temp_dir, "file"), drifted)
+        proc = subprocess.Popen(["patch", "-s", "-p1"], cwd=self._temp_dir,
+                                stdin=subprocess.PIPE)
+        proc.communicate(diff)
+        self.assertEquals(proc.wait(), 0)
+        self.assertEquals(patch_set.apply_to_data("file", drifted),
+                          read_file(os.path.join(self._temp_dir, "file")))
+        # Only two lines of context are ignored.
+        self.assertRaises(
+            unidiff.PatchError,
+            lambda: patch_set.apply_to_data(
+                "file", drifted.replace("line 11\n", "eleven\n")))
+
+    def test_failure_report(self):
+        diff = self.make_diff(
+            {"file": lines},
+            {"file": lines.replace("line 2\n", "two\n")
+                          .replace("line 17\n", "seventeen\n")})
+        patch_set = unidiff.PatchSet(unidiff.parse_patch(diff))
+        try:
+            patch_set.apply_to_data("file", lines.replace("line 16", "x"))
+        except unidiff.PatchError, exn:
+            self.assertEquals(len(exn.failures), 1)
+            self.assertTrue(exn.failures[0].startswith(
+                    "file: hunk #2 @@ -15,6 +15,6 @@ does not match"),
+                            exn.failures)
+        else:
+            self.fail("Expected an error")
+
+    def test_bad_patch(self):
+        self.assertRaises(unidiff.PatchError, lambda: unidiff.parse_patch(
+                "--- a/foo\n+++ b/foo\n@@ -1,2 +1,2 @@\n foo\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()